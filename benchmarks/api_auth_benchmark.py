@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Fires authenticated requests at the api's middleware stack in process and reports requests per second,
+once with the verified token cache and once with it disabled so every request pays for the RS512 verification.
+
+Usage: api_auth_benchmark.py [number_of_requests] [number_of_keys]
+"""
+import asyncio
+import contextlib
+import io
+import sys
+import time
+from os import path
+from uuid import uuid4
+
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), 'src'))
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import api
+from backend import Backend, APIKey, Application, Economy, KeyType, TokenCache, logger
+
+NUM_REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+NUM_KEYS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+CONCURRENCY = 16
+
+logger.setLevel(100)
+
+
+def setup_keys():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    api.private_key = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                                serialization.NoEncryption())
+    api.trusted_public_keys['TB.pub'] = private_key.public_key().public_bytes(serialization.Encoding.PEM,
+                                                                              serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+async def whoami(request, key: APIKey = None):
+    return web.json_response({"key_id": key.key_id})
+
+
+async def run(tokens: list[str]) -> float:
+    app = web.Application(middlewares=[api.unit_of_work, api.authenticate])
+    app.router.add_get('/bench', whoami)
+    async with TestClient(TestServer(app)) as client:
+        async def worker(offset):
+            for i in range(offset, NUM_REQUESTS, CONCURRENCY):
+                async with client.get('/bench', headers={"authorization": tokens[i % len(tokens)]}) as resp:
+                    assert resp.status == 200, resp.status
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):  # the middleware prints every url
+            await asyncio.gather(*[worker(i) for i in range(CONCURRENCY)])
+        return time.perf_counter() - start
+
+
+def main():
+    setup_keys()
+    api.backend = Backend('sqlite:///:memory:')
+    economy = Economy(economy_id=uuid4(), owner_guild_id=1, currency_name='bench', currency_unit='b')
+    app = Application(application_id=uuid4(), application_name='bench', owner_id=1, economy=economy)
+    keys = [APIKey(application=app, issuer_id=1, type=KeyType.GRANT, enabled=True) for _ in range(NUM_KEYS)]
+    api.backend.session.add_all(keys)
+    api.backend.session.commit()
+    tokens = [api.generate_key(key.key_id) for key in keys]
+
+    for name, size in (("no token cache", 0), ("verified token cache", 4096)):
+        api.backend.token_cache = TokenCache(size)
+        elapsed = asyncio.run(run(tokens))
+        print(f"{name:<22} {NUM_REQUESTS / elapsed:10.0f} req/s  {api.backend.token_cache.stats()}")
+
+
+if __name__ == '__main__':
+    main()
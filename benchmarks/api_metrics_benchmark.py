@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Fires authenticated requests at the api in process, alternating between the middleware stack with and without the
+instrument middleware and its query counting, then times the instrumentation on its own to report the overhead the metrics add.
+
+Usage: api_metrics_benchmark.py [number_of_requests] [rounds]
+"""
+import asyncio
+import statistics
+import sys
+import time
+import timeit
+from os import path
+from uuid import uuid4
+
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), 'src'))
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient, make_mocked_request
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from sqlalchemy import event, select
+
+import api
+from backend import Backend, APIKey, Application, Economy, KeyType, logger
+
+NUM_REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+CONCURRENCY = 16
+
+logger.setLevel(100)
+
+
+def setup_keys():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    api.private_key = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                                serialization.NoEncryption())
+    api.trusted_public_keys['TB.pub'] = private_key.public_key().public_bytes(serialization.Encoding.PEM,
+                                                                              serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+async def economy(request, key=None):
+    economy = api.backend.get_economy_by_id(key.economy_id)
+    return web.json_response({"currency": economy.currency_name})
+
+
+async def run(tokens: list[str], instrumented: bool) -> float:
+    middlewares = [api.unit_of_work, api.authenticate]
+    if instrumented:
+        middlewares.insert(0, api.instrument)
+    app = web.Application(middlewares=middlewares)
+    app.router.add_get('/bench', economy)
+    raw_backend = api.backend
+    if instrumented:
+        await api.instrument_backend(app)
+    async with TestClient(TestServer(app)) as client:
+        async def worker(offset):
+            for i in range(offset, NUM_REQUESTS, CONCURRENCY):
+                async with client.get('/bench', headers={"authorization": tokens[i % len(tokens)]}) as resp:
+                    assert resp.status == 200, resp.status
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(i) for i in range(CONCURRENCY)])
+        elapsed = time.perf_counter() - start
+    if instrumented:
+        for name in api.QUERY_EVENTS:
+            event.remove(raw_backend.engine, name, api.count_query)
+        api.backend = raw_backend
+    return elapsed
+
+
+def per_call(fn, number: int = 20000) -> float:
+    """The best of a few runs of fn in microseconds per call"""
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def instrumentation_cost(economy_id) -> float:
+    """What the metrics add to a request like the benchmark's in microseconds, timed directly as it is far below the run to run noise"""
+    request = make_mocked_request('GET', '/bench', app=web.Application())
+
+    async def handler(request):
+        return web.Response()
+
+    def loop_cost(middleware: bool):
+        loop = asyncio.new_event_loop()
+        coro = (lambda: api.instrument(request, handler)) if middleware else (lambda: handler(request))
+        cost = per_call(lambda: loop.run_until_complete(coro()), 2000)
+        loop.close()
+        return cost
+
+    raw_backend = api.backend
+    proxy = api.InstrumentedBackend(raw_backend)
+    stats = api.RequestStats()
+    api.current_request.set(stats)
+    middleware = loop_cost(True) - loop_cost(False)
+    backend_call = per_call(lambda: proxy.get_key_context(1)) - per_call(lambda: raw_backend.get_key_context(1))
+    query = lambda: raw_backend.session.execute(select(Economy.currency_name).where(Economy.economy_id == economy_id)).all()
+    without_listener = per_call(query, 2000)
+    for name in api.QUERY_EVENTS:
+        event.listen(raw_backend.engine, name, api.count_query)
+    with_listener = per_call(query, 2000)
+    for name in api.QUERY_EVENTS:
+        event.remove(raw_backend.engine, name, api.count_query)
+    api.current_request.set(None)
+
+    route = api.metrics.routes[('/bench', 'GET')]
+    calls_per_request = route.backend_calls.sum / route.backend_calls.count
+    queries_per_request = route.queries.sum / route.queries.count
+    return max(middleware, 0) + max(backend_call, 0) * calls_per_request + max(with_listener - without_listener, 0) * queries_per_request
+
+
+def main():
+    setup_keys()
+    api.backend = Backend('sqlite:///:memory:')
+    economy = Economy(economy_id=uuid4(), owner_guild_id=1, currency_name='bench', currency_unit='b')
+    app = Application(application_id=uuid4(), application_name='bench', owner_id=1, economy=economy)
+    keys = [APIKey(application=app, issuer_id=1, type=KeyType.GRANT, enabled=True) for _ in range(50)]
+    api.backend.session.add_all(keys)
+    api.backend.session.commit()
+    tokens = [api.generate_key(key.key_id) for key in keys]
+    economy_id = economy.economy_id
+
+    asyncio.run(run(tokens, False))  # warm up
+    # which one goes first alternates as whichever does tends to come out faster
+    timings = {False: [], True: []}
+    for i in range(ROUNDS):
+        for instrumented in ((False, True) if i % 2 == 0 else (True, False)):
+            timings[instrumented].append(asyncio.run(run(tokens, instrumented)))
+
+    for instrumented, name in ((False, "without metrics"), (True, "with metrics")):
+        print(f"{name:<16} {NUM_REQUESTS / statistics.median(timings[instrumented]):10.0f} req/s (median of {ROUNDS} runs)")
+    # the end to end numbers above are too noisy to resolve a couple of percent, so the overhead is worked out from timing
+    # the instrumentation on its own against how long a request takes
+    request_time = statistics.median(timings[False]) / NUM_REQUESTS * 1e6
+    cost = instrumentation_cost(economy_id)
+    print(f"request          {request_time:10.1f} us")
+    print(f"instrumentation  {cost:10.1f} us")
+    print(f"overhead         {cost / request_time * 100:10.2f} %")
+    print()
+    print(api.metrics.render())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Seeds a sqlite database with a large transaction history and compares the query plans and latencies
+of the hot backend queries with and without the secondary indexes declared on the models.
+
+Usage: index_benchmark.py [number_of_transactions] [database_path]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from os import path
+from uuid import uuid4
+
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), 'src'))
+
+from sqlalchemy import event, insert
+
+from backend import Backend, Base, Account, Transaction, Permission, Economy, StubUser
+from backend import AccountType, Actions, CUD, Permissions
+
+NUM_TRANSACTIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+DB_PATH = sys.argv[2] if len(sys.argv) > 2 else path.join(tempfile.gettempdir(), 'index_benchmark.db')  # kept out of the working tree
+NUM_ACCOUNTS = 10_000
+NUM_PERMISSIONS = 50_000
+BATCH_SIZE = 50_000
+REPEATS = 50
+
+
+def seed(backend: Backend):
+    economy = Economy(economy_id=uuid4(), owner_guild_id=1, currency_name='bench', currency_unit='b')
+    backend.session.add(economy)
+    backend.session.commit()
+
+    accounts = [{
+        "account_id": uuid4(),
+        "account_name": f"account-{i}",
+        "owner_id": 10_000 + i,
+        "account_type": AccountType.USER if i % 10 else AccountType.CORPORATION,
+        "balance": 0,
+        "income_to_date": 0,
+        "economy_id": economy.economy_id,
+        "deleted": False
+    } for i in range(NUM_ACCOUNTS)]
+    ids = [a["account_id"] for a in accounts]
+    hot = ids[:10]  # a handful of treasury style accounts that show up in most transactions
+
+    with backend.engine.begin() as conn:
+        conn.execute(insert(Account), accounts)
+        conn.execute(insert(Permission), [{
+            "entry_id": uuid4(),
+            "user_id": 10_000 + random.randrange(NUM_ACCOUNTS),
+            "permission": random.choice(list(Permissions)),
+            "account_id": random.choice(ids),
+            "economy_id": economy.economy_id,
+            "allowed": True
+        } for _ in range(NUM_PERMISSIONS)])
+
+        start = datetime.now() - timedelta(days=365)
+        for offset in range(0, NUM_TRANSACTIONS, BATCH_SIZE):
+            conn.execute(insert(Transaction), [{
+                "actor_id": 1,
+                "timestamp": start + timedelta(seconds=offset + i),
+                "action": Actions.TRANSFER,
+                "cud": CUD.UPDATE,
+                "economy_id": economy.economy_id,
+                "target_account_id": random.choice(hot) if i % 2 else random.choice(ids),
+                "destination_account_id": random.choice(ids),
+                "amount": random.randrange(1, 10_000),
+                "meta": {}
+            } for i in range(min(BATCH_SIZE, NUM_TRANSACTIONS - offset))])
+    return economy, accounts
+
+
+def run_queries(backend: Backend, economy, account):
+    user = StubUser(account.owner_id)
+    queries = {
+        "has_permission": lambda: backend.has_permission(user, Permissions.TRANSFER_FUNDS, account=account),
+        "get_user_account": lambda: backend.get_user_account(account.owner_id, economy),
+        "get_account_by_name": lambda: backend.get_account_by_name(account.account_name, economy),
+        "get_transaction_log": lambda: backend.get_transaction_log(user, account, limit=50),
+    }
+
+    statements = []
+
+    @event.listens_for(backend.engine, "before_cursor_execute")
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    results = {}
+    for name, query in queries.items():
+        backend.permission_cache.clear()
+        statements.clear()
+        query()
+        plan = []
+        if statements:
+            statement, parameters = statements[-1]
+            with backend.engine.connect() as conn:
+                plan = [row[-1] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)]
+
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            backend.permission_cache.clear()
+            query()
+        results[name] = ((time.perf_counter() - start) / REPEATS * 1000, plan)
+
+    event.remove(backend.engine, "before_cursor_execute", capture)
+    return results
+
+
+def report(title, results):
+    print(f"\n== {title} ==")
+    for name, (latency, plan) in results.items():
+        print(f"{name:<22} {latency:8.3f} ms")
+        for step in plan:
+            print(f"{'':<24}{step}")
+
+
+def main():
+    if os.path.exists(DB_PATH):
+        os.remove(DB_PATH)
+    backend = Backend(f"sqlite:///{DB_PATH}")
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(backend.engine)
+
+    print(f"seeding {NUM_TRANSACTIONS} transactions...")
+    economy, accounts = seed(backend)
+    economy = backend.get_economy_by_id(economy.economy_id)
+    hot_account = backend.get_account_by_id(accounts[0]["account_id"])
+
+    report("without indexes", run_queries(backend, economy, hot_account))
+    backend.create_indexes()
+    with backend.engine.connect() as conn:
+        conn.exec_driver_sql("ANALYZE")
+    report("with indexes", run_queries(backend, economy, hot_account))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Runs a mix of backend operations against a sqlite database and samples the process's resident set size,
+once using the shared session and once with a unit of work per operation, to show whether memory reaches a steady state.
+
+Usage: session_memory_benchmark.py [number_of_operations]
+"""
+import gc
+import os
+import resource
+import sys
+import tempfile
+import time
+from os import path
+
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), 'src'))
+
+from backend import Backend, StubUser, AccountType, Permissions, logger
+
+NUM_OPERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+SAMPLES = 10
+NUM_ACCOUNTS = 100
+
+logger.setLevel(100)  # every transfer tries to notify someone
+
+
+class BenchGuild:
+    id = 1
+
+
+class BenchAdmin(StubUser):
+    guild = BenchGuild()
+
+
+def rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # peak rather than current outside of linux
+
+
+def run(use_units: bool):
+    with tempfile.TemporaryDirectory() as directory:
+        backend = Backend(f"sqlite:///{path.join(directory, 'bench.db')}")
+        admin = BenchAdmin(0)
+        economy = backend.create_economy(admin, 'bench', 'b')
+        account_ids = []
+        for i in range(NUM_ACCOUNTS):
+            account = backend.create_account(admin, 1000 + i, economy, f'account {i}', AccountType.CORPORATION)
+            backend.print_money(admin, account, 10**12)
+            account_ids.append(account.account_id)
+        economy_id = economy.economy_id
+
+        def operation(i):
+            account = backend.get_account_by_id(account_ids[i % NUM_ACCOUNTS])
+            backend.has_permission(StubUser(1000 + i % NUM_ACCOUNTS), Permissions.VIEW_BALANCE, account=account)
+            if i % 10 == 0:
+                to_account = backend.get_account_by_id(account_ids[(i + 1) % NUM_ACCOUNTS])
+                backend.perform_transaction(admin, account, to_account, 1)
+            elif i % 10 == 1:
+                backend.get_user_account(1000 + i % NUM_ACCOUNTS, backend.get_economy_by_id(economy_id))
+
+        samples = []
+        start = time.perf_counter()
+        for i in range(NUM_OPERATIONS):
+            if use_units:
+                with backend.unit_of_work():
+                    operation(i)
+            else:
+                operation(i)
+            if (i + 1) % (NUM_OPERATIONS // SAMPLES) == 0:
+                gc.collect()
+                samples.append((i + 1, rss_mb()))
+        elapsed = time.perf_counter() - start
+        backend.close()
+    return samples, elapsed
+
+
+def main():
+    for title, use_units in (("shared session", False), ("unit of work per operation", True)):
+        samples, elapsed = run(use_units)
+        print(f"\n== {title} ({NUM_OPERATIONS / elapsed:.0f} ops/s) ==")
+        for operations, rss in samples:
+            print(f"{operations:>10} ops  {rss:8.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
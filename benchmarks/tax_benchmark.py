@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Seeds a sqlite database with an economy of many accounts and a set of wealth and income brackets, then times a tax cycle
+run by the compiled tax engine against the old approach of a handful of statements per bracket.
+
+Usage: tax_benchmark.py [number_of_accounts] [number_of_brackets] [database_path]
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from os import path
+from uuid import uuid4
+
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), 'src'))
+
+from sqlalchemy import event, insert, select, update, func
+
+from backend import Backend, Account, Tax, Economy, StubUser, AccountType, TaxType, logger
+
+NUM_ACCOUNTS = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+NUM_BRACKETS = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+DB_PATH = sys.argv[3] if len(sys.argv) > 3 else path.join(tempfile.gettempdir(), 'tax_benchmark.db')  # kept out of the working tree
+BRACKET_WIDTH = 10_000
+
+logger.setLevel(100)  # no one wants 10k debtor notices
+
+
+def seed(backend: Backend):
+    economy = Economy(economy_id=uuid4(), owner_guild_id=1, currency_name='bench', currency_unit='b')
+    gov_id = uuid4()
+    with backend.engine.begin() as conn:
+        conn.execute(insert(Economy), [{"economy_id": economy.economy_id, "owner_guild_id": 1, "currency_name": 'bench', "currency_unit": 'b'}])
+        conn.execute(insert(Account), [{
+            "account_id": gov_id if i == 0 else uuid4(),
+            "account_name": f"account-{i}",
+            "owner_id": 10_000 + i,
+            "account_type": AccountType.GOVERNMENT if i == 0 else random.choice([AccountType.USER, AccountType.CORPORATION]),
+            "balance": random.randrange(0, NUM_BRACKETS*BRACKET_WIDTH*2),
+            "income_to_date": random.randrange(0, NUM_BRACKETS*BRACKET_WIDTH*2),
+            "economy_id": economy.economy_id,
+            "deleted": False
+        } for i in range(NUM_ACCOUNTS)])
+        conn.execute(insert(Tax), [{
+            "entry_id": uuid4(),
+            "tax_name": f"{tax_type.name}-{account_type.name}-{i}",
+            "affected_type": account_type,
+            "tax_type": tax_type,
+            "bracket_start": i*BRACKET_WIDTH,
+            "bracket_end": (i + 1)*BRACKET_WIDTH,
+            "rate": 5 + 3*i,
+            "to_account_id": gov_id,
+            "economy_id": economy.economy_id
+        } for tax_type in (TaxType.WEALTH, TaxType.INCOME)
+          for account_type in (AccountType.USER, AccountType.CORPORATION)
+          for i in range(NUM_BRACKETS)])
+    return economy.economy_id
+
+
+def per_bracket_tax(backend: Backend, economy: Economy):
+    """The statements the old perform_tax issued for every bracket, scoped to the economy, kept as a baseline"""
+    session = backend.session
+    scope = Account.economy_id == economy.economy_id
+    for tax_type, base in ((TaxType.WEALTH, Account.balance), (TaxType.INCOME, Account.income_to_date)):
+        brackets = session.execute(select(Tax).where(Tax.tax_type == tax_type).where(Tax.economy_id == economy.economy_id)
+                                   .order_by(Tax.bracket_start.desc())).scalars().all()
+        for bracket in brackets:
+            full_tax = ((bracket.bracket_end - bracket.bracket_start)*bracket.rate)//100
+            partial = scope & (Account.account_type == bracket.affected_type) & (base >= bracket.bracket_start) & (base < bracket.bracket_end)
+            full = scope & (Account.account_type == bracket.affected_type) & (base >= bracket.bracket_end)
+            raised = session.execute(select(func.sum(((base - bracket.bracket_start)*bracket.rate)//100)).where(partial)).scalar() or 0
+            session.execute(update(Account).where(partial).values(balance=Account.balance - ((base - bracket.bracket_start)*bracket.rate)//100))
+            raised += (session.execute(select(func.count()).select_from(Account).where(full)).scalar() or 0)*full_tax
+            session.execute(update(Account).where(full).values(balance=Account.balance - full_tax))
+            if tax_type == TaxType.INCOME:
+                for debtor in session.execute(select(Account).where(scope).where(Account.balance < 0)).scalars():
+                    raised += debtor.balance
+                    debtor.balance = 0
+    session.execute(update(Account).where(scope).values(income_to_date=0))
+    session.commit()
+
+
+def run(db_path, name, fn):
+    backend = Backend(f"sqlite:///{db_path}")
+    economy = backend.session.execute(select(Economy)).scalar_one()
+    statements = []
+    event.listen(backend.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    start = time.perf_counter()
+    fn(backend, economy)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<24} {elapsed*1000:10.1f} ms {len(statements):6} statements")
+    backend.close()
+
+
+def main():
+    if os.path.exists(DB_PATH):
+        os.remove(DB_PATH)
+    backend = Backend(f"sqlite:///{DB_PATH}")
+    print(f"seeding {NUM_ACCOUNTS} accounts with {NUM_BRACKETS} brackets per tax and account type...")
+    seed(backend)
+    backend.close()
+
+    for name, fn in (("per bracket statements", per_bracket_tax),
+                     ("compiled tax engine", lambda b, e: b.perform_tax(StubUser(0), e))):
+        copy = DB_PATH + '.run'
+        shutil.copy(DB_PATH, copy)
+        run(copy, name, fn)
+        os.remove(copy)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,32 @@
 from enum import Enum
+from datetime import datetime
 
 import aiohttp, asyncio
+import base64
+import bisect
+import hashlib
+import hmac
+import inspect
+import json
 import discord.errors
 from aiohttp import web
 import jwt
 import os
 import time
 import re
-from uuid import UUID
+from contextvars import ContextVar
+from uuid import UUID, uuid4
 
 from aiohttp.web_request import Request
 from aiohttp.web_urldispatcher import SystemRoute
-
-from backend import StubUser, Permissions, Account, BackendError
-from backend import Backend, Transaction, Application, KeyType, APIKey
-from backend import CONSOLE_USER_ID
-from utils import load_config
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from backend import StubUser, Permissions, Account, BackendError, SpendingLimitError, IdempotencyError
+from backend import Backend, Transaction, Application, KeyType, KeyContext, IdempotencyClaim
+from backend import GrantStore, MemoryGrantStore, SQLGrantStore
+from backend import CONSOLE_USER_ID, LRUCache
+from utils import load_config, TransactionCSVEncoder
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 
 env = Environment(
@@ -23,7 +34,13 @@ env = Environment(
     autoescape= select_autoescape()
 )
 
-auth_cache = {}
+grant_store: GrantStore = None
+http: aiohttp.ClientSession = None # shared by every call out to discord so connections get reused
+runner: web.AppRunner = None
+MAX_GRANT_WAIT = 60
+GRANT_POLL_INTERVAL = 5 # how often a waiting retrieve-key rechecks the store, in case the grant was issued by another api worker
+MAX_BATCH_TRANSFERS = 100
+MAX_LOOKUP_ACCOUNTS = 100
 
 config = {}
 API_URL = "https://discord.com/api/v10"
@@ -35,6 +52,7 @@ private_key = None
 routes = web.RouteTableDef()
 INSECURE = (
     re.compile('^/api/oauth/'),
+    re.compile('^/metrics$'), # checks its own token, see get_metrics
 )
 backend: Backend = None
 
@@ -43,7 +61,7 @@ backend: Backend = None
 
 class APIStubUser(StubUser):
     @classmethod
-    def from_key(cls, key : APIKey):
+    def from_key(cls, key: KeyContext):
         self = cls(key.key_id)
         self.mention = f"<@{key.issuer_id}>"
         return self
@@ -51,6 +69,214 @@ class APIStubUser(StubUser):
 
 
 
+class GrantWaiters:
+    """Lets retrieve-key requests park until issue_token is called for their reference rather than polling for it"""
+
+    def __init__(self):
+        self._events: dict[tuple[UUID, UUID], asyncio.Event] = {}
+        self._waiting: dict[tuple[UUID, UUID], int] = {}
+
+    async def wait(self, application_id: UUID, ref_id: UUID, timeout: float) -> bool:
+        ref = (application_id, ref_id)
+        event = self._events.setdefault(ref, asyncio.Event())
+        self._waiting[ref] = self._waiting.get(ref, 0) + 1
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiting[ref] -= 1
+            if not self._waiting[ref]:
+                del self._waiting[ref]
+                self._events.pop(ref, None)
+
+    def notify(self, application_id: UUID, ref_id: UUID):
+        event = self._events.get((application_id, ref_id))
+        if event is not None:
+            event.set()
+
+
+grant_waiters = GrantWaiters()
+
+
+async def wait_for_grant(application_id: UUID, ref_id: UUID, timeout: float) -> dict | None:
+    """Waits up to timeout seconds for a registered reference to be granted, returning its state once it has been"""
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        backend.session.rollback() # don't sit on a database connection while parked
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            return grant_store.get(application_id, ref_id)
+        await grant_waiters.wait(application_id, ref_id, min(remaining, GRANT_POLL_INTERVAL))
+        key_meta = grant_store.get(application_id, ref_id)
+        if key_meta is None or key_meta.get('request_data') is not None:
+            return key_meta
+
+
+class DiscordIdCache(LRUCache):
+    """A size bounded LRU remembering which discord user a bearer token belongs to for ttl seconds"""
+
+    def __init__(self, ttl: float = 300, max_size: int = 4096):
+        super().__init__(max_size, ttl)
+
+    @staticmethod
+    def _digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> int | None:
+        return super().get(self._digest(token))
+
+    def put(self, token: str, user_id: int):
+        super().put(self._digest(token), user_id)
+
+
+discord_ids = DiscordIdCache()
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0.0, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestStats:
+    """What a single request has done so far, the current one is found through current_request"""
+    __slots__ = ("backend_calls", "queries")
+
+    def __init__(self):
+        self.backend_calls = 0
+        self.queries = 0
+
+
+current_request: ContextVar[RequestStats | None] = ContextVar("api_current_request", default=None)
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.backend_calls = Histogram(COUNT_BUCKETS)
+        self.queries = Histogram(COUNT_BUCKETS)
+        self.responses: dict[int, int] = {}
+        self.in_flight = 0
+
+    def observe(self, status: int, elapsed: float, stats: RequestStats):
+        self.latency.observe(elapsed)
+        self.backend_calls.observe(stats.backend_calls)
+        self.queries.observe(stats.queries)
+        self.responses[status] = self.responses.get(status, 0) + 1
+
+
+class APIMetrics:
+    """Per route request metrics, rendered in the OpenMetrics text format for /metrics"""
+
+    def __init__(self):
+        self.routes: dict[tuple[str, str], RouteMetrics] = {}
+
+    def route(self, route: str, method: str) -> RouteMetrics:
+        route_metrics = self.routes.get((route, method))
+        if route_metrics is None:
+            route_metrics = self.routes[(route, method)] = RouteMetrics()
+        return route_metrics
+
+    @staticmethod
+    def _labels(route: str, method: str, **extra) -> str:
+        def escape(value) -> str:
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        labels = {"route": route, "method": method, **extra}
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+    def _histogram(self, lines: list[str], name: str, unit: str | None, description: str, attribute: str):
+        lines.append(f"# TYPE {name} histogram")
+        if unit is not None:
+            lines.append(f"# UNIT {name} {unit}")
+        lines.append(f"# HELP {name} {description}")
+        for (route, method), route_metrics in self.routes.items():
+            histogram = getattr(route_metrics, attribute)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(route, method, le=bound)} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(route, method)} {histogram.sum}")
+            lines.append(f"{name}_count{self._labels(route, method)} {histogram.count}")
+
+    def render(self) -> str:
+        lines = []
+        self._histogram(lines, "taubot_api_request_duration_seconds", "seconds", "How long requests took to serve", "latency")
+        self._histogram(lines, "taubot_api_request_backend_calls", None, "Backend calls made per request", "backend_calls")
+        self._histogram(lines, "taubot_api_request_queries", None, "SQL statements executed per request", "queries")
+        lines.append("# TYPE taubot_api_responses counter")
+        lines.append("# HELP taubot_api_responses Responses sent by status code")
+        for (route, method), route_metrics in self.routes.items():
+            for status, count in route_metrics.responses.items():
+                lines.append(f"taubot_api_responses_total{self._labels(route, method, status=status)} {count}")
+        lines.append("# TYPE taubot_api_requests_in_flight gauge")
+        lines.append("# HELP taubot_api_requests_in_flight Requests currently being served")
+        for (route, method), route_metrics in self.routes.items():
+            lines.append(f"taubot_api_requests_in_flight{self._labels(route, method)} {route_metrics.in_flight}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+metrics = APIMetrics()
+
+
+class InstrumentedBackend:
+    """Wraps the backend so the calls made while serving a request get counted, see instrument"""
+
+    def __init__(self, wrapped: Backend):
+        object.__setattr__(self, "_wrapped", wrapped)
+
+    @property
+    def session(self) -> Session:
+        return self._wrapped.session
+
+    def __getattr__(self, name):
+        attr = getattr(self._wrapped, name)
+        if not inspect.ismethod(attr):
+            return attr
+        if inspect.iscoroutinefunction(attr):
+            async def counted(*args, **kwargs):
+                stats = current_request.get()
+                if stats is not None:
+                    stats.backend_calls += 1
+                return await attr(*args, **kwargs)
+        else:
+            def counted(*args, **kwargs):
+                stats = current_request.get()
+                if stats is not None:
+                    stats.backend_calls += 1
+                return attr(*args, **kwargs)
+        object.__setattr__(self, name, counted) # later lookups find it without coming back through here
+        return counted
+
+    def __setattr__(self, name, value):
+        setattr(self._wrapped, name, value)
+
+
+def count_query(*args):
+    stats = current_request.get()
+    if stats is not None:
+        stats.queries += 1
+    # returning None leaves the dialect to execute the statement as normal
+
+
+# dialect events rather than before_cursor_execute, engine events make every connection join their listeners which costs
+# more than everything else the metrics do put together
+QUERY_EVENTS = ("do_execute", "do_executemany", "do_execute_no_params")
+
+
 def generate_key(key_id):
     if key_id == CONSOLE_USER_ID:
         raise web.HTTPUnauthorized(reason="Almost had me there") # purely for the sake of my sanity making it impossible to accidentally issue a god key
@@ -78,7 +304,7 @@ def needs_discord(coro):
 
 def needs(*types: KeyType):
     def decorator(coro):
-        async def result(request: Request, key: APIKey= None, **kwargs):
+        async def result(request: Request, key: KeyContext= None, **kwargs):
             if key.type not in types:
                 raise web.HTTPUnauthorized()
             return await coro(request, key=key, **kwargs)
@@ -87,17 +313,40 @@ def needs(*types: KeyType):
 
 
 @web.middleware
-async def authenticate(request, handler):
-    rel_url = request.rel_url
-    print(rel_url)
-    if [regex.match(str(rel_url)) for regex in INSECURE] != [None] * len(INSECURE):
+async def instrument(request, handler):
+    resource = request.match_info.route.resource
+    route_metrics = metrics.route(resource.canonical if resource is not None else "unmatched", request.method)
+    stats = RequestStats()
+    token = current_request.set(stats)
+    route_metrics.in_flight += 1
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        route_metrics.in_flight -= 1
+        route_metrics.observe(status, time.perf_counter() - start, stats)
+        current_request.reset(token)
+
+
+@web.middleware
+async def unit_of_work(request, handler):
+    with backend.unit_of_work():
         return await handler(request)
+
+
+def verify_token(token: str) -> int:
+    """Checks the token was signed by a trusted issuer and returns the id of the key it was issued for"""
     try:
-        token = request.headers["authorization"]
-    except KeyError:
+        claims = jwt.decode(token, options={"verify_signature": False})
+        public_key = trusted_public_keys[claims['iss'] + '.pub']
+    except (jwt.InvalidTokenError, KeyError, TypeError):
         raise web.HTTPUnauthorized()
-    claims = jwt.decode(token, options={"verify_signature": False})
-    public_key = trusted_public_keys[claims['iss'] + '.pub']
     options = {
         "require": ["kid", "iss"]
     }
@@ -107,12 +356,37 @@ async def authenticate(request, handler):
         raise web.HTTPUnauthorized()
 
     try:
-        key_id = int(claims["kid"])
+        return int(claims["kid"])
     except (ValueError, TypeError):
         raise web.HTTPUnauthorized()
 
-    key = backend.get_key_by_id(key_id)
-    if key is None or not key.enabled:
+
+@web.middleware
+async def authenticate(request, handler):
+    rel_url = request.rel_url
+    if [regex.match(str(rel_url)) for regex in INSECURE] != [None] * len(INSECURE):
+        return await handler(request)
+    try:
+        token = request.headers["authorization"]
+    except KeyError:
+        raise web.HTTPUnauthorized()
+
+    digest = backend.token_cache.digest(token)
+    verified = backend.token_cache.get(digest)
+    if verified is None:
+        key_id = verify_token(token)
+    else:
+        key_id, enabled = verified
+        if not enabled:
+            raise web.HTTPUnauthorized()
+
+    key = backend.get_key_context(key_id)
+    if key is None:
+        backend.token_cache.invalidate_key(key_id)
+        raise web.HTTPUnauthorized()
+    if verified is None:
+        backend.token_cache.put(digest, key_id, key.enabled)
+    if not key.enabled:
         raise web.HTTPUnauthorized()
     try:
         return await handler(request, key=key)
@@ -122,9 +396,7 @@ async def authenticate(request, handler):
 
 @routes.post('/api/oauth-references')
 @needs(KeyType.MASTER)
-async def create_reference(request: Request, key: APIKey):
-    if not auth_cache.get(key.application_id):
-        auth_cache[key.application_id] = {}
+async def create_reference(request: Request, key: KeyContext):
     # TODO: minimum required perms
     data = await request.json()
     if not set(data.keys()).issubset({'ref_id'}):
@@ -133,46 +405,32 @@ async def create_reference(request: Request, key: APIKey):
         ref_id = UUID(data['ref_id'])
     except:
         raise web.HTTPBadRequest()
-    auth_cache[key.application_id][ref_id] = {}
+    grant_store.put(key.application_id, ref_id, {})
+    backend.session.commit()
     return web.HTTPCreated()
 
 
 @routes.get('/api/retrieve-key/{ref_id}')
 @needs(KeyType.MASTER)
-async def retrieve_key(request, key: APIKey=None):
-    app = key.application
+async def retrieve_key(request, key: KeyContext=None):
+    app = backend.get_application(key.application_id)
     try:
         ref_id = UUID(request.match_info["ref_id"])
+        wait = float(request.query.get('wait', 0))
     except (TypeError, ValueError):
         raise web.HTTPBadRequest()
+    if not 0 <= wait <= MAX_GRANT_WAIT:
+        raise web.HTTPBadRequest()
 
-    to_be_issued = auth_cache.get(app.application_id)
-    existing_key = backend.get_key(app, ref_id)
-    if to_be_issued is None:
-        to_be_issued = {}
-
-
-    key_meta = to_be_issued.get(ref_id)
-    if key_meta is None and existing_key is not None:
-        key = existing_key
-    else:
-        if key_meta is None:
-            raise web.HTTPNotFound()
-        data = key_meta.get('request_data')
-        key = APIKey(application=app, internal_app_id=ref_id, issuer_id=key_meta.get('issuer_id'), spending_limit=data.get('spending_limit'))
-        backend.session.add(key)
-        perms = data['permissions']
-        key.activate()
-        for acc in perms.keys():
-            acc = backend.get_account_by_id(UUID(acc))
-            backend.change_many_permissions(
-                StubUser(CONSOLE_USER_ID),
-                key.key_id,
-                *[Permissions[p] for p in perms[str(acc.account_id)]],
-                account=acc
-            )
-        auth_cache[app.application_id].pop(ref_id)
-
+    key_meta = grant_store.get(app.application_id, ref_id)
+    if wait and key_meta is not None and key_meta.get('request_data') is None:
+        key_meta = await wait_for_grant(key.application_id, ref_id, wait)
+    new_key = None
+    if key_meta is not None and key_meta.get('request_data') is not None:
+        new_key = backend.issue_granted_key(grant_store, app, ref_id)
+    key = new_key if new_key is not None else backend.get_key(app, ref_id) # another worker may have just claimed the grant
+    if key is None:
+        raise web.HTTPNotFound()
 
     res = {
         "key": generate_key(key.key_id)
@@ -221,21 +479,23 @@ async def get_access_token(code: str) -> str:
         'Content-Type': 'application/x-www-form-urlencoded'
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(CALLBACK_URL, data=data, auth=auth, headers=headers) as resp:
-            if resp.status != 200:
-                raise web.HTTPBadRequest()
-            data = await resp.json()
+    async with http.post(CALLBACK_URL, data=data, auth=auth, headers=headers) as resp:
+        if resp.status != 200:
+            raise web.HTTPBadRequest()
+        data = await resp.json()
     
     return data.get('access_token')
 
 
 async def get_user_id(token: str) -> int:
-    async with aiohttp.ClientSession() as session:
-        async with session.get(API_URL + '/users/@me', headers={'Authorization': 'Bearer ' + token}) as resp:
-            if resp.status != 200:
-                raise web.HTTPBadRequest()
-            user_id = int((await resp.json()).get('id'))
+    user_id = discord_ids.get(token)
+    if user_id is not None:
+        return user_id
+    async with http.get(API_URL + '/users/@me', headers={'Authorization': 'Bearer ' + token}) as resp:
+        if resp.status != 200:
+            raise web.HTTPBadRequest()
+        user_id = int((await resp.json()).get('id'))
+    discord_ids.put(token, user_id)
     return user_id
 
 
@@ -265,10 +525,7 @@ async def issue_token(request, discord_id=None):
     if app is None:
         raise web.HTTPBadRequest()
 
-    if not auth_cache.get(aid):
-        raise web.HTTPUnauthorized()
-
-    meta = auth_cache[aid].get(ref_code)
+    meta = grant_store.get(aid, ref_code)
     if meta is None:
         raise web.HTTPForbidden(reason="Ref Code has not been registered")
 
@@ -300,18 +557,20 @@ async def issue_token(request, discord_id=None):
         except (ValueError, TypeError):
             raise web.HTTPBadRequest()
 
-        account = backend.get_account_by_id(account_id)
+        account = await backend.get_account_by_id_async(account_id)
         if account is None:
             raise web.HTTPBadRequest()
 
         for perm in perms:
-            if not backend.has_permission(granter, Permissions[perm], account=account):
+            if not await backend.has_permission_async(granter, Permissions[perm], account=account):
                 raise web.HTTPUnauthorized()
 
-    auth_cache[aid][ref_code] = {
+    grant_store.put(aid, ref_code, {
         "issuer_id": granter.id,
         "request_data": data
-    }
+    })
+    backend.session.commit()
+    grant_waiters.notify(aid, ref_code)
     return web.HTTPCreated()
 
 
@@ -336,10 +595,11 @@ async def grant_page(request, discord_id=None):
     if auth_granter is None:
         auth_granter = StubUser(discord_id)
 
-    def has_perm(pid, account):
-        return backend.has_permission(auth_granter, list(Permissions)[pid], account=account)
-
     accs = backend.get_authable_accounts(auth_granter, app.economy)
+    perms = backend.evaluate_permissions(auth_granter, [Permissions.VIEW_BALANCE, Permissions.TRANSFER_FUNDS], accs)
+
+    def has_perm(pid, account):
+        return perms[(list(Permissions)[pid], account.account_id)]
     
     result = env.get_template('grant_page.html').render(issuer=auth_granter, app=app, accounts=accs, has_perm=has_perm)
     return web.Response(text=result, content_type='text/html')
@@ -348,51 +608,102 @@ async def grant_page(request, discord_id=None):
 
 @routes.get('/api/users/{user_id}')
 @needs(KeyType.GRANT, KeyType.MASTER)
-async def get_account_id(request, key: APIKey=None):
+async def get_account_id(request, key: KeyContext=None):
     try:
         user_id = request.match_info["user_id"]
         user_id = key.issuer_id if user_id == "me" else int(user_id)
     except ValueError:
         raise web.HTTPNotFound()
 
-    economy = key.application.economy
-    account = backend.get_user_account(user_id, economy)
+    economy = backend.get_economy_by_id(key.economy_id)
+    account = await backend.get_user_account_async(user_id, economy)
     if account is None:
         raise web.HTTPNotFound()
     return web.json_response(await encode_account(key, account))
 
-async def encode_account(key:APIKey, account: Account):
-    return {
-        "account_id": str(account.account_id),
-        "owner_id": str(account.owner_id),
-        "account_name": account.account_name,
-        "account_type": account.account_type.name,
-        "balance": account.balance if await backend.key_has_permission(key, Permissions.VIEW_BALANCE, account=account) else None
+async def encode_account(key: KeyContext, account: Account):
+    return (await encode_accounts(key, [account]))[0]
+
+ACCOUNT_FIELDS = ("account_id", "owner_id", "account_name", "account_type", "balance")
+
+async def encode_accounts(key: KeyContext, accounts: list[Account], fields=ACCOUNT_FIELDS):
+    # balance visibility is the only part that costs anything, so it's only worked out if it was asked for
+    perms = {}
+    if "balance" in fields:
+        perms = await backend.key_evaluate_permissions(key, [Permissions.VIEW_BALANCE], accounts)
+    encoders = {
+        "account_id": lambda account: str(account.account_id),
+        "owner_id": lambda account: str(account.owner_id),
+        "account_name": lambda account: account.account_name,
+        "account_type": lambda account: account.account_type.name,
+        "balance": lambda account: account.balance if perms[(Permissions.VIEW_BALANCE, account.account_id)] else None
     }
+    return [{field: encoders[field](account) for field in fields} for account in accounts]
 
 
 @routes.get("/api/accounts/by-name/{account_name}")
 @needs(KeyType.GRANT, KeyType.MASTER)
-async def get_account_by_name(request, key: APIKey=None):
+async def get_account_by_name(request, key: KeyContext=None):
     try:
         account_name = request.match_info["account_name"]
     except ValueError:
         raise web.HTTPNotFound()
-    economy = key.application.economy
-    account = backend.get_account_by_name(account_name, economy)
+    economy = backend.get_economy_by_id(key.economy_id)
+    account = await backend.get_account_by_name_async(account_name, economy)
     if account is None:
         raise web.HTTPNotFound()
     return web.json_response(await encode_account(key, account))
 
 
+@routes.post("/api/accounts/lookup")
+@needs(KeyType.GRANT, KeyType.MASTER)
+async def lookup_accounts(request, key: KeyContext=None):
+    lookup = await request.json()
+    if not isinstance(lookup, dict) or not set(lookup.keys()) <= {"ids", "names", "fields"}:
+        raise web.HTTPBadRequest()
+    ids, names = lookup.get("ids", []), lookup.get("names", [])
+    fields = lookup.get("fields", list(ACCOUNT_FIELDS))
+    if not all(isinstance(i, list) for i in (ids, names, fields)) or not all(isinstance(i, str) for i in names + fields):
+        raise web.HTTPBadRequest()
+    if not 0 < len(ids) + len(names) <= MAX_LOOKUP_ACCOUNTS or not fields or not set(fields) <= set(ACCOUNT_FIELDS):
+        raise web.HTTPBadRequest()
+    if ids and key.type != KeyType.GRANT:  # same as /api/accounts/{account_id}
+        raise web.HTTPUnauthorized()
+    try:
+        ids = [UUID(account_id) for account_id in ids]
+    except (ValueError, TypeError, AttributeError):
+        raise web.HTTPBadRequest()
+
+    accounts = await backend.lookup_accounts_async(ids, names, key.economy_id)
+    by_id = {account.account_id: account for account in accounts}
+    by_name = {account.account_name: account for account in accounts if account.economy_id == key.economy_id and not account.deleted}
+
+    # results come back in the order they were asked for, once each
+    found, not_found = {}, []
+    for account_id in ids:
+        if account_id in by_id:
+            found.setdefault(account_id, by_id[account_id])
+        else:
+            not_found.append(str(account_id))
+    for name in names:
+        if name in by_name:
+            found.setdefault(by_name[name].account_id, by_name[name])
+        else:
+            not_found.append(name)
+    return web.json_response({
+        "accounts": await encode_accounts(key, list(found.values()), list(dict.fromkeys(fields))),
+        "not_found": not_found
+    })
+
+
 @routes.get("/api/accounts/{account_id}")
 @needs(KeyType.GRANT)
-async def get_account(request, key: APIKey=None):
+async def get_account(request, key: KeyContext=None):
     try:
         account_id = UUID(request.match_info["account_id"])
     except ValueError:
         raise web.HTTPNotFound()
-    account = backend.get_account_by_id(account_id)
+    account = await backend.get_account_by_id_async(account_id)
     if account is None:
         raise web.HTTPNotFound()
 
@@ -413,15 +724,43 @@ def encode_transaction(t: Transaction):
             "amount": t.amount
         }
 
+def encode_cursor(t: Transaction) -> str:
+    return base64.urlsafe_b64encode(f"{t.timestamp.isoformat()},{t.transaction_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        timestamp, transaction_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(',')
+        return datetime.fromisoformat(timestamp), int(transaction_id)
+    except ValueError:
+        raise web.HTTPBadRequest(reason="Invalid cursor")
+
+
+def parse_limit(request) -> int | None:
+    """The optional limit query parameter of the transaction log routes, which has to be a positive integer"""
+    try:
+        limit = request.query.get("limit")
+        limit = int(limit) if limit is not None else None
+    except ValueError:
+        raise web.HTTPBadRequest()
+    if limit is not None and limit <= 0:
+        raise web.HTTPBadRequest()
+    return limit
+
+
 @routes.get("/api/accounts/{account_id}/transactions")
 @needs(KeyType.GRANT)
-async def get_account_transactions(request, key: APIKey = None):
+async def get_account_transactions(request, key: KeyContext = None):
     try:
         account_id = UUID(request.match_info["account_id"])
     except ValueError:
         raise web.HTTPNotFound()
 
-    account = backend.get_account_by_id(account_id)
+    limit = parse_limit(request)
+    cursor = request.query.get("cursor")
+    before = decode_cursor(cursor) if cursor is not None else None
+
+    account = await backend.get_account_by_id_async(account_id)
     if account is None:
         raise web.HTTPNotFound()
 
@@ -429,34 +768,236 @@ async def get_account_transactions(request, key: APIKey = None):
     if not await backend.key_has_permission(key, Permissions.VIEW_BALANCE, account=account):
         raise web.HTTPUnauthorized()
 
-    transactions = backend.get_transaction_log(actor, account, limit=request.query.get("limit"))
+    transactions = await backend.get_transaction_log_async(actor, account, limit=limit, before=before)
     result = [encode_transaction(t) for t in transactions]
-    return web.json_response(result)
+    headers = {}
+    if limit is not None and len(transactions) == limit:
+        headers["Next-Cursor"] = encode_cursor(transactions[-1])
+    return web.json_response(result, headers=headers)
+
+@routes.get("/api/accounts/{account_id}/transactions/export")
+@needs(KeyType.GRANT)
+async def export_account_transactions(request, key: KeyContext = None):
+    try:
+        account_id = UUID(request.match_info["account_id"])
+    except ValueError:
+        raise web.HTTPNotFound()
+
+    limit = parse_limit(request)
+
+    account = await backend.get_account_by_id_async(account_id)
+    if account is None:
+        raise web.HTTPNotFound()
+
+    actor = APIStubUser.from_key(key)
+    if not await backend.key_has_permission(key, Permissions.VIEW_BALANCE, account=account):
+        raise web.HTTPUnauthorized()
+
+    encoder = TransactionCSVEncoder(currency=account.economy.currency_unit)
+    resp = web.StreamResponse(headers={
+        "Content-Type": "text/csv",
+        "Content-Encoding": "gzip",
+        "Content-Disposition": f'attachment; filename="{account_id}.csv"'
+    })
+    await resp.prepare(request)
+    async for chunk in backend.iter_transaction_log_async(actor, account, limit=limit):
+        await resp.write(encoder.encode(chunk))
+    await resp.write(encoder.finish())
+    await resp.write_eof()
+    return resp
+
+@routes.get("/api/tax-simulation")
+@needs(KeyType.GRANT, KeyType.MASTER)
+async def get_tax_simulation(request, key: KeyContext = None):
+    economy = backend.get_economy_by_id(key.economy_id)
+    if not await backend.key_has_permission(key, Permissions.MANAGE_TAX_BRACKETS, economy=economy):
+        raise web.HTTPUnauthorized()
+    return web.json_response(backend.simulate_tax(APIStubUser.from_key(key), economy))
 
 @routes.post("/api/transactions/")
-async def create_transaction(request, key: APIKey=None):
-    transaction_data = await request.json()
+async def create_transaction(request, key: KeyContext=None):
+    return await idempotent(request, key, await request.json(), make_transaction)
+
+
+async def idempotent(request, key: KeyContext, data, make, content_type: str = 'text/plain'):
+    """
+    Makes make(key, data, claim) at most once per Idempotency-Key header, retries get the original's response replayed.
+    make has to record its outcome against the claim in the same commit as whatever it changes.
+    """
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is None:
+        return await make(key, data)
+    if not 0 < len(idempotency_key) <= 255:
+        raise web.HTTPBadRequest()
+
+    # a retry has to be for the same request, otherwise reusing the key is a mistake on the client's part
+    request_hash = hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+    claim = IdempotencyClaim(key.key_id, idempotency_key, uuid4())
+    record = backend.claim_idempotency_key(claim, request_hash)
+    if record is not None:
+        if record.request_hash != request_hash:
+            raise web.HTTPUnprocessableEntity()
+        if record.status is None:  # the original is still being made
+            raise web.HTTPConflict()
+        return web.Response(status=record.status, text=record.response, content_type=content_type,
+                            headers={"Idempotent-Replayed": "true"})
+
+    # a transfer records its outcome against the claim in the same commit, so finishing afterwards only records the outcome
+    # of requests that failed without changing anything. An unexpected error may have come before or after that commit,
+    # release_idempotency_key only gives the claim up if no outcome was recorded
+    try:
+        response = await make(key, data, claim)
+    except web.HTTPException as e:
+        response = e
+    except BaseException:
+        backend.release_idempotency_key(claim)
+        raise
+    backend.finish_idempotency_key(claim, response.status, response.text)
+    if isinstance(response, web.HTTPException):
+        raise response
+    return response
+
+
+async def make_transaction(key: KeyContext, transaction_data, claim: IdempotencyClaim = None):
     if set(transaction_data.keys()) != {"from_account", "to_account", "amount"}:
         raise web.HTTPBadRequest()
 
     actor = APIStubUser.from_key(key)
 
-    from_account = backend.get_account_by_id(UUID(transaction_data["from_account"]))
-    to_account = backend.get_account_by_id(UUID(transaction_data["to_account"]))
+    from_account = await backend.get_account_by_id_async(UUID(transaction_data["from_account"]))
+    to_account = await backend.get_account_by_id_async(UUID(transaction_data["to_account"]))
     amount = int(transaction_data["amount"])
     if from_account is None or to_account is None:
         raise web.HTTPNotFound()
+    if amount <= 0:
+        raise web.HTTPBadRequest()
+    if not await backend.key_has_permission(key, Permissions.TRANSFER_FUNDS, account=from_account):
+        return web.HTTPOk()
+    if claim is not None:
+        done = web.HTTPOk()
+        claim = claim._replace(status=done.status, response=done.text)
+    # the spending limit is checked in the same database transaction as the transfer, so concurrent requests can't overspend between them
     try:
-        if key.spent_to_date + amount > key.spending_limit:
-            raise web.HTTPUnauthorized()
-        if await backend.key_has_permission(key, Permissions.TRANSFER_FUNDS, account=from_account):
-            key.spent_to_date += amount
-            backend.perform_transaction(actor, from_account, to_account, amount)
+        await backend.perform_transaction_async(actor, from_account, to_account, amount, key=key, idempotency=claim)
+    except SpendingLimitError:
+        raise web.HTTPUnauthorized()
+    except IdempotencyError:
+        raise web.HTTPConflict()
     except BackendError:
         raise web.HTTPBadRequest()
     return web.HTTPOk()
 
 
+@routes.post("/api/transactions/batch")
+async def create_transactions(request, key: KeyContext=None):
+    return await idempotent(request, key, await request.json(), make_transactions, content_type='application/json')
+
+
+async def make_transactions(key: KeyContext, batch, claim: IdempotencyClaim = None):
+    if not isinstance(batch, dict) or not set(batch.keys()) <= {"transfers", "mode"}:
+        raise web.HTTPBadRequest()
+    mode = batch.get("mode", "atomic")
+    transfers = batch.get("transfers")
+    if mode not in ("atomic", "best_effort") or not isinstance(transfers, list) \
+            or not 0 < len(transfers) <= config.get('max_batch_transfers', MAX_BATCH_TRANSFERS):
+        raise web.HTTPBadRequest()
+
+    # everything is validated before anything is looked up so a malformed batch costs nothing
+    parsed = []
+    for transfer in transfers:
+        if not isinstance(transfer, dict) or set(transfer.keys()) != {"from_account", "to_account", "amount"}:
+            raise web.HTTPBadRequest()
+        try:
+            parsed.append((UUID(transfer["from_account"]), UUID(transfer["to_account"]), int(transfer["amount"])))
+        except (ValueError, TypeError, AttributeError):
+            raise web.HTTPBadRequest()
+        if parsed[-1][2] <= 0:
+            raise web.HTTPBadRequest()
+
+    accounts = await backend.get_accounts_by_ids_async({i for f, t, _ in parsed for i in (f, t)})
+    from_accounts = {f: accounts[f] for f, _, _ in parsed if f in accounts}
+    allowed = await backend.key_evaluate_permissions(key, [Permissions.TRANSFER_FUNDS], from_accounts.values())
+
+    errors = [None]*len(parsed)
+    to_perform, indices = [], []
+    for i, (from_id, to_id, amount) in enumerate(parsed):
+        if from_id not in accounts or to_id not in accounts:
+            errors[i] = "Account not found"
+        elif not allowed[(Permissions.TRANSFER_FUNDS, from_id)]:
+            errors[i] = "Your key does not have permission to transfer funds from that account"
+        else:
+            to_perform.append((accounts[from_id], accounts[to_id], amount))
+            indices.append(i)
+
+    atomic = mode == "atomic"
+
+    def respond(results):
+        merged = list(errors)
+        for i, error in zip(indices, results):
+            merged[i] = error
+        # when an atomic batch fails the transfers that were fine didn't go through either
+        rolled_back = atomic and any(merged)
+        results = [{"status": "failed" if error else ("skipped" if rolled_back else "done"), "reason": error} for error in merged]
+        return web.json_response({"results": results}, status=400 if rolled_back else 200)
+
+    def outcome(results):  # what gets recorded against the idempotency claim in the batch's commit
+        response = respond(results)
+        return response.status, response.text
+
+    if not to_perform or (atomic and any(errors)):
+        return respond([])
+    try:
+        results = await backend.perform_transactions_async(
+            APIStubUser.from_key(key), to_perform, atomic=atomic, key=key, idempotency=claim, respond=outcome)
+    except SpendingLimitError:
+        raise web.HTTPUnauthorized()
+    except BackendError:
+        raise web.HTTPConflict()
+    return respond(results)
+
+
+@routes.get('/metrics')
+async def get_metrics(request):
+    metrics_token = config.get('metrics_token')
+    if metrics_token is None:
+        raise web.HTTPNotFound()
+    if not hmac.compare_digest(request.headers.get('authorization', '').encode(), f"Bearer {metrics_token}".encode()):
+        raise web.HTTPUnauthorized()
+    return web.Response(body=metrics.render().encode(), headers={
+        "Content-Type": "application/openmetrics-text; version=1.0.0; charset=utf-8"
+    })
+
+
+async def instrument_backend(app):
+    global backend
+    if not isinstance(backend, InstrumentedBackend):
+        backend = InstrumentedBackend(backend)
+    engines = [backend.engine] + ([backend.async_engine.sync_engine] if backend.async_engine is not None else [])
+    for engine in engines:
+        for name in QUERY_EVENTS:
+            if not event.contains(engine, name, count_query):
+                event.listen(engine, name, count_query)
+
+
+async def open_grant_store(app):
+    global grant_store
+    ttl, max_pending = config.get('grant_ttl', 3600), config.get('grant_store_size', 1000)
+    if config.get('grant_store', 'sql') == 'memory':
+        grant_store = MemoryGrantStore(ttl, max_pending)
+    else:
+        grant_store = SQLGrantStore(backend, ttl, max_pending)
+
+
+async def open_http_session(app):
+    global http, discord_ids
+    http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=config.get('discord_http_timeout', 10)))
+    discord_ids = DiscordIdCache(config.get('discord_id_cache_ttl', 300))
+
+
+async def close_http_session(app):
+    await http.close()
+
+
 def init_app():
     global config, trusted_public_keys, private_key
 
@@ -466,16 +1007,29 @@ def init_app():
         trusted_public_keys[fp] = open('./keys/public-keys/' + fp, 'rb').read()
     config = load_config()
     env.globals['static_uri'] = config.get('static_uri')
-    app = web.Application(middlewares=[authenticate])
+    app = web.Application(middlewares=[instrument, unit_of_work, authenticate])
     app.add_routes(routes)
+    app.on_startup.append(instrument_backend)
+    app.on_startup.append(open_grant_store)
+    app.on_startup.append(open_http_session)
+    app.on_cleanup.append(close_http_session)
 
     return app
 
+async def close_backend(app):
+    await backend.close_async()
+
+
 async def main():
-    global backend
-    runner = web.AppRunner(init_app())
+    global backend, runner
+    app = init_app()
+    app.on_cleanup.append(close_backend) # only when the api runs on its own, inside the bot the bot closes the backend
+    runner = web.AppRunner(app)
     db_uri = config.get('database_uri')
-    backend = Backend(db_uri if db_uri else 'sqlite:///database.db')
+    backend = Backend(db_uri if db_uri else 'sqlite:///database.db', async_mode=config.get('database_mode') == 'async',
+                      pool_size=config.get('database_pool_size'), max_overflow=config.get('database_max_overflow'),
+                      token_cache_size=config.get('api_token_cache_size', 4096), idempotency_ttl=config.get('idempotency_ttl', 86400),
+                      idempotency_lease=config.get('idempotency_lease', 60))
     await runner.setup()
     site = web.TCPSite(runner, 'localhost', 8080)
     await site.start()
@@ -484,4 +1038,10 @@ if __name__ == '__main__':
     print('starting API')
     asyncio.set_event_loop(asyncio.new_event_loop())
     asyncio.get_event_loop().create_task(main())
-    asyncio.get_event_loop().run_forever()
+    try:
+        asyncio.get_event_loop().run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if runner is not None:
+            asyncio.get_event_loop().run_until_complete(runner.cleanup())
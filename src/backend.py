@@ -1,24 +1,46 @@
+import asyncio
+import bisect
+import functools
+import hashlib
+import heapq
 import logging
+import operator
+import threading
 import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime
 from enum import Enum
 from typing import Any
+from typing import Callable
 from typing import List
+from typing import NamedTuple
 from typing import Optional
 from uuid import UUID, uuid4
 
+import numpy as np
 from discord import Member, User  # I wanted to avoid doing this here, gonna have to rewrite all the unittests.
-from sqlalchemy import ForeignKey, INT, union, or_, Delete
+from sqlalchemy import ForeignKey, INT, union, or_, Delete, Index, tuple_
 from sqlalchemy import String, BigInteger, DateTime, \
     JSON  # I wanted to avoid using the JSON type since it locks us into certain databases, but on further research it seems to be supported by most major db distributions, and having unstructured data at times is sometimes just way too useful.
-from sqlalchemy import create_engine
-from sqlalchemy import func
-from sqlalchemy import select, delete, update
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy import make_url
+from sqlalchemy import func, event
+from sqlalchemy import select, delete, update, insert, case
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import Session
+from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import mapped_column
 from sqlalchemy.orm import relationship
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 
 logger = logging.getLogger(__name__)
 
@@ -189,9 +211,45 @@ class APIKey(Base):
     def activate(self):
         self.enabled = True
 
+
+class PendingGrant(Base):
+    """An oauth grant that an application has registered a reference for but not yet retrieved the key of, see SQLGrantStore"""
+    __tablename__ = 'pending_grants'
+    __table_args__ = (
+        Index('ix_pending_grants_expiry', 'expires_at'),
+    )
+    application_id: Mapped[UUID] = mapped_column(ForeignKey("applications.application_id", ondelete='CASCADE'), primary_key=True)
+    ref_id: Mapped[UUID] = mapped_column(primary_key=True)
+    state: Mapped[dict[str, Any]] = mapped_column(default={})
+    expires_at: Mapped[float] = mapped_column()
+
+class IdempotencyRecord(Base):
+    """The outcome of an api request made with an Idempotency-Key header, replayed to any retries of it, see Backend.claim_idempotency_key"""
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (
+        Index('ix_idempotency_keys_expiry', 'expires_at'),
+    )
+    key_id: Mapped[int] = mapped_column(ForeignKey("api_keys.key_id", ondelete='CASCADE'), primary_key=True)
+    idempotency_key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    request_hash: Mapped[str] = mapped_column(String(64))
+    claim_id: Mapped[UUID] = mapped_column() # identifies the request holding the claim, so one whose lease ran out can't record over its successor
+    status: Mapped[int] = mapped_column(nullable=True) # None until the request it was claimed for has finished
+    response: Mapped[str] = mapped_column(nullable=True)
+    expires_at: Mapped[float] = mapped_column()
+
+def account_display_name(account_type: AccountType, owner_id: int, account_name: str) -> str:
+    if account_type == AccountType.USER:
+        return f'<@{owner_id}>'
+    return account_name
+
+
 class Account(Base):
     """A class used to represent an account stored in the database"""
     __tablename__ = 'accounts'
+    __table_args__ = (
+        Index('ix_accounts_owner', 'economy_id', 'owner_id', 'account_type', 'deleted'),
+        Index('ix_accounts_name', 'economy_id', 'account_name'),
+    )
     account_id: Mapped[UUID] = mapped_column(primary_key=True)
     account_name: Mapped[str] = mapped_column(String(64))
     owner_id: Mapped[int] = mapped_column(BigInteger(), nullable=True)
@@ -213,9 +271,7 @@ class Account(Base):
         return frmt(self.balance)
 
     def get_name(self) -> str:
-        if self.account_type == AccountType.USER:
-            return f'<@{self.owner_id}>'
-        return self.account_name
+        return account_display_name(self.account_type, self.owner_id, self.account_name)
 
     def delete(self):
         self.deleted = True
@@ -225,6 +281,10 @@ class Account(Base):
 class Transaction(Base):
     """A class used to represent transactions stored in the database"""
     __tablename__ = 'transactions'
+    __table_args__ = (
+        Index('ix_transactions_target', 'target_account_id', 'action', 'timestamp'),
+        Index('ix_transactions_destination', 'destination_account_id', 'action', 'timestamp'),
+    )
     transaction_id: Mapped[int] = mapped_column(primary_key=True)
     actor_id: Mapped[int] = mapped_column(BigInteger(), nullable=False)
     timestamp: Mapped[DateTime] = mapped_column(DateTime(), nullable=False, default=datetime.now)
@@ -257,6 +317,9 @@ class BalanceUpdateNotifier(Base):
 class Permission(Base):
     """A class used to represent a permission as stored in the database"""
     __tablename__ = 'perms'
+    __table_args__ = (
+        Index('ix_perms_lookup', 'user_id', 'permission', 'account_id', 'economy_id'),
+    )
     entry_id: Mapped[UUID] = mapped_column(primary_key=True)
     account_id: Mapped[UUID] = mapped_column(ForeignKey('accounts.account_id'), nullable=True)
     user_id: Mapped[int] = mapped_column(BigInteger()) # can also be a role id or an api key id < 4194304, due to how discord works there are zero chances of a collision
@@ -287,6 +350,9 @@ class Tax(Base):
 class RecurringTransfer(Base):
     """A class used to represent a recurring transfer as stored in the database"""
     __tablename__ = 'recurring_transfers'
+    __table_args__ = (
+        Index('ix_recurring_transfers_next_due', 'next_due'),
+    )
     entry_id: Mapped[UUID] = mapped_column(primary_key=True)
     
     authorisor_id: Mapped[int] = mapped_column(BigInteger())
@@ -301,6 +367,7 @@ class RecurringTransfer(Base):
     last_payment_timestamp: Mapped[int] = mapped_column()
     payment_interval: Mapped[int] = mapped_column()
     number_of_payments_left: Mapped[int] = mapped_column(nullable=True) # thanks hackerman!
+    next_due: Mapped[float] = mapped_column(nullable=True) # always last_payment_timestamp + payment_interval, stored so it can be indexed
 
     transaction_type: Mapped[TransactionType] = mapped_column()
 
@@ -308,6 +375,14 @@ class BackendError(Exception):
     pass
 
 
+class SpendingLimitError(BackendError):
+    pass
+
+
+class IdempotencyError(BackendError):
+    pass
+
+
 class StubUser:
     """
     A class to be used if the user could not be found anymore
@@ -319,6 +394,237 @@ class StubUser:
         self.roles = []
 
 
+class LRUCache:
+    """
+    A thread safe, size bounded LRU cache whose entries can also expire ttl seconds after they were put, the caches below build on it.
+    Subclasses keep any indexes of their own in step with the entries by overriding _added and _removed.
+    """
+
+    def __init__(self, max_size: int = 4096, ttl: float | None = None, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Any, tuple[float | None, Any]] = OrderedDict() # key -> (expiry, value)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= self.clock():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (None if self.ttl is None else self.clock() + self.ttl, value)
+            self._added(key, value)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._removed(key, entry[1])
+
+    def _added(self, key, value):
+        pass
+
+    def _removed(self, key, value):
+        pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+class PermissionCache(LRUCache):
+    """
+    A size bounded LRU cache of effective permissions.
+
+    Entries are keyed on the subject ids (the user id and the ids of their roles), the permission,
+    and the account and economy the check was made against. The backend invalidates entries when a permission row
+    or an account's ownership changes, and again once that change is committed or rolled back. Entries also expire after ttl seconds
+    so changes made by another process (the bot and the api can run separately) get picked up.
+    The tick worker threads share it with the event loop, so everything is done under a lock.
+    """
+
+    def __init__(self, max_size: int = 4096, ttl: float = 60):
+        super().__init__(max_size, ttl)
+        self._by_subject: dict[int, set] = {}
+        self._by_account: dict[UUID, set] = {}
+
+    @staticmethod
+    def make_key(user, permission: Permissions, account_id: UUID | None, economy_id: UUID | None) -> tuple:
+        return user.id, tuple(sorted(r.id for r in user.roles)), permission, account_id, economy_id
+
+    def _added(self, key: tuple, allowed: bool):
+        for subject_id in (key[0],) + key[1]:
+            self._by_subject.setdefault(subject_id, set()).add(key)
+        if key[3] is not None:
+            self._by_account.setdefault(key[3], set()).add(key)
+
+    def _removed(self, key: tuple, allowed: bool):
+        for subject_id in (key[0],) + key[1]:
+            keys = self._by_subject.get(subject_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_subject[subject_id]
+        keys = self._by_account.get(key[3])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_account[key[3]]
+
+    def invalidate(self, subject_id: int, permission: Permissions, account_id: UUID | None, economy_id: UUID | None):
+        """Drops every entry that a permission row with the given scope could have affected"""
+        with self._lock:
+            for key in list(self._by_subject.get(subject_id, ())):
+                if key[2] != permission:
+                    continue
+                if account_id is not None and key[3] != account_id:
+                    continue
+                if economy_id is not None and key[4] != economy_id:
+                    continue
+                self._remove(key)
+
+    def invalidate_subject(self, subject_id: int):
+        with self._lock:
+            for key in list(self._by_subject.get(subject_id, ())):
+                self._remove(key)
+
+    def invalidate_account(self, account_id: UUID):
+        with self._lock:
+            for key in list(self._by_account.get(account_id, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._by_subject.clear()
+            self._by_account.clear()
+
+
+class GrantedPermission(NamedTuple):
+    user_id: int
+    permission: Permissions
+    account_id: UUID | None
+    economy_id: UUID | None
+    allowed: bool
+
+
+class KeyContext(NamedTuple):
+    """An immutable snapshot of everything the api needs to authorise a request made with a key"""
+    key_id: int
+    issuer_id: int
+    type: "KeyType"
+    enabled: bool
+    spending_limit: int | None
+    application_id: UUID
+    economy_id: UUID
+    owner_guild_id: int
+    permissions: frozenset[GrantedPermission]
+
+
+class IdempotencyClaim(NamedTuple):
+    """
+    A request's claim on an idempotency key, see Backend.claim_idempotency_key.
+    status and response are the outcome recorded against it if the request's changes go through.
+    """
+    key_id: int
+    idempotency_key: str
+    claim_id: UUID
+    status: int = 200
+    response: str | None = None
+
+
+class KeyContextCache(LRUCache):
+    """
+    A size bounded LRU cache of KeyContexts keyed on the key id.
+
+    The backend drops a key's context whenever the key or its permissions change, entries also expire after ttl seconds
+    so changes made by another process (the bot and the api can run separately) get picked up.
+    """
+
+    def __init__(self, max_size: int = 4096, ttl: float = 60):
+        super().__init__(max_size, ttl)
+
+    def put(self, context: KeyContext):
+        super().put(context.key_id, context)
+
+    def invalidate(self, key_id: int):
+        self.pop(key_id)
+
+
+class TokenCache(LRUCache):
+    """
+    A size bounded LRU cache of api tokens whose signatures have already been verified.
+
+    Entries are keyed on a digest of the token and hold the id of the key it was issued for along with whether that key
+    was enabled, so repeat requests skip the RSA verification. The backend drops a key's entries when it gets deleted or
+    replaced. Requests still need the key's KeyContext, which is dropped at the same time and otherwise expires on its own
+    (see KeyContextCache), so a stale entry can't let a deleted key through for longer than that.
+    """
+
+    def __init__(self, max_size: int = 4096):
+        super().__init__(max_size)
+        self._by_key: dict[int, set[bytes]] = {}
+
+    @staticmethod
+    def digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def put(self, digest: bytes, key_id: int, enabled: bool):
+        super().put(digest, (key_id, enabled))
+
+    def _added(self, digest: bytes, entry: tuple[int, bool]):
+        self._by_key.setdefault(entry[0], set()).add(digest)
+
+    def _removed(self, digest: bytes, entry: tuple[int, bool]):
+        digests = self._by_key.get(entry[0])
+        if digests is not None:
+            digests.discard(digest)
+            if not digests:
+                del self._by_key[entry[0]]
+
+    def invalidate_key(self, key_id: int):
+        with self._lock:
+            for digest in list(self._by_key.get(key_id, ())):
+                self._remove(digest)
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._by_key.clear()
+
+
 def make_serializable(arg: Any):
     if isinstance(arg, UUID):
         return str(arg)
@@ -336,54 +642,651 @@ def make_serializable(arg: Any):
 
 
 
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg"
+}
+
+
+def make_async_uri(path: str) -> str:
+    """Swaps the driver of a database uri for its asyncio equivalent, i.e. sqlite:///database.db -> sqlite+aiosqlite:///database.db"""
+    url = make_url(path)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        raise ValueError(f"There is no supported asyncio driver for {url.get_backend_name()} databases")
+    return url.set(drivername=driver).render_as_string(hide_password=False)
+
+
+class TaxTable:
+    """
+    The brackets of one (economy, affected type, tax type) compiled for transaction time taxes.
+    The breakpoints of the brackets are sorted and the tax owed on everything below each of them precomputed,
+    so working out the tax on an amount is a bisect and a sum over the brackets the amount falls inside of.
+    """
+
+    def __init__(self, brackets: list[Tax]):
+        self.points = sorted({b.bracket_start for b in brackets} | {b.bracket_end for b in brackets})
+        self.recipients = {b.to_account_id for b in brackets}
+        self.segments: list[tuple[dict[UUID, int], list[tuple[int, int, UUID]]]] = []
+        for point in self.points:
+            below = {}
+            inside = []
+            for bracket in brackets:
+                if bracket.bracket_end <= point:
+                    full_tax = ((bracket.bracket_end - bracket.bracket_start)*bracket.rate)//100
+                    below[bracket.to_account_id] = below.get(bracket.to_account_id, 0) + full_tax
+                elif bracket.bracket_start <= point:
+                    inside.append((bracket.bracket_start, bracket.rate, bracket.to_account_id))
+            self.segments.append((below, inside))
+
+    def owed(self, amount: int) -> dict[UUID, int]:
+        """The tax owed on amount to each receiving account"""
+        i = bisect.bisect_right(self.points, amount) - 1
+        if i < 0:
+            return {}
+        below, inside = self.segments[i]
+        taxes = dict(below)
+        for bracket_start, rate, to_account_id in inside:
+            taxes[to_account_id] = taxes.get(to_account_id, 0) + ((amount - bracket_start)*rate)//100
+        return taxes
+
+
+EMPTY_TAX_TABLE = TaxTable([])
+
+
+class TransferScheduler:
+    """
+    Runs recurring transfers when they actually fall due rather than in one daily burst.
+    Transfers due within the next `horizon` seconds are held in a heap ordered by next_due, topped up from the
+    next_due index, and the scheduler sleeps until the top of the heap is due. Anything that fell due while the
+    bot was down is overdue the first time the heap is filled, so it gets paid straight away.
+    """
+
+    def __init__(self, backend: "Backend", horizon: float = 3600, retry_delay: float = 60):
+        self.backend = backend
+        self.horizon = horizon
+        self.retry_delay = retry_delay
+        self.runs = 0
+        self.failures = 0
+        self.transfers = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        self._heap: list[tuple[float, UUID]] = []
+        self._loaded_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._loaded_until = 0.0
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def schedule(self, entry_id: UUID, next_due: float):
+        """Tells the scheduler about a new transfer, ones due after the loaded horizon get picked up by the next refill"""
+        if next_due <= self._loaded_until:
+            heapq.heappush(self._heap, (next_due, entry_id))
+            self.wake()
+
+    def wake(self):
+        """Makes the scheduler look at what's due straight away rather than when it planned to, e.g. after the clock jumped"""
+        self._wakeup.set()
+
+    def _refill(self, now: float):
+        self._loaded_until = now + self.horizon
+        with self.backend.unit_of_work() as session:
+            rows = session.execute(select(RecurringTransfer.next_due, RecurringTransfer.entry_id)
+                                   .where(RecurringTransfer.next_due <= self._loaded_until)).all()
+        self._heap = [tuple(row) for row in rows]
+        heapq.heapify(self._heap)
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            if now >= self._loaded_until:
+                self._refill(now)
+
+            due = {}
+            while self._heap and self._heap[0][0] <= now:
+                next_due, entry_id = heapq.heappop(self._heap)
+                due[entry_id] = next_due
+            if due:
+                try:
+                    with self.backend.unit_of_work():
+                        paid = await self.backend.tick()
+                except Exception:
+                    logger.exception("Failed to pay recurring transfers, retrying shortly")
+                    paid = False
+                if not paid:
+                    # whatever failed is still due, so without backing off it would be retried straight away
+                    self.failures += 1
+                    await asyncio.sleep(self.retry_delay)
+                else:
+                    lags = [now - next_due for next_due in due.values()]
+                    self.runs += 1
+                    self.transfers += len(lags)
+                    self.total_lag += sum(lags)
+                    self.last_lag = max(lags)
+                    self.max_lag = max(self.max_lag, self.last_lag)
+                self._loaded_until = 0.0  # the transfers that were paid have moved, so reload them
+                continue
+
+            wake = min(self._heap[0][0], self._loaded_until) if self._heap else self._loaded_until
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(wake - now, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "runs": self.runs,
+            "failures": self.failures,
+            "transfers": self.transfers,
+            "scheduled": len(self._heap),
+            "mean_lag": self.total_lag / self.transfers if self.transfers else 0.0,
+            "max_lag": self.max_lag,
+            "last_lag": self.last_lag
+        }
+
+
+class GrantStore(ABC):
+    """
+    Keeps the state of oauth grants from an application registering a reference until it retrieves the key.
+
+    Entries expire ttl seconds after they were last written and each application can only have max_pending of them,
+    registering more drops the ones closest to expiring.
+    Stores kept in the database work inside the backend's session and leave committing to the caller.
+    """
+
+    def __init__(self, ttl: float = 3600, max_pending: int = 1000):
+        self.ttl = ttl
+        self.max_pending = max_pending
+
+    @abstractmethod
+    def put(self, application_id: UUID, ref_id: UUID, state: dict) -> None:
+        ...
+
+    @abstractmethod
+    def get(self, application_id: UUID, ref_id: UUID) -> dict | None:
+        ...
+
+    @abstractmethod
+    def pop(self, application_id: UUID, ref_id: UUID) -> dict | None:
+        """Removes and returns a grant's state, only one caller can ever get a given grant back"""
+
+    @abstractmethod
+    def restore(self, application_id: UUID, ref_id: UUID, state: dict) -> None:
+        """Puts back a grant whose pop was rolled back, after the session's rollback"""
+
+
+class MemoryGrantStore(GrantStore):
+    """A GrantStore local to the process, grants are lost on restart and not shared between api workers"""
+
+    def __init__(self, ttl: float = 3600, max_pending: int = 1000):
+        super().__init__(ttl, max_pending)
+        self._grants: dict[UUID, OrderedDict[UUID, tuple[float, dict]]] = {}
+        self._lock = threading.RLock()
+
+    def put(self, application_id: UUID, ref_id: UUID, state: dict) -> None:
+        with self._lock:
+            grants = self._grants.setdefault(application_id, OrderedDict())
+            grants.pop(ref_id, None)
+            grants[ref_id] = (time.monotonic() + self.ttl, state)
+            while len(grants) > self.max_pending:
+                grants.popitem(last=False)
+
+    def get(self, application_id: UUID, ref_id: UUID) -> dict | None:
+        with self._lock:
+            grants = self._grants.get(application_id, {})
+            entry = grants.get(ref_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                self.pop(application_id, ref_id)
+                return None
+            return entry[1]
+
+    def pop(self, application_id: UUID, ref_id: UUID) -> dict | None:
+        with self._lock:
+            grants = self._grants.get(application_id)
+            if grants is None:
+                return None
+            entry = grants.pop(ref_id, None)
+            if not grants:
+                del self._grants[application_id]
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            return entry[1]
+
+    def restore(self, application_id: UUID, ref_id: UUID, state: dict) -> None:
+        self.put(application_id, ref_id, state)
+
+
+class SQLGrantStore(GrantStore):
+    """A GrantStore kept in the pending_grants table, so it survives restarts and can be shared by several api workers"""
+
+    def __init__(self, backend: "Backend", ttl: float = 3600, max_pending: int = 1000):
+        super().__init__(ttl, max_pending)
+        self.backend = backend
+
+    def put(self, application_id: UUID, ref_id: UUID, state: dict) -> None:
+        session = self.backend.session
+        now = time.time()
+        session.execute(delete(PendingGrant).where(PendingGrant.expires_at <= now))
+        session.execute(delete(PendingGrant).where(PendingGrant.application_id == application_id)
+                        .where(PendingGrant.ref_id == ref_id))
+        session.execute(insert(PendingGrant).values(application_id=application_id, ref_id=ref_id,
+                                                    state=make_serializable(state), expires_at=now + self.ttl))
+        overflow = (select(PendingGrant.ref_id).where(PendingGrant.application_id == application_id)
+                    .order_by(PendingGrant.expires_at.desc()).offset(self.max_pending))
+        session.execute(delete(PendingGrant).where(PendingGrant.application_id == application_id)
+                        .where(PendingGrant.ref_id.in_(overflow.scalar_subquery())))
+
+    def get(self, application_id: UUID, ref_id: UUID) -> dict | None:
+        return self.backend.session.execute(select(PendingGrant.state)
+                                            .where(PendingGrant.application_id == application_id)
+                                            .where(PendingGrant.ref_id == ref_id)
+                                            .where(PendingGrant.expires_at > time.time())).scalar_one_or_none()
+
+    def pop(self, application_id: UUID, ref_id: UUID) -> dict | None:
+        return self.backend.session.execute(delete(PendingGrant)
+                                            .where(PendingGrant.application_id == application_id)
+                                            .where(PendingGrant.ref_id == ref_id)
+                                            .where(PendingGrant.expires_at > time.time())
+                                            .returning(PendingGrant.state)).scalar_one_or_none()
+
+    def restore(self, application_id: UUID, ref_id: UUID, state: dict) -> None:
+        pass # the rollback already undid the delete
+
+
 class Backend:
     """A singleton used to call the backend database"""
     
-    def __init__(self, path: str):
-        self.engine = create_engine(path)
-        self.session = Session(self.engine)
+    def __init__(self, path: str, permission_cache_size: int = 4096, async_mode: bool = False, pool_size: int = None, max_overflow: int = None,
+                 tick_concurrency: int = 4, tax_table_ttl: float = 60, token_cache_size: int = 4096, idempotency_ttl: float = 86400,
+                 idempotency_lease: float = 60, tick_summary_interval: float = 60*60*24):
+        pool_options = {k: v for k, v in (("pool_size", pool_size), ("max_overflow", max_overflow)) if v is not None}
+        self.engine = create_engine(path, **pool_options)
+        self.sessionmaker = sessionmaker(self.engine)
+        event.listen(self.sessionmaker, "after_commit", self._run_invalidations)
+        event.listen(self.sessionmaker, "after_rollback", self._run_invalidations)
+        self._default_session = self.sessionmaker()
+        self._current_session: ContextVar[Session | None] = ContextVar(f"backend_session_{id(self)}", default=None)
+        self.permission_cache = PermissionCache(permission_cache_size)
+        self.token_cache = TokenCache(token_cache_size)
+        self.key_contexts = KeyContextCache(token_cache_size)
+        # the api can run in a process of its own, so tables also get rebuilt every so often to pick up brackets changed elsewhere
+        self.tax_table_ttl = tax_table_ttl
+        self._tax_tables: dict[UUID, tuple[float, dict[tuple[AccountType, TaxType], TaxTable]]] = {}
+        self.idempotency_ttl = idempotency_ttl
+        self.idempotency_lease = idempotency_lease
+        self._idempotency_purge_due = 0
+        # transfers are paid whenever they fall due, so the public summary is gathered up and posted at most once per interval
+        self.tick_summary_interval = tick_summary_interval
+        self._tick_summary: dict[str, list] = {} # economy name -> [transfers, seconds taken, failed ticks, last error]
+        self._tick_summary_due = 0.0
+        self.async_engine = None
+        self.async_sessionmaker = None
+        if async_mode:
+            # The async engine serves the *_async methods, everything else keeps going through the sync engine
+            self.async_engine = create_async_engine(make_async_uri(path), **pool_options)
+            self.async_sessionmaker = async_sessionmaker(self.async_engine, expire_on_commit=False)
         Base.metadata.create_all(self.engine)
+        self.add_missing_columns()
+        self.create_indexes()
+        with self.engine.begin() as conn:
+            conn.execute(update(RecurringTransfer).where(RecurringTransfer.next_due == None)
+                         .values(next_due=RecurringTransfer.last_payment_timestamp + RecurringTransfer.payment_interval))
+        self.scheduler = TransferScheduler(self)
+        # in memory sqlite databases are per connection, so ticks against one can't be spread over worker threads
+        in_memory = self.engine.url.get_backend_name() == 'sqlite' and self.engine.url.database in (None, '', ':memory:')
+        self._tick_pool = None if in_memory else ThreadPoolExecutor(max_workers=tick_concurrency, thread_name_prefix="tick")
+
+    def close(self):
+        """
+        Shuts down the tick workers and closes the database connections, the backend can't be used afterwards.
+        From inside a running event loop use close_async instead so the async engine's connections get closed properly.
+        """
+        if self._tick_pool is not None:
+            self._tick_pool.shutdown(wait=True)
+            self._tick_pool = None
+        self._default_session.close()
+        self.engine.dispose()
+        if self.async_engine is not None:
+            self.async_engine.sync_engine.dispose(close=False) # closing them needs the event loop they were opened on
+
+    async def close_async(self):
+        await self.scheduler.stop()
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+        self.close()
+
+    @property
+    def session(self) -> Session:
+        """The session of the unit of work running in the current context, or a shared session outside of one"""
+        session = self._current_session.get()
+        return session if session is not None else self._default_session
+
+    @contextmanager
+    def unit_of_work(self):
+        """
+        Gives the current context (i.e. a command, request or tick) its own session for the duration of the block.
+        Since asyncio tasks each get their own copy of the context, concurrent coroutines never share a transaction,
+        and the session's identity map is thrown away afterwards rather than growing for the lifetime of the process.
+        Objects loaded inside the block are detached once it exits, so hold on to ids rather than ORM objects across units.
+        Nested units reuse the outer unit's session.
+        """
+        if self._current_session.get() is not None:
+            yield self._current_session.get()
+            return
+
+        session = self.sessionmaker()
+        token = self._current_session.set(session)
+        try:
+            yield session
+        except BaseException:
+            session.rollback()
+            raise
+        finally:
+            self._current_session.reset(token)
+            session.close()
+
+    def add_missing_columns(self):
+        """create_all won't add columns to tables that already exist either, so nullable columns declared since the database was created get added here"""
+        inspector = inspect(self.engine)
+        with self.engine.begin() as conn:
+            for table in Base.metadata.sorted_tables:
+                existing = {column["name"] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in existing and column.nullable:
+                        conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(self.engine.dialect)}"))
+
+    def create_indexes(self):
+        """create_all won't add indexes to tables that already exist, so databases created before an index was declared get it here"""
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(self.engine, checkfirst=True)
             
 
-    async def tick(self):
+    async def tick(self) -> bool:
         """
-        Triggers a tick in the server
-        Must be triggered externally        
+        Pays every recurring transfer that's due
+        Normally triggered by the TransferScheduler whenever a transfer falls due
+
+        Each economy is paid on its own connection in the tick worker pool, so one big economy doesn't hold up
+        the others or the event loop, and one economy failing doesn't stop the rest from being paid.
+
+        :returns: False if any economy failed, its transfers are still due so the caller should back off before ticking again.
         """
 
         tick_time = time.time()
-        stmt = select(RecurringTransfer).where((RecurringTransfer.last_payment_timestamp + RecurringTransfer.payment_interval) <= tick_time)
-        transfers = self.session.execute(stmt).all()
+        # the join below skips transfers paid from an account that has since been closed, so they're cancelled here instead
+        orphaned = self.session.execute(select(RecurringTransfer.entry_id, RecurringTransfer.authorisor_id, RecurringTransfer.amount, RecurringTransfer.payment_interval)
+                                        .where(RecurringTransfer.next_due <= tick_time)
+                                        .where(RecurringTransfer.from_account_id.not_in(select(Account.account_id)))).all()
+        if orphaned:
+            self.session.execute(delete(RecurringTransfer).where(RecurringTransfer.entry_id.in_([row[0] for row in orphaned])),
+                                 execution_options={"synchronize_session": False})
+            self.session.commit()
+        for _, authorisor_id, amount, payment_interval in orphaned:
+            logger.log(PRIVATE_LOG, f'Failed to perform recurring transaction of {frmt(amount)} due to : the account paying it has been closed')
+            self.notify_user(authorisor_id, f"Your recurring transaction of {frmt(amount)} every {payment_interval/60/60/24}days was cancelled due to: the account paying it has been closed", "Failed Reccurring Transfer")
+
+        due = self.session.execute(select(Account.economy_id, RecurringTransfer.authorisor_id, Economy.owner_guild_id)
+                                   .join(Account, RecurringTransfer.from_account_id == Account.account_id)
+                                   .join(Economy, Account.economy_id == Economy.economy_id)
+                                   .where(RecurringTransfer.next_due <= tick_time)
+                                   .distinct()).all()
+        if not due:
+            return True
+
+        # every authorisor gets resolved once up front rather than once per payment
+        member_keys = list({(authorisor_id, guild_id) for _, authorisor_id, guild_id in due})
+        members = await asyncio.gather(*[self.get_member(*key) for key in member_keys], return_exceptions=True)
+        authorisors = {key: member if member is not None and not isinstance(member, BaseException) else StubUser(key[0])
+                       for key, member in zip(member_keys, members)}
+
+        economy_ids = list({economy_id for economy_id, _, _ in due})
+        start = time.perf_counter()
+        if self._tick_pool is not None:
+            loop = asyncio.get_running_loop()
+            results = await asyncio.gather(*[loop.run_in_executor(self._tick_pool, self._tick_economy_in_unit, economy_id, authorisors, tick_time)
+                                             for economy_id in economy_ids])
+        else:
+            results = [self._tick_economy_safely(self.session, economy_id, authorisors, tick_time) for economy_id in economy_ids]
+        elapsed = time.perf_counter() - start
+
+        logger.debug(f"Tick paid recurring transfers across {len(results)} economies in {elapsed*1000:.0f}ms")
+        for name, guild_id, paid, failed, error, economy_elapsed in results:
+            if error is None and not paid and not failed:
+                continue
+            summary = self._tick_summary.setdefault(name, [0, 0.0, 0, None])
+            summary[1] += economy_elapsed
+            if error is not None:
+                summary[2] += 1
+                summary[3] = error
+                continue
+            self._report_tick_economy(name, guild_id, paid, failed, authorisors)
+            summary[0] += len(paid) + len(failed)
+        self._post_tick_summary(tick_time)
+        return all(error is None for _, _, _, _, error, _ in results)
+
+    def _post_tick_summary(self, now: float):
+        """Posts what the ticks since the last summary did to the public log, if there's anything to say and the interval has passed"""
+        if not self._tick_summary or now < self._tick_summary_due:
+            return
+        lines = []
+        for name, (transfers, economy_elapsed, failures, error) in self._tick_summary.items():
+            line = f"{name}: {transfers} transfers in {economy_elapsed*1000:.0f}ms"
+            if failures:
+                line += f", {failures} failed ticks, the last due to: {error}"
+            lines.append(line)
+        total = sum(transfers for transfers, *_ in self._tick_summary.values())
+        logger.log(PUBLIC_LOG, f"Paid {total} recurring transfers across {len(self._tick_summary)} economies\n" + "\n".join(lines))
+        self._tick_summary = {}
+        self._tick_summary_due = now + self.tick_summary_interval
+
+    def _tick_economy_in_unit(self, economy_id: UUID, authorisors: dict, tick_time: float):
+        """Runs in a tick worker thread, which doesn't inherit the tick's context, so this is a unit of work with its own session and connection"""
+        with self.unit_of_work() as session:
+            return self._tick_economy_safely(session, economy_id, authorisors, tick_time)
+
+    def _tick_economy_safely(self, session: Session, economy_id: UUID, authorisors: dict, tick_time: float):
+        """
+        Loads one economy's due transfers and runs _tick_economy on them, catching any failure so the other economies still get paid.
+
+        :returns: (economy name, guild id, paid, failed, error, seconds taken)
+        """
+        start = time.perf_counter()
+        name, guild_id = str(economy_id), None
+        try:
+            stmt = (select(RecurringTransfer)
+                    .join(Account, RecurringTransfer.from_account_id == Account.account_id)
+                    .where(Account.economy_id == economy_id)
+                    .where(RecurringTransfer.next_due <= tick_time)
+                    .options(selectinload(RecurringTransfer.from_account).selectinload(Account.economy),
+                             selectinload(RecurringTransfer.from_account).selectinload(Account.update_notifiers),
+                             selectinload(RecurringTransfer.to_account).selectinload(Account.update_notifiers)))
+            transfers = session.execute(stmt).scalars().all()
+            if not transfers:
+                return name, guild_id, [], [], None, time.perf_counter() - start
+            economy = transfers[0].from_account.economy
+            name, guild_id = economy.currency_name, economy.owner_guild_id
+            paid, failed = self._tick_economy(session, transfers, authorisors, tick_time)
+            return name, guild_id, paid, failed, None, time.perf_counter() - start
+        except Exception as e:
+            session.rollback()
+            logger.exception(f"Failed to pay the recurring transfers of economy {economy_id}")
+            return name, guild_id, [], [], e, time.perf_counter() - start
+
+    def _tick_economy(self, session: Session, transfers: list[RecurringTransfer], authorisors: dict, tick_time: float):
+        """
+        Pays every due recurring transfer in an economy in one go.
+        The number of payments owed by each transfer is worked out up front, the payments are played out against
+        the account balances in python and the result is written back with a handful of set based statements.
+        A transfer that can't be paid gets cancelled after making the payments it could afford, like it would if
+        the payments had been made one by one.
+
+        :returns: The transfers that were paid and the ones that were cancelled, for _report_tick_economy
+        """
+        economy = transfers[0].from_account.economy
+        transfers = sorted(transfers, key=lambda t: (t.last_payment_timestamp, t.entry_id))
+
+        allowed = {}
+        by_authorisor = {}
         for transfer in transfers:
-            transfer = transfer[0]
-            number_of_transfers = int((tick_time - transfer.last_payment_timestamp) // transfer.payment_interval)
-            payments_left = transfer.number_of_payments_left # I'm extracting this value since updating ORM objects is more expensive than updating an int and informing the ORM of the changes at the end.
-            for i in range(number_of_transfers):
-                if payments_left == 0:
-                    self.session.delete(transfer)
-                    break
-                
-                try:
-                    authorisor = await self.get_member(transfer.authorisor_id, transfer.from_account.economy.owner_guild_id)
-                    if authorisor is None:
-                        authorisor = StubUser(transfer.authorisor_id)
-                    self.perform_transaction(authorisor, transfer.from_account, transfer.to_account, transfer.amount, transfer.transaction_type)
-                    payments_left -= 1
-                except BackendError as e:
-                    logger.log(PRIVATE_LOG, f'Failed to perform recurring transaction of {frmt(transfer.amount)} from {transfer.from_account.account_name} to {transfer.to_account.account_name} due to : {e}')
-                    self.notify_user(transfer.authorisor_id, "Your recurring transaction of {frmt(transfer.amount)} every {transfer.payment_interval/60/60/24}days to {transfer.to_account.account_name} was cancelled due to: {e}", "Failed Reccurring Transfer")
-                    self.session.delete(transfer)
-            else: # for those unfamiliar with for/else this is not executed if the loop breaks
-                transfer.number_of_payments_left = payments_left
-                transfer.last_payment_timestamp = tick_time
-        self.session.commit()
-        logger.log(PUBLIC_LOG, f'successfully performed tick')
+            by_authorisor.setdefault(transfer.authorisor_id, []).append(transfer)
+        for authorisor_id, authorised in by_authorisor.items():
+            results = self._evaluate_permissions(session, authorisors[(authorisor_id, economy.owner_guild_id)], [Permissions.TRANSFER_FUNDS],
+                                                 [t.from_account for t in authorised])
+            for transfer in authorised:
+                allowed[transfer.entry_id] = results[(Permissions.TRANSFER_FUNDS, transfer.from_account_id)]
+
+        tax_tables = self._get_tax_tables(session, economy.economy_id)
+
+        account_ids = {t.from_account_id for t in transfers} | {t.to_account_id for t in transfers}
+        account_ids |= {account_id for table in tax_tables.values() for account_id in table.recipients}
+        balances = dict(session.execute(select(Account.account_id, Account.balance)
+                                        .where(Account.account_id.in_(account_ids))
+                                        .order_by(Account.account_id)
+                                        .with_for_update()).all())
+
+        deltas, income, rows, paid, failed, updated, finished = {}, {}, [], [], [], [], []
+        for transfer in transfers:
+            from_account, to_account = transfer.from_account, transfer.to_account
+            to_name = to_account.account_name if to_account is not None else "a closed account"
+            due = int((tick_time - transfer.last_payment_timestamp) // transfer.payment_interval)
+            payments_left = transfer.number_of_payments_left
+            count = due if payments_left is None else min(due, payments_left)
+            reason = None
+            vat, fees = {}, {}
+            if transfer.amount > 0:
+                vat, fees = self._transaction_taxes(session, from_account, transfer.amount)
+            cost = transfer.amount + sum(fees.values())
+            if to_account is None:
+                count, reason = 0, "The account it paid into has been closed"
+            elif not allowed[transfer.entry_id]:
+                count, reason = 0, "You do not have permission to transfer funds from that account"
+            elif from_account.economy_id != to_account.economy_id:
+                count, reason = 0, "Cannot transfer funds from one economy to another"
+            elif transfer.amount <= 0:
+                count, reason = 0, "Cannot transfer a non-positive amount"
+            elif from_account.account_id != to_account.account_id and balances[from_account.account_id] // cost < count:
+                count, reason = balances[from_account.account_id] // cost, "You do not have sufficient funds to transfer from that account"
+
+            if count and from_account.account_id != to_account.account_id:
+                received = transfer.amount - sum(vat.values())
+                changes = {}
+                for taxes in (vat, fees):
+                    for account_id, owed in taxes.items():
+                        changes[account_id] = changes.get(account_id, 0) + owed*count
+                changes[from_account.account_id] = changes.get(from_account.account_id, 0) - cost*count
+                changes[to_account.account_id] = changes.get(to_account.account_id, 0) + received*count
+                for account_id, change in changes.items():
+                    balances[account_id] += change
+                    deltas[account_id] = deltas.get(account_id, 0) + change
+                if transfer.transaction_type == TransactionType.INCOME:
+                    income[to_account.account_id] = income.get(to_account.account_id, 0) + transfer.amount*count
+                rows.extend({
+                    "actor_id": transfer.authorisor_id,
+                    "economy_id": economy.economy_id,
+                    "target_account_id": from_account.account_id,
+                    "destination_account_id": to_account.account_id,
+                    "action": Actions.TRANSFER,
+                    "cud": CUD.UPDATE,
+                    "amount": transfer.amount
+                } for _ in range(count))
+                # everything gets expired on commit so anything needed for the notifications is pulled out now
+                official = self._has_permission(session, authorisors[(transfer.authorisor_id, economy.owner_guild_id)],
+                                                Permissions.GOVERNMENT_OFFICIAL, economy=economy)
+                paid.append((transfer.authorisor_id, from_account.account_id, to_account.account_id, count, received,
+                             from_account.account_name, to_account.account_name,
+                             from_account.get_update_notifiers(), to_account.get_update_notifiers(), official))
+
+            if reason is not None:
+                failed.append((transfer.entry_id, transfer.authorisor_id, transfer.amount, transfer.payment_interval, reason,
+                               from_account.account_name, to_name))
+            elif payments_left is not None and payments_left < due:
+                finished.append(transfer.entry_id)
+            else:
+                # payments stay on their original schedule rather than drifting to whenever the tick happened to run
+                last_payment_timestamp = transfer.last_payment_timestamp + due*transfer.payment_interval
+                updated.append({
+                    "entry_id": transfer.entry_id,
+                    "number_of_payments_left": None if payments_left is None else payments_left - count,
+                    "last_payment_timestamp": last_payment_timestamp,
+                    "next_due": last_payment_timestamp + transfer.payment_interval
+                })
 
+        new_balances = self._apply_balance_deltas_bulk(session, deltas)
+        if new_balances is None:
+            raise BackendError("Balances changed while recurring transfers were being paid, they will be retried next tick")
+        if income:
+            session.execute(update(Account).where(Account.account_id.in_(income))
+                            .values(income_to_date=Account.income_to_date + case(income, value=Account.account_id)),
+                            execution_options={"synchronize_session": False})
+        if rows:
+            session.execute(insert(Transaction), rows)
+        if updated:
+            session.execute(update(RecurringTransfer), updated)
+        removed = finished + [entry_id for entry_id, *_ in failed]
+        if removed:
+            session.execute(delete(RecurringTransfer).where(RecurringTransfer.entry_id.in_(removed)),
+                            execution_options={"synchronize_session": False})
+        session.commit()
+
+        return [entry + (new_balances[entry[1]], new_balances[entry[2]]) for entry in paid], failed
+
+    def _report_tick_economy(self, currency_name: str, guild_id: int, paid: list, failed: list, authorisors: dict):
+        """Logs and sends out the notifications for the transfers _tick_economy made, this has to happen back on the event loop"""
+        for authorisor_id, _, _, count, received, from_name, to_name, from_notifiers, to_notifiers, official, from_balance, to_balance in paid:
+            authorisor = authorisors[(authorisor_id, guild_id)]
+            payments = f" ({count} payments)" if count > 1 else ""
+            logger.log(PUBLIC_LOG if official else PRIVATE_LOG, f"Economy: {currency_name}\n{authorisor.mention} transferred {frmt(received*count)} from {from_name} to {to_name}{payments}")
+            self.notify_users(to_notifiers, f"{authorisor.mention} transferred {frmt(received*count)} from {from_name} to {to_name}{payments}, \n it\'s new balance is {frmt(to_balance)}", "Balance Update")
+            self.notify_users(from_notifiers, f"{authorisor.mention} transferred {frmt(received*count)} from an account you watch ({from_name}), to {to_name}{payments} \n {from_name}\'s new balance is {frmt(from_balance)}", "Balance Update")
+
+        for _, authorisor_id, amount, payment_interval, reason, from_name, to_name in failed:
+            logger.log(PRIVATE_LOG, f'Failed to perform recurring transaction of {frmt(amount)} from {from_name} to {to_name} due to : {reason}')
+            self.notify_user(authorisor_id, f"Your recurring transaction of {frmt(amount)} every {payment_interval/60/60/24}days to {to_name} was cancelled due to: {reason}", "Failed Reccurring Transfer")
 
-    def _one_or_none(self, stmt):
-        res = self.session.execute(stmt).one_or_none()
+
+    @staticmethod
+    def _invalidate_on_commit(session: Session, invalidate, *args):
+        """
+        Invalidates a cache entry now, so the session sees its own change, and again once the session's transaction ends.
+        In between the session (or another request) could cache what the uncommitted change looked like, which is wrong
+        if it gets rolled back, or cache the old state again before the change is committed.
+        """
+        invalidate(*args)
+        session.info.setdefault("invalidations", []).append((invalidate, args))
+
+    @staticmethod
+    def _run_invalidations(session: Session):
+        for invalidate, args in session.info.pop("invalidations", ()):
+            invalidate(*args)
+
+    def _one_or_none(self, stmt, session: Session = None):
+        res = (session or self.session).execute(stmt).one_or_none()
         return res if res is None else res[0]
 
+    async def _run_async(self, fn, *args, **kwargs):
+        """
+        Runs fn(session, *args, **kwargs) on a fresh AsyncSession without blocking the event loop,
+        or on the shared sync session if the backend isn't running in async mode.
+        """
+        if self.async_sessionmaker is None:
+            return fn(self.session, *args, **kwargs)
+        async with self.async_sessionmaker() as session:
+            return await session.run_sync(fn, *args, **kwargs)
+
 
     def get_permissions(self, user: Member, economy=None):
         perms = select(Permission).where(Permission.user_id.in_([user.id] + [r.id for r in user.roles]))
@@ -399,43 +1302,127 @@ class Backend:
 
         return [i[0] for i in self.session.execute(stmt).all()]
 
+    def _key_context_allows(self, key: KeyContext, permission: Permissions, account_id: UUID | None, economy_id: UUID | None,
+                            owner_id: int | None) -> bool:
+        """Resolves a permission for the key itself from the permissions held in its context"""
+        applicable = [p for p in key.permissions if p.permission == permission
+                      and p.account_id in (None, account_id) and p.economy_id in (None, economy_id)]
+        return self._resolve_permission(StubUser(key.key_id), permission, owner_id, applicable)
+
+    async def key_has_permission(self, key: KeyContext, permission: Permissions, account: Account = None, economy: Economy = None) -> bool:
+        account_id = account.account_id if account is not None else None
+        economy_id = economy.economy_id if economy is not None else (account.economy_id if account is not None else None)
+        if not self._key_context_allows(key, permission, account_id, economy_id, account.owner_id if account is not None else None):
+            return False
+        actor = await self.get_member(key.issuer_id, key.owner_guild_id)
+        if actor is None:  # whoever issued the key has left the guild
+            return False
+        return await self.has_permission_async(actor, permission, account=account, economy=economy)
+
+    async def key_evaluate_permissions(self, key: KeyContext, permissions, accounts) -> dict[tuple[Permissions, UUID], bool]:
+        """The batched equivalent of key_has_permission, see evaluate_permissions"""
+        actor = await self.get_member(key.issuer_id, key.owner_guild_id)
+        accounts = list(accounts)
+        if actor is None:
+            return {(p, a.account_id): False for p in permissions for a in accounts}
+        actor_perms = self.evaluate_permissions(actor, permissions, accounts)
+        results = {}
+        for account in accounts:
+            for permission in permissions:
+                results[(permission, account.account_id)] = actor_perms[(permission, account.account_id)] and \
+                    self._key_context_allows(key, permission, account.account_id, account.economy_id, account.owner_id)
+        return results
 
+    def evaluate_permissions(self, user, permissions, accounts) -> dict[tuple[Permissions, UUID], bool]:
+        """
+        Checks a set of permissions against a set of accounts in one go.
 
+        :param user: The user to evaluate the permissions for.
+        :param permissions: The permissions to check.
+        :param accounts: The accounts to check them against.
+        :returns: A dict mapping (permission, account_id) to whether that permission is held on that account.
+        """
+        return self._evaluate_permissions(self.session, user, permissions, accounts)
 
-
-
-
-    async def key_has_permission(self, key: APIKey, *args, **kwargs) -> bool:
-        actor = await self.get_member(key.issuer_id, key.application.economy.owner_guild_id)
-        return self.has_permission(StubUser(key.key_id), *args, **kwargs) and self.has_permission(actor, *args, **kwargs)
+    def _evaluate_permissions(self, session: Session, user, permissions, accounts) -> dict[tuple[Permissions, UUID], bool]:
+        permissions = list(permissions)
+        accounts = list(accounts)
+        if user.id == CONSOLE_USER_ID:
+            return {(p, a.account_id): True for p in permissions for a in accounts}
+
+        results = {}
+        missing = []
+        for account in accounts:
+            for permission in permissions:
+                cache_key = PermissionCache.make_key(user, permission, account.account_id, account.economy_id)
+                allowed = self.permission_cache.get(cache_key)
+                if allowed is None:
+                    missing.append((permission, account, cache_key))
+                else:
+                    results[(permission, account.account_id)] = allowed
+
+        if not missing:
+            return results
+
+        account_ids = {account.account_id for _, account, _ in missing}
+        economy_ids = {account.economy_id for _, account, _ in missing}
+        stmt = (select(Permission)
+                .where(Permission.user_id.in_([user.id] + [r.id for r in user.roles]))
+                .where(Permission.permission.in_({permission for permission, _, _ in missing}))
+                .where(Permission.account_id.in_(account_ids) | (Permission.account_id == None))
+                .where(Permission.economy_id.in_(economy_ids) | (Permission.economy_id == None)))
+
+        rows = {}
+        for row in session.execute(stmt).scalars():
+            rows.setdefault(row.permission, []).append(row)
+
+        for permission, account, cache_key in missing:
+            applicable = [r for r in rows.get(permission, ())
+                          if r.account_id in (None, account.account_id) and r.economy_id in (None, account.economy_id)]
+            allowed = self._resolve_permission(user, permission, account.owner_id, applicable)
+            self.permission_cache.put(cache_key, allowed)
+            results[(permission, account.account_id)] = allowed
+        return results
 
     def has_permission(self, user, permission: Permissions, account: Account = None, economy: Economy = None) -> bool:
         """
         Checks if a user is allowed to do something
         """
+        return self._has_permission(self.session, user, permission, account, economy)
+
+    async def has_permission_async(self, user, permission: Permissions, account: Account = None, economy: Economy = None) -> bool:
+        return await self._run_async(self._has_permission, user, permission, account, economy)
+
+    def _has_permission(self, session: Session, user, permission: Permissions, account: Account = None, economy: Economy = None) -> bool:
         if user.id == CONSOLE_USER_ID:
             return True
 
-        if account is not None and economy is None:
-            economy = account.economy
+        account_id = account.account_id if account is not None else None
+        economy_id = economy.economy_id if economy is not None else (account.economy_id if account is not None else None)
+        cache_key = PermissionCache.make_key(user, permission, account_id, economy_id)
+        allowed = self.permission_cache.get(cache_key)
+        if allowed is not None:
+            return allowed
 
         stmt = select(Permission).where(Permission.user_id.in_([user.id] + [r.id for r in user.roles])).where(Permission.permission == permission)
-        stmt = stmt.where((Permission.account_id == (account.account_id if account is not None else None)) | (Permission.account_id == None))
-        stmt = stmt.where((Permission.economy_id == (economy.economy_id if economy is not None else None)) | (Permission.economy_id == None))
-        default = False
-        owner_id = account.owner_id if account is not None else None
-
-        if permission in DEFAULT_GLOBAL_PERMISSIONS:
-            default = True
-        elif permission in DEFAULT_OWNER_PERMISSIONS and owner_id in [user.id] + [r.id for r in user.roles]:
-            default = True
-        
-        
-        result = list(self.session.execute(stmt).all())
-        
-        if len(result) == 0:
-            return default
+        stmt = stmt.where((Permission.account_id == account_id) | (Permission.account_id == None))
+        stmt = stmt.where((Permission.economy_id == economy_id) | (Permission.economy_id == None))
 
+        result = [i[0] for i in session.execute(stmt).all()]
+        allowed = self._resolve_permission(user, permission, account.owner_id if account is not None else None, result)
+        self.permission_cache.put(cache_key, allowed)
+        return allowed
+
+    @staticmethod
+    def _resolve_permission(user, permission: Permissions, owner_id: int | None, result: list[Permission]) -> bool:
+        """
+        Picks the permission entry that takes precedence out of the entries that apply to a check
+        and falls back to the default for that permission if there are none
+        """
+        if len(result) == 0:
+            if permission in DEFAULT_GLOBAL_PERMISSIONS:
+                return True
+            return permission in DEFAULT_OWNER_PERMISSIONS and owner_id in [user.id] + [r.id for r in user.roles]
 
         def evaluate(perm):
             # Precedence for result : 
@@ -449,12 +1436,11 @@ class Backend:
                 return 2
             return 3
 
-        best = result.pop(0)[0]
-        for r in result:
+        best = result[0]
+        for r in result[1:]:
             # Some more precedence rules
             # permissions registered to the user directly take priority over those registered to roles
             # and the higher the role in the discord ranking thing the higher the precedence
-            r = r[0]
             if evaluate(best) > evaluate(r):
                 best = r
                 continue
@@ -491,9 +1477,44 @@ class Backend:
     def get_key_by_id(self, kid: int) -> APIKey | None:
         return self._one_or_none(select(APIKey).where(APIKey.key_id == kid))
 
+    def get_key_context(self, key_id: int) -> KeyContext | None:
+        """Gets a KeyContext for a key with one query, the result is cached until the key or its permissions change"""
+        context = self.key_contexts.get(key_id)
+        if context is not None:
+            return context
+        rows = self.session.execute(
+            select(APIKey.key_id, APIKey.issuer_id, APIKey.type, APIKey.enabled, APIKey.spending_limit, APIKey.application_id,
+                   Application.economy_id, Economy.owner_guild_id,
+                   Permission.user_id, Permission.permission, Permission.account_id.label("perm_account_id"),
+                   Permission.economy_id.label("perm_economy_id"), Permission.allowed)
+            .join(Application, Application.application_id == APIKey.application_id)
+            .join(Economy, Economy.economy_id == Application.economy_id)
+            .outerjoin(Permission, Permission.user_id == APIKey.key_id)
+            .where(APIKey.key_id == key_id)
+        ).all()
+        if not rows:
+            return None
+        row = rows[0]
+        context = KeyContext(
+            key_id=row.key_id,
+            issuer_id=row.issuer_id,
+            type=row.type,
+            enabled=row.enabled,
+            spending_limit=row.spending_limit,
+            application_id=row.application_id,
+            economy_id=row.economy_id,
+            owner_guild_id=row.owner_guild_id,
+            permissions=frozenset(GrantedPermission(r.user_id, r.permission, r.perm_account_id, r.perm_economy_id, r.allowed)
+                                  for r in rows if r.permission is not None)
+        )
+        self.key_contexts.put(context)
+        return context
+
     def initialize_key(self, app: Application, ref_id: UUID, issuer_id: int) -> APIKey:
         current_key = self.get_key(app, ref_id)
         if current_key is not None:
+            self.token_cache.invalidate_key(current_key.key_id)
+            self.key_contexts.invalidate(current_key.key_id)
             self.session.delete(current_key)
 
         new_key = APIKey(application = app, internal_app_id=ref_id, issuer_id=issuer_id)
@@ -571,6 +1592,7 @@ class Backend:
             meta = make_serializable(kwargs)
         ))
         self.session.commit()
+        self._compile_tax_tables(self.session, to_account.economy.economy_id)
         return tax_bracket
 
 
@@ -581,9 +1603,9 @@ class Backend:
             raise BackendError("You do not have permission to create tax brackets in this economy")
 
         tax_bracket = self.get_tax_bracket(tax_name, economy)
-        tax_bracket_id = tax_bracket.entry_id
         if tax_bracket is None:
             raise BackendError("No tax bracket of that name exists in this economy")
+        tax_bracket_id = tax_bracket.entry_id
 
         self.session.delete(tax_bracket)
         logger.log(PUBLIC_LOG, f"Economy: {tax_bracket.economy.currency_name}\n {user.mention} deleted the tax bracket {tax_name}")
@@ -599,112 +1621,114 @@ class Backend:
         ))
 
         self.session.commit()
+        self._compile_tax_tables(self.session, economy.economy_id)
 
 
 
-    def _perform_transaction_tax(self, amount: int, transaction: Transaction, economy: Economy) -> int:
-        """Performs taxation and returns the total amount of tax taken"""
-        vat_taxes = self.session.execute(select(Tax).where(Tax.tax_type==TaxType.VAT)
-                                         .where(Tax.economy_id==economy.economy_id)
-                                         .where(Tax.affected_type == self.get_account_by_id(transaction.target_account_id).account_type)
-                                         .order_by(Tax.bracket_start.desc())).all()
-        total_cum_tax = 0
-        for vat_tax in vat_taxes:
-            vat_tax = vat_tax[0]
+    def _get_tax_tables(self, session: Session, economy_id: UUID) -> dict[tuple[AccountType, TaxType], TaxTable]:
+        """The compiled VAT and transaction tax tables of an economy keyed on (affected type, tax type), see TaxTable"""
+        entry = self._tax_tables.get(economy_id)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        return self._compile_tax_tables(session, economy_id)
 
-            accumulated_tax = 0
+    def _compile_tax_tables(self, session: Session, economy_id: UUID) -> dict[tuple[AccountType, TaxType], TaxTable]:
+        brackets = {}
+        for bracket in session.execute(select(Tax).where(Tax.economy_id == economy_id)
+                                       .where(Tax.tax_type.in_([TaxType.VAT, TaxType.TRANSACTION]))).scalars():
+            brackets.setdefault((bracket.affected_type, bracket.tax_type), []).append(bracket)
+        tables = {key: TaxTable(key_brackets) for key, key_brackets in brackets.items()}
+        self._tax_tables[economy_id] = (time.monotonic() + self.tax_table_ttl, tables)
+        return tables
 
-            full_tax = ((vat_tax.bracket_end - vat_tax.bracket_start)*vat_tax.rate)//100
-            if amount >= vat_tax.bracket_end:
-                accumulated_tax += full_tax
-            else:
-                accumulated_tax += ((amount - vat_tax.bracket_start)*vat_tax.rate)//100
-            amount -= accumulated_tax
-            vat_tax.to_account.balance += accumulated_tax
-            total_cum_tax += accumulated_tax
-        return total_cum_tax
+    def _transaction_taxes(self, session: Session, from_account: Account, amount: int) -> tuple[dict[UUID, int], dict[UUID, int]]:
+        """
+        Works out the taxes on a transfer out of from_account.
+
+        :returns: The VAT owed to each receiving account, which comes out of what the recipient gets,
+                  and the transaction tax owed to each receiving account, which the sender pays on top of the amount.
+        """
+        tables = self._get_tax_tables(session, from_account.economy_id)
+        vat = tables.get((from_account.account_type, TaxType.VAT), EMPTY_TAX_TABLE).owed(amount)
+        fees = tables.get((from_account.account_type, TaxType.TRANSACTION), EMPTY_TAX_TABLE).owed(amount)
+        return vat, fees
 
 
-    def perform_tax(self, user:Member, economy: Economy):
+    @staticmethod
+    def _bracket_tax(bracket: Tax, base):
+        """The tax a single bracket levies on base as a SQL expression"""
+        full_tax = ((bracket.bracket_end - bracket.bracket_start)*bracket.rate)//100
+        return case((base >= bracket.bracket_end, full_tax),
+                    (base >= bracket.bracket_start, ((base - bracket.bracket_start)*bracket.rate)//100),
+                    else_=0)
+
+    def _apply_tax_brackets(self, session: Session, economy: Economy, tax_type: TaxType, base, reset: bool = False) -> dict[str, int]:
+        """
+        Compiles every bracket of a tax type in an economy into one piecewise expression of the tax each account owes on base,
+        then takes the per bracket revenue and any shortfall in one aggregate pass and collects the tax in one UPDATE.
+        Accounts that can't cover their bill are emptied and the shortfall is written off against the top brackets first.
+
+        :param base: The column being taxed, balance for wealth taxes and income_to_date for income taxes.
+        :param reset: Whether base should be zeroed on every account in the economy afterwards.
+        :returns: The revenue raised by each bracket, keyed on the bracket's name.
+        """
+        brackets = session.execute(select(Tax).where(Tax.tax_type == tax_type)
+                                   .where(Tax.economy_id == economy.economy_id)
+                                   .order_by(Tax.bracket_start.desc())).scalars().all()
+        scope = Account.economy_id == economy.economy_id
+        if not brackets:
+            if reset:
+                session.execute(update(Account).where(scope).values({base: 0}), execution_options={"synchronize_session": False})
+            return {}
+
+        by_type = {}
+        for bracket in brackets:
+            by_type.setdefault(bracket.affected_type, []).append(bracket)
+        owed = case(*[(Account.account_type == account_type, functools.reduce(operator.add, [self._bracket_tax(b, base) for b in type_brackets]))
+                      for account_type, type_brackets in by_type.items()], else_=0)
+        taxed = scope & or_(*[(Account.account_type == account_type) & (base >= min(b.bracket_start for b in type_brackets))
+                              for account_type, type_brackets in by_type.items()])
+        # accounts pay what they can, and an account that was already overdrawn doesn't get bailed out
+        collected = case((Account.balance >= owed, owed), (Account.balance > 0, Account.balance), else_=0)
+        shortfall = owed - collected
+
+        totals = session.execute(select(*[func.coalesce(func.sum(case((Account.account_type == b.affected_type, self._bracket_tax(b, base)), else_=0)), 0)
+                                          for b in brackets], func.coalesce(func.sum(shortfall), 0))
+                                 .where(taxed)).one()
+        revenue = dict(zip(brackets, totals[:-1]))
+        written_off = totals[-1]
+        if written_off:
+            for account_name, debt in session.execute(select(Account.account_name, shortfall).where(taxed).where(shortfall > 0)):
+                logger.log(PRIVATE_LOG, f'Economy: {economy.currency_name}\n{account_name} failed to meet their tax obligations and still owe {frmt(debt)}')
+            for bracket in brackets:
+                covered = min(revenue[bracket], written_off)
+                revenue[bracket] -= covered
+                written_off -= covered
+
+        values = {Account.balance: Account.balance - collected}
+        if reset:
+            values[base] = 0
+        session.execute(update(Account).where(scope if reset else taxed).values(values), execution_options={"synchronize_session": False})
+
+        deltas = {}
+        for bracket, raised in revenue.items():
+            deltas[bracket.to_account_id] = deltas.get(bracket.to_account_id, 0) + raised
+        self._apply_balance_deltas(session, {account_id: delta for account_id, delta in deltas.items() if delta})
+        return {bracket.tax_name: raised for bracket, raised in revenue.items()}
+
+    def perform_tax(self, user:Member, economy: Economy) -> dict[str, int]:
+        """
+        Collects every wealth and income tax in an economy, the income of every account in the economy is reset afterwards
+
+        :returns: The revenue raised by each tax bracket
+        """
         if not self.has_permission(user, Permissions.MANAGE_TAX_BRACKETS, economy=economy):
             raise BackendError("You do not have permission to trigger taxes in this economy")
-        
-        wealth_taxes = self.session.execute(select(Tax).where(Tax.tax_type==TaxType.WEALTH).where(Tax.economy_id==economy.economy_id).order_by(Tax.bracket_start.desc())).all()
-        
-        for wealth_tax in wealth_taxes:
-            wealth_tax = wealth_tax[0]
-            
-            accumulated_tax = 0
-            full_tax = ((wealth_tax.bracket_end - wealth_tax.bracket_start)*wealth_tax.rate)//100
-
-            accum = self._one_or_none(
-                                select(func.sum(((Account.balance-wealth_tax.bracket_start)*wealth_tax.rate)//100))
-                                .select_from(Account)
-                                .where(Account.account_type==wealth_tax.affected_type)
-                                .where(Account.balance >= wealth_tax.bracket_start)
-                                .where(Account.balance < wealth_tax.bracket_end))
-
-            accumulated_tax += accum if accum is not None else 0
-            self.session.execute(update(Account)
-                .where(Account.account_type == wealth_tax.affected_type)
-                .where(Account.balance >= wealth_tax.bracket_start)
-                .where(Account.balance < wealth_tax.bracket_end)
-                .values(balance=Account.balance-(((Account.balance-wealth_tax.bracket_start)*wealth_tax.rate)//100))
-            )
-
-            accum = self._one_or_none(select(func.count()).select_from(Account).where(Account.account_type == wealth_tax.affected_type).where(Account.balance >= wealth_tax.bracket_end))
-            accumulated_tax += (accum if accum is not None else 0)*full_tax
-            self.session.execute(update(Account).where(Account.account_type == wealth_tax.affected_type).where(Account.balance >= wealth_tax.bracket_end).values(balance=(Account.balance - full_tax)))
-            wealth_tax.to_account.balance += accumulated_tax
-
-        income_taxes = self.session.execute(select(Tax).where(Tax.tax_type==TaxType.INCOME).where(Tax.economy_id == economy.economy_id).order_by(Tax.bracket_start.desc())).all()
-
-        for income_tax in income_taxes:
-            income_tax = income_tax[0]
-            
-            accumulated_tax = 0
-
-            full_tax = ((income_tax.bracket_end - income_tax.bracket_start)*income_tax.rate)//100
-            accum = self._one_or_none(
-                        select(func.sum(((Account.income_to_date-income_tax.bracket_start)*income_tax.rate)//100))
-                        .select_from(Account)
-                        .where(Account.account_type == income_tax.affected_type)
-                        .where(Account.income_to_date >= income_tax.bracket_start)
-                        .where(Account.income_to_date < income_tax.bracket_end)
-                        .where(Account.economy_id == income_tax.economy_id)
-            )
-
-            self.session.execute(
-                        update(Account)
-                        .where(Account.account_type == income_tax.affected_type)
-                        .where(Account.income_to_date >= income_tax.bracket_start)
-                        .where(Account.income_to_date < income_tax.bracket_end)
-                        
-                        .values(balance=((Account.income_to_date-income_tax.bracket_start)*income_tax.rate)//100)
-            )
-            
-            accumulated_tax += accum if accum is not None else 0
-            
-            accum = self._one_or_none(select(func.count()).select_from(Account).where(Account.account_type == income_tax.affected_type).where(Account.income_to_date >= income_tax.bracket_end))
-            accumulated_tax += (accum if accum is not None else 0) * full_tax
-            self.session.execute(
-                        update(Account)
-                        .where(Account.account_type==income_tax.affected_type)
-                        .where(Account.income_to_date >= income_tax.bracket_end)
-                        .values(balance=(Account.balance - full_tax))
-            )
-            
-            debtors = self.session.execute(select(Account).where(Account.balance < 0)).all()
-            for debtor in debtors:
-                debtor = debtor[0]
-                debt = -debtor.balance
-                accumulated_tax -= debt
-                debtor.balance = 0
-                logger.log(PRIVATE_LOG, f'Economy: {debtor.economy.currency_name}\n{debtor.account_name} failed to meet their tax obligations and still owe {frmt(debt)}')
-            self.session.execute(update(Account).values(income_to_date=0))
-            income_tax.to_account.balance += accumulated_tax
-
-        logger.log(PUBLIC_LOG, f'Economy: {economy.currency_name}\n {user.mention} triggered a tax cycle')
+
+        revenue = self._apply_tax_brackets(self.session, economy, TaxType.WEALTH, Account.balance)
+        revenue.update(self._apply_tax_brackets(self.session, economy, TaxType.INCOME, Account.income_to_date, reset=True))
+
+        logger.log(PUBLIC_LOG, f'Economy: {economy.currency_name}\n {user.mention} triggered a tax cycle raising {frmt(sum(revenue.values()))}')
         
         self.session.add(Transaction(
             actor_id = user.id,
@@ -714,6 +1738,72 @@ class Backend:
         ))
 
         self.session.commit()
+        return revenue
+
+    @staticmethod
+    def _bracket_tax_array(bracket: Tax, base: np.ndarray) -> np.ndarray:
+        """_bracket_tax over an array, dividing towards zero like SQL does"""
+        full_tax = ((bracket.bracket_end - bracket.bracket_start)*bracket.rate)//100
+        partial = (base - bracket.bracket_start)*bracket.rate
+        partial = np.sign(partial)*(np.abs(partial)//100)
+        return np.where(base >= bracket.bracket_end, full_tax, np.where(base >= bracket.bracket_start, partial, 0))
+
+    def simulate_tax(self, user: Member, economy: Economy) -> dict:
+        """
+        Works out what perform_tax would do to an economy without changing anything.
+        The economy's balances and incomes are pulled out as arrays and every bracket is evaluated over them at once,
+        following the same rules as _apply_tax_brackets so the figures match a real tax cycle to the cent.
+
+        :returns: A report of the total revenue, the revenue and number of accounts affected for each bracket
+                  and the accounts that would be left unable to pay.
+        """
+        if not self.has_permission(user, Permissions.MANAGE_TAX_BRACKETS, economy=economy):
+            raise BackendError("You do not have permission to simulate taxes in this economy")
+
+        rows = self.session.execute(select(Account.account_name, Account.account_type, Account.balance, Account.income_to_date, Account.account_id)
+                                    .where(Account.economy_id == economy.economy_id)).all()
+        names = [row[0] for row in rows]
+        types = np.fromiter((row[1].value for row in rows), dtype=np.int64, count=len(rows))
+        balance = np.fromiter((row[2] for row in rows), dtype=np.int64, count=len(rows))
+        income = np.fromiter((row[3] for row in rows), dtype=np.int64, count=len(rows))
+        index = {row[4]: i for i, row in enumerate(rows)}
+
+        report = {"total": 0, "brackets": [], "debtors": []}
+        for tax_type in (TaxType.WEALTH, TaxType.INCOME):
+            base = balance if tax_type == TaxType.WEALTH else income
+            brackets = self.session.execute(select(Tax).where(Tax.tax_type == tax_type)
+                                            .where(Tax.economy_id == economy.economy_id)
+                                            .order_by(Tax.bracket_start.desc())).scalars().all()
+            owed = np.zeros(len(rows), dtype=np.int64)
+            pieces = []
+            for bracket in brackets:
+                piece = np.where(types == bracket.affected_type.value, self._bracket_tax_array(bracket, base), 0)
+                pieces.append(piece)
+                owed += piece
+
+            collected = np.where(balance >= owed, owed, np.maximum(balance, 0))
+            shortfall = owed - collected
+            written_off = int(shortfall.sum())
+            # the revenue is paid into each bracket's account before the next tax type is collected, like _apply_tax_brackets does
+            credited = np.zeros(len(rows), dtype=np.int64)
+            for bracket, piece in zip(brackets, pieces):
+                revenue = int(piece.sum())
+                covered = min(revenue, written_off)
+                written_off -= covered
+                if bracket.to_account_id in index:
+                    credited[index[bracket.to_account_id]] += revenue - covered
+                report["brackets"].append({
+                    "tax_name": bracket.tax_name,
+                    "tax_type": tax_type.name,
+                    "affected_type": bracket.affected_type.name,
+                    "accounts": int(np.count_nonzero(piece > 0)),
+                    "revenue": revenue - covered
+                })
+                report["total"] += revenue - covered
+            report["debtors"].extend({"account_name": names[i], "tax_type": tax_type.name, "owed": int(shortfall[i])}
+                                     for i in np.flatnonzero(shortfall > 0))
+            balance = balance - collected + credited
+        return report
 
 
     """Permissions"""
@@ -726,6 +1816,9 @@ class Backend:
                 .where(Permission.account_id == (account.account_id if account is not None else None))
         )
         self.session.execute(stmt)
+        self._invalidate_on_commit(self.session, self.permission_cache.invalidate, user_id, permission,
+                                   account.account_id if account is not None else None, economy.economy_id if economy is not None else None)
+        self._invalidate_on_commit(self.session, self.key_contexts.invalidate, user_id)
     
     
 
@@ -783,6 +1876,11 @@ class Backend:
         self.session.commit()
 
     def change_many_permissions(self, actor: Member, affected_id: int, *permissions, account: Account = None, economy: Economy = None, allowed: bool = True):
+        self._change_many_permissions(actor, affected_id, *permissions, account=account, economy=economy, allowed=allowed)
+        self.session.commit()
+
+    def _change_many_permissions(self, actor: Member, affected_id: int, *permissions, account: Account = None, economy: Economy = None, allowed: bool = True):
+        """change_many_permissions without the commit, so it can be part of a bigger transaction"""
         if not self.has_permission(actor, Permissions.MANAGE_PERMISSIONS, economy=economy):
             raise BackendError("You do not have permission to manage permissions here")
         for permission in permissions:
@@ -799,7 +1897,6 @@ class Backend:
                 "allowed": allowed
             })
         ))
-        self.session.commit()
 
 
     """Economies"""
@@ -876,7 +1973,9 @@ class Backend:
         if not self.has_permission(user, Permissions.MANAGE_ECONOMIES, economy=economy):
             raise BackendError("You do not have permission to delete this economy")
         self.session.execute(delete(Guild).where(Guild.economy_id == economy.economy_id))
-        
+        self._invalidate_on_commit(self.session, self.permission_cache.clear) # permissions cascade with the economy
+        self._tax_tables.pop(econ_id, None)
+
         self.session.delete(economy)
         self.session.add(Transaction(
             actor_id = user.id,
@@ -952,6 +2051,8 @@ class Backend:
             raise BackendError(f"Could not transfer account ownership: {e}.")
         else:
             return account
+        finally:
+            self.permission_cache.invalidate_account(account.account_id) # the owner's default permissions move with the account
 
     def delete_account(self, authorisor: Member, account):
         if not self.has_permission(authorisor, Permissions.CLOSE_ACCOUNT, account=account, economy=account.economy):
@@ -959,6 +2060,7 @@ class Backend:
         acc_id = account.account_id
         econ_id = account.economy.economy_id
         self.session.delete(account)
+        self._invalidate_on_commit(self.session, self.permission_cache.invalidate_account, acc_id)
         self.session.add(Transaction(
             actor_id = authorisor.id,
             economy_id = econ_id,
@@ -969,47 +2071,187 @@ class Backend:
         self.session.commit()
 
     def get_user_account(self, user_id: int, economy: Economy) -> Account | None:
-        return self._one_or_none(select(Account).where(Account.owner_id == user_id).where(Account.account_type == AccountType.USER).where(Account.economy_id == economy.economy_id).where(Account.deleted==False))
+        return self._get_user_account(self.session, user_id, economy.economy_id)
 
     def get_account_by_name(self, account_name: str, economy: Economy) -> Account | None:
-        return self._one_or_none(select(Account).where(Account.account_name == account_name).where(Account.economy_id == economy.economy_id).where(Account.deleted==False))
+        return self._get_account_by_name(self.session, account_name, economy.economy_id)
 
     def get_account_by_id(self, account_id: UUID) -> Account | None:
-        return self._one_or_none(select(Account).where(Account.account_id == account_id))
+        return self._get_account_by_id(self.session, account_id)
+
+    # Accounts returned by the async lookups outlive their session, so anything the backend reaches through them is loaded up front
+    _DETACHED_ACCOUNT_OPTIONS = (selectinload(Account.economy), selectinload(Account.update_notifiers))
+
+    async def get_user_account_async(self, user_id: int, economy: Economy) -> Account | None:
+        return await self._run_async(self._get_user_account, user_id, economy.economy_id, *self._DETACHED_ACCOUNT_OPTIONS)
+
+    async def get_account_by_name_async(self, account_name: str, economy: Economy) -> Account | None:
+        return await self._run_async(self._get_account_by_name, account_name, economy.economy_id, *self._DETACHED_ACCOUNT_OPTIONS)
+
+    async def get_account_by_id_async(self, account_id: UUID) -> Account | None:
+        return await self._run_async(self._get_account_by_id, account_id, *self._DETACHED_ACCOUNT_OPTIONS)
+
+    def _get_user_account(self, session: Session, user_id: int, economy_id: UUID, *options) -> Account | None:
+        return self._one_or_none(select(Account).options(*options).where(Account.owner_id == user_id).where(Account.account_type == AccountType.USER).where(Account.economy_id == economy_id).where(Account.deleted==False), session)
+
+    def _get_account_by_name(self, session: Session, account_name: str, economy_id: UUID, *options) -> Account | None:
+        return self._one_or_none(select(Account).options(*options).where(Account.account_name == account_name).where(Account.economy_id == economy_id).where(Account.deleted==False), session)
+
+    def _get_account_by_id(self, session: Session, account_id: UUID, *options) -> Account | None:
+        return self._one_or_none(select(Account).options(*options).where(Account.account_id == account_id), session)
+
+    def get_accounts_by_ids(self, account_ids) -> dict[UUID, Account]:
+        return self._get_accounts_by_ids(self.session, account_ids)
+
+    async def get_accounts_by_ids_async(self, account_ids) -> dict[UUID, Account]:
+        return await self._run_async(self._get_accounts_by_ids, account_ids, *self._DETACHED_ACCOUNT_OPTIONS)
+
+    def _get_accounts_by_ids(self, session: Session, account_ids, *options) -> dict[UUID, Account]:
+        """Looks up many accounts in one query, ids that don't match an account are left out"""
+        accounts = session.execute(select(Account).options(*options).where(Account.account_id.in_(set(account_ids)))).scalars()
+        return {account.account_id: account for account in accounts}
+
+    def lookup_accounts(self, account_ids, account_names, economy_id: UUID) -> list[Account]:
+        return self._lookup_accounts(self.session, account_ids, account_names, economy_id)
+
+    async def lookup_accounts_async(self, account_ids, account_names, economy_id: UUID) -> list[Account]:
+        # only the account's own columns get encoded, so there's nothing to load up front for once it's detached
+        return await self._run_async(self._lookup_accounts, account_ids, account_names, economy_id)
+
+    def _lookup_accounts(self, session: Session, account_ids, account_names, economy_id: UUID, *options) -> list[Account]:
+        """
+        Looks up accounts by id and by name in one query, names are looked up in economy_id like _get_account_by_name does.
+        Anything that doesn't match an account is left out.
+        """
+        by_name = (Account.account_name.in_(set(account_names)) & (Account.economy_id == economy_id) & (Account.deleted == False))
+        return list(session.execute(select(Account).options(*options)
+                                    .where(or_(Account.account_id.in_(set(account_ids)), by_name))).scalars())
 
 
 
     """Transfers"""
 
 
-    def get_transaction_log(self, user: Member, account: Account, limit=None): 
+    def _transaction_log_ids(self, account_id: UUID, limit=None, before: tuple[datetime, int] | None = None):
+        order = (Transaction.timestamp.desc(), Transaction.transaction_id.desc())
+        sides = []
+        for column in (Transaction.target_account_id, Transaction.destination_account_id):
+            # each side gets its own query so it can walk its own index rather than OR-ing the two columns together
+            side = select(Transaction.transaction_id).where(column == account_id).where(Transaction.action == Actions.TRANSFER).order_by(*order)
+            if before is not None:
+                side = side.where(tuple_(Transaction.timestamp, Transaction.transaction_id) < tuple_(*before))
+            side = side.limit(limit)
+            sides.append(select(side.subquery().c.transaction_id))
+        ids = union(*sides).subquery()
+        return select(ids.c.transaction_id)
+
+    def get_transaction_log(self, user: Member, account: Account, limit=None, before: tuple[datetime, int] | None = None):
+        """
+        Returns the transfers to and from an account, newest first.
+
+        :param limit: The maximum number of transactions to return.
+        :param before: A (timestamp, transaction_id) cursor, only transactions older than it are returned.
+                       Passing the timestamp and id of the last transaction of a page fetches the next page.
+        """
+        return self._get_transaction_log(self.session, user, account, limit, before)
+
+    async def get_transaction_log_async(self, user: Member, account: Account, limit=None, before: tuple[datetime, int] | None = None):
+        return await self._run_async(self._get_transaction_log, user, account, limit, before)
+
+    def _get_transaction_log(self, session: Session, user: Member, account: Account, limit=None, before: tuple[datetime, int] | None = None):
+        if not self._has_permission(session, user, Permissions.VIEW_BALANCE, account=account):
+            raise BackendError("You do not have permissions to view the transaction log on this account")
+
+        stmt = (select(Transaction)
+                .where(Transaction.transaction_id.in_(self._transaction_log_ids(account.account_id, limit, before)))
+                .order_by(Transaction.timestamp.desc(), Transaction.transaction_id.desc())
+                .limit(limit))
+        return list(session.execute(stmt).scalars())
+
+    def iter_transaction_log(self, user: Member, account: Account, limit=None, chunk_size: int = 1000):
+        """
+        Like get_transaction_log but fetches the log a chunk at a time with the account names joined in,
+        so arbitrarily long logs can be exported without loading every transaction and account into the session.
+
+        :returns: A generator of lists of (timestamp, from_name, amount, to_name) tuples, newest first.
+        """
         if not self.has_permission(user, Permissions.VIEW_BALANCE, account=account):
             raise BackendError("You do not have permissions to view the transaction log on this account")
-        stmt = select(Transaction).where((Transaction.target_account_id == account.account_id) | (Transaction.destination_account_id == account.account_id)).where(Transaction.action == Actions.TRANSFER).order_by(Transaction.timestamp.desc())
-        stmt = stmt.limit(limit)
-        r = self.session.execute(stmt)
-        results = [i[0] for i in r.all()]
-        return results
-    
 
-    
+        def chunks():
+            before = None
+            remaining = limit
+            while remaining is None or remaining > 0:
+                size = chunk_size if remaining is None else min(chunk_size, remaining)
+                chunk, before = self._transaction_log_chunk(self.session, account.account_id, size, before)
+                if chunk:
+                    yield chunk
+                if before is None:
+                    return
+                if remaining is not None:
+                    remaining -= len(chunk)
+
+        return chunks()
+
+    async def iter_transaction_log_async(self, user: Member, account: Account, limit=None, chunk_size: int = 1000):
+        """
+        iter_transaction_log for the event loop, each chunk is fetched through _run_async so the loop isn't blocked while it's read,
+        and no connection is held between chunks while the previous one is being sent.
+        """
+        if not await self.has_permission_async(user, Permissions.VIEW_BALANCE, account=account):
+            raise BackendError("You do not have permissions to view the transaction log on this account")
+
+        account_id = account.account_id
+        before = None
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk, before = await self._run_async(self._transaction_log_chunk, account_id, size, before)
+            if self.async_sessionmaker is None:
+                self.session.rollback() # ends the read so the shared session hands its connection back until the next chunk
+            if chunk:
+                yield chunk
+            if before is None:
+                return
+            if remaining is not None:
+                remaining -= len(chunk)
+
+    def _transaction_log_chunk(self, session: Session, account_id: UUID, size: int, before: tuple[datetime, int] | None):
+        """Fetches up to size rows of an account's log older than before, along with the cursor of the next chunk, None if this was the last"""
+        source = aliased(Account)
+        destination = aliased(Account)
+        stmt = (select(Transaction.timestamp, Transaction.transaction_id, Transaction.amount,
+                       source.account_type, source.owner_id, source.account_name,
+                       destination.account_type, destination.owner_id, destination.account_name)
+                .join(source, Transaction.target_account_id == source.account_id, isouter=True)
+                .join(destination, Transaction.destination_account_id == destination.account_id, isouter=True)
+                .where(Transaction.transaction_id.in_(self._transaction_log_ids(account_id, size, before)))
+                .order_by(Transaction.timestamp.desc(), Transaction.transaction_id.desc())
+                .limit(size))
+        rows = session.execute(stmt).all()
+        chunk = [(r[0], account_display_name(*r[3:6]), r[2], account_display_name(*r[6:9])) for r in rows]
+        return chunk, ((rows[-1][0], rows[-1][1]) if len(rows) == size else None)
+
     def create_recurring_transfer(self, user: Member, from_account: Account, to_account: Account, amount: int, payment_interval: int, number_of_payments: int = None, transaction_type: TransactionType = TransactionType.INCOME) -> None:
         if not self.has_permission(user, Permissions.TRANSFER_FUNDS, account=from_account, economy=from_account.economy):
             raise BackendError("You do not have permission to transfer funds on this account")
+        now = time.time()
         rec_transfer = RecurringTransfer(
                 entry_id = uuid4(),
                 authorisor_id = user.id,
                 from_account_id=from_account.account_id,
                 to_account_id = to_account.account_id,
                 amount = amount,
-                last_payment_timestamp = time.time(),
+                last_payment_timestamp = now,
                 payment_interval = payment_interval,
+                next_due = now + payment_interval,
                 transaction_type = transaction_type,
                 number_of_payments_left = number_of_payments - 1
         )
 
         self.session.add(rec_transfer)
         self.session.commit()
+        self.scheduler.schedule(rec_transfer.entry_id, rec_transfer.next_due)
         self.perform_transaction(user, rec_transfer.from_account, rec_transfer.to_account, rec_transfer.amount, rec_transfer.transaction_type)
 
     def subscribe(self, user, account):
@@ -1025,19 +2267,79 @@ class Backend:
 
         
         
-    def perform_transaction(self, user: Member, from_account: Account, to_account: Account, amount: int, transaction_type: TransactionType = TransactionType.PERSONAL):
-        """Performs a transaction from one account to another accounting for tax, returns a boolean indicating if the transaction was successful"""
-        if not self.has_permission(user, Permissions.TRANSFER_FUNDS, account=from_account, economy=from_account.economy):
+    def _apply_balance_deltas(self, session: Session, deltas: dict[UUID, int]) -> dict[UUID, int] | None:
+        """
+        Applies balance changes as atomic UPDATEs rather than reading balances into python and writing them back,
+        so concurrent writers can't lose each others updates.
+        Accounts are updated in account id order so concurrent transfers always take row locks in the same order,
+        and debits are guarded so they only apply if they would not overdraw the account.
+
+        :returns: The new balance of each account, or None if a debit would have overdrawn its account in which case the caller must roll back.
+        """
+        balances = {}
+        for account_id in sorted(deltas):
+            delta = deltas[account_id]
+            stmt = update(Account).where(Account.account_id == account_id).values(balance=Account.balance + delta).returning(Account.balance)
+            if delta < 0:
+                stmt = stmt.where(Account.balance >= -delta)
+            balance = session.execute(stmt, execution_options={"synchronize_session": False}).scalar_one_or_none()
+            if balance is None:
+                return None
+            balances[account_id] = balance
+        return balances
+
+    def _apply_balance_deltas_bulk(self, session: Session, deltas: dict[UUID, int]) -> dict[UUID, int] | None:
+        """
+        Like _apply_balance_deltas but applies every change in a single UPDATE, the caller must already hold the row locks.
+
+        :returns: The new balance of each account, or None if any debit would have overdrawn its account in which case the caller must roll back.
+        """
+        if not deltas:
+            return {}
+        change = case(deltas, value=Account.account_id)
+        stmt = (update(Account).where(Account.account_id.in_(deltas))
+                .where((change >= 0) | (Account.balance + change >= 0))
+                .values(balance=Account.balance + change)
+                .returning(Account.account_id, Account.balance))
+        balances = dict(session.execute(stmt, execution_options={"synchronize_session": False}).all())
+        return balances if len(balances) == len(deltas) else None
+
+    def perform_transaction(self, user: Member, from_account: Account, to_account: Account, amount: int, transaction_type: TransactionType = TransactionType.PERSONAL,
+                            key: APIKey | KeyContext = None, idempotency: IdempotencyClaim = None):
+        """
+        Performs a transaction from one account to another accounting for tax.
+        When an api key makes it the amount is added to what the key has spent, and the outcome of the request is recorded
+        against its idempotency claim, in the same database transaction as the transfer so either all of it happens or none of it does.
+
+        :raises SpendingLimitError: If the transfer would take the key over its spending limit.
+        :raises IdempotencyError: If the idempotency claim's lease ran out and another request has taken it over.
+        """
+        return self._perform_transaction(self.session, user, from_account, to_account, amount, transaction_type, key, idempotency)
+
+    async def perform_transaction_async(self, user: Member, from_account: Account, to_account: Account, amount: int, transaction_type: TransactionType = TransactionType.PERSONAL,
+                                        key: APIKey | KeyContext = None, idempotency: IdempotencyClaim = None):
+        return await self._run_async(self._perform_transaction, user, from_account, to_account, amount, transaction_type, key, idempotency)
+
+    def _perform_transaction(self, session: Session, user: Member, from_account: Account, to_account: Account, amount: int, transaction_type: TransactionType = TransactionType.PERSONAL,
+                             key: APIKey | KeyContext = None, idempotency: IdempotencyClaim = None):
+        if not self._has_permission(session, user, Permissions.TRANSFER_FUNDS, account=from_account, economy=from_account.economy):
             raise BackendError("You do not have permission to transfer funds from that account")
 
         if from_account.economy_id != to_account.economy_id:
             raise BackendError("Cannot transfer funds from one economy to another")
 
-        if from_account.balance < amount:
-            raise BackendError("You do not have sufficient funds to transfer from that account")
-
         if from_account.account_id == to_account.account_id:
-            return 
+            if from_account.balance < amount:
+                raise BackendError("You do not have sufficient funds to transfer from that account")
+            if key is not None or idempotency is not None:
+                self._finish_key_transfer(session, key, amount, idempotency)
+                session.commit()
+            return
+
+        vat, fees = self._transaction_taxes(session, from_account, amount)
+        cost = amount + sum(fees.values())
+        if from_account.balance < cost:
+            raise BackendError("You do not have sufficient funds to transfer from that account")
 
         transaction = Transaction(
             actor_id=user.id,
@@ -1049,27 +2351,170 @@ class Backend:
             amount=amount
         )
 
+        deltas = {}
+        for taxes in (vat, fees):
+            for account_id, owed in taxes.items():
+                deltas[account_id] = deltas.get(account_id, 0) + owed
+        received = amount - sum(vat.values())
+        deltas[from_account.account_id] = deltas.get(from_account.account_id, 0) - cost
+        deltas[to_account.account_id] = deltas.get(to_account.account_id, 0) + received
+
+        balances = self._apply_balance_deltas(session, deltas)
+        if balances is None:
+            session.rollback()
+            raise BackendError("You do not have sufficient funds to transfer from that account")
+        self._finish_key_transfer(session, key, amount, idempotency)
         if transaction_type == TransactionType.INCOME:
-            to_account.income_to_date += amount
-        from_account.balance -= amount
-        amount -= self._perform_transaction_tax(amount, transaction, from_account.economy)
-        to_account.balance += amount
-
+            income_to_date = session.execute(update(Account).where(Account.account_id == to_account.account_id)
+                                             .values(income_to_date=Account.income_to_date + amount)
+                                             .returning(Account.income_to_date),
+                                             execution_options={"synchronize_session": False}).scalar_one()
+            set_committed_value(to_account, 'income_to_date', income_to_date)
+        set_committed_value(from_account, 'balance', balances[from_account.account_id])
+        set_committed_value(to_account, 'balance', balances[to_account.account_id])
+        amount = received
 
         log = PRIVATE_LOG
-        if self.has_permission(user, Permissions.GOVERNMENT_OFFICIAL, economy=from_account.economy):
+        if self._has_permission(session, user, Permissions.GOVERNMENT_OFFICIAL, economy=from_account.economy):
             log = PUBLIC_LOG
         logger.log(log, f"Economy: {from_account.economy.currency_name}\n{user.mention} transferred {frmt(amount)} from {from_account.account_name} to {to_account.account_name}")
-        self.session.add(transaction)
+        session.add(transaction)
 
         self.notify_users(to_account.get_update_notifiers(), f"{user.mention} transferred {frmt(amount)} from {from_account.account_name} to {to_account.account_name}, \n it\'s new balance is {to_account.get_balance()}", "Balance Update")
         self.notify_users(from_account.get_update_notifiers(), f'{user.mention} transferred {frmt(amount)} from an account you watch ({from_account.account_name}), to {to_account.account_name} \n {from_account.account_name}\'s new balance is {from_account.get_balance()}', "Balance Update")
-        self.session.commit()
+        session.commit()
+
+    def _finish_key_transfer(self, session: Session, key: APIKey | KeyContext | None, amount: int, idempotency: IdempotencyClaim | None):
+        """The api key's side of a transfer, done inside the transfer's database transaction, rolls it back and raises if either part fails"""
+        if key is not None and not self._add_key_spending(session, key, amount):
+            session.rollback()
+            raise SpendingLimitError("That would take the key over its spending limit")
+        if idempotency is not None and not self._record_idempotency_outcome(session, idempotency, idempotency.status, idempotency.response):
+            session.rollback()
+            raise IdempotencyError("The idempotency key has been claimed by another request")
+
+    def perform_transactions(self, user: Member, transfers: list[tuple[Account, Account, int]], atomic: bool = True,
+                             key: APIKey | KeyContext = None, idempotency: IdempotencyClaim = None,
+                             respond: Callable[[list[str | None]], tuple[int, str]] = None) -> list[str | None]:
+        """Performs a batch of transactions in one database transaction, see _perform_transactions"""
+        return self._perform_transactions(self.session, user, transfers, atomic, key, idempotency, respond)
+
+    async def perform_transactions_async(self, user: Member, transfers: list[tuple[Account, Account, int]], atomic: bool = True,
+                                         key: APIKey | KeyContext = None, idempotency: IdempotencyClaim = None,
+                                         respond: Callable[[list[str | None]], tuple[int, str]] = None) -> list[str | None]:
+        return await self._run_async(self._perform_transactions, user, transfers, atomic, key, idempotency, respond)
+
+    def _perform_transactions(self, session: Session, user: Member, transfers: list[tuple[Account, Account, int]],
+                              atomic: bool = True, key: APIKey | KeyContext = None, idempotency: IdempotencyClaim = None,
+                              respond: Callable[[list[str | None]], tuple[int, str]] = None) -> list[str | None]:
+        """
+        Performs a batch of transfers accounting for tax, in the order given, inside a single database transaction.
+        Permissions are evaluated in one go, every balance involved is locked up front and the transfers are played out
+        in python like _tick_economy does, so the batch costs a handful of statements however many transfers are in it.
+
+        :param transfers: (from account, to account, amount) for each transfer.
+        :param atomic: If set nothing goes through unless everything can, otherwise whatever can go through does.
+        :param key: The api key the batch is made with, everything that goes through is added to its spending
+                    as a single check against its spending limit.
+        :param idempotency: A claim on an idempotency key to record the batch's outcome against in the same commit.
+        :param respond: Turns the batch's results into the (status, response) recorded against the claim.
+        :returns: For each transfer None if it went through (or would have, had an atomic batch not failed),
+                  otherwise the reason it couldn't.
+        :raises SpendingLimitError: If the batch would take the key over its spending limit, nothing goes through.
+        :raises IdempotencyError: If the claim is no longer held, nothing goes through.
+        """
+        allowed = self._evaluate_permissions(session, user, [Permissions.TRANSFER_FUNDS],
+                                             {f.account_id: f for f, _, _ in transfers}.values())
+
+        taxes = []
+        account_ids = set()
+        for from_account, to_account, amount in transfers:
+            vat, fees = {}, {}
+            if amount > 0 and from_account.economy_id == to_account.economy_id:
+                vat, fees = self._transaction_taxes(session, from_account, amount)
+            taxes.append((vat, fees))
+            account_ids |= {from_account.account_id, to_account.account_id} | vat.keys() | fees.keys()
+        balances = dict(session.execute(select(Account.account_id, Account.balance)
+                                        .where(Account.account_id.in_(account_ids))
+                                        .order_by(Account.account_id)
+                                        .with_for_update()).all())
+
+        errors, deltas, rows, done = [], {}, [], []
+        for (from_account, to_account, amount), (vat, fees) in zip(transfers, taxes):
+            cost = amount + sum(fees.values())
+            error = None
+            if not allowed[(Permissions.TRANSFER_FUNDS, from_account.account_id)]:
+                error = "You do not have permission to transfer funds from that account"
+            elif from_account.economy_id != to_account.economy_id:
+                error = "Cannot transfer funds from one economy to another"
+            elif amount <= 0:
+                error = "Cannot transfer a non-positive amount"
+            elif balances[from_account.account_id] < (amount if from_account.account_id == to_account.account_id else cost):
+                error = "You do not have sufficient funds to transfer from that account"
+            errors.append(error)
+            if error is not None or from_account.account_id == to_account.account_id:
+                continue
+
+            received = amount - sum(vat.values())
+            changes = {}
+            for tax in (vat, fees):
+                for account_id, owed in tax.items():
+                    changes[account_id] = changes.get(account_id, 0) + owed
+            changes[from_account.account_id] = changes.get(from_account.account_id, 0) - cost
+            changes[to_account.account_id] = changes.get(to_account.account_id, 0) + received
+            for account_id, change in changes.items():
+                balances[account_id] += change
+                deltas[account_id] = deltas.get(account_id, 0) + change
+            rows.append({
+                "actor_id": user.id,
+                "economy_id": from_account.economy_id,
+                "target_account_id": from_account.account_id,
+                "destination_account_id": to_account.account_id,
+                "action": Actions.TRANSFER,
+                "cud": CUD.UPDATE,
+                "amount": amount
+            })
+            done.append((from_account, to_account, received, balances[from_account.account_id], balances[to_account.account_id]))
+
+        if atomic and any(error is not None for error in errors):
+            session.rollback()
+            return errors
+
+        spent = sum(amount for (_, _, amount), error in zip(transfers, errors) if error is None)
+        if key is not None and spent and not self._add_key_spending(session, key, spent):
+            session.rollback()
+            raise SpendingLimitError("That would take the key over its spending limit")
+        if idempotency is not None and not self._record_idempotency_outcome(session, idempotency, *respond(errors)):
+            session.rollback()
+            raise IdempotencyError("The idempotency key has been claimed by another request")
+
+        new_balances = self._apply_balance_deltas_bulk(session, deltas)
+        if new_balances is None:
+            session.rollback()
+            raise BackendError("You do not have sufficient funds to transfer from that account")
+        if rows:
+            session.execute(insert(Transaction), rows)
+        for from_account, to_account, _, _, _ in done:
+            set_committed_value(from_account, 'balance', new_balances[from_account.account_id])
+            set_committed_value(to_account, 'balance', new_balances[to_account.account_id])
+
+        officials = {}
+        for from_account, to_account, received, from_balance, to_balance in done:
+            economy = from_account.economy
+            if economy.economy_id not in officials:
+                officials[economy.economy_id] = self._has_permission(session, user, Permissions.GOVERNMENT_OFFICIAL, economy=economy)
+            logger.log(PUBLIC_LOG if officials[economy.economy_id] else PRIVATE_LOG,
+                       f"Economy: {economy.currency_name}\n{user.mention} transferred {frmt(received)} from {from_account.account_name} to {to_account.account_name}")
+            self.notify_users(to_account.get_update_notifiers(), f"{user.mention} transferred {frmt(received)} from {from_account.account_name} to {to_account.account_name}, \n it\'s new balance is {frmt(to_balance)}", "Balance Update")
+            self.notify_users(from_account.get_update_notifiers(), f'{user.mention} transferred {frmt(received)} from an account you watch ({from_account.account_name}), to {to_account.account_name} \n {from_account.account_name}\'s new balance is {frmt(from_balance)}', "Balance Update")
+        session.commit()
+        return errors
 
     def print_money(self, user: Member, to_account: Account, amount: int):
         if not self.has_permission(user, Permissions.MANAGE_FUNDS, account=to_account, economy=to_account.economy):
             raise BackendError("You do not have permission to print funds")
-        to_account.balance += amount
+        balances = self._apply_balance_deltas(self.session, {to_account.account_id: amount})
+        set_committed_value(to_account, 'balance', balances[to_account.account_id])
         logger.log(PUBLIC_LOG, f'Economy: {to_account.economy.currency_name}\n{user.mention} printed {frmt(amount)} to {to_account.account_name}')
         self.session.add(Transaction(
             actor_id = user.id,
@@ -1085,9 +2530,11 @@ class Backend:
     def remove_funds(self, user: Member, from_account: Account, amount: int):
         if not self.has_permission(user, Permissions.MANAGE_FUNDS, account=from_account, economy=from_account.economy):
             raise BackendError("You do not have permission to remove funds")
-        if from_account.balance < amount:
+        balances = self._apply_balance_deltas(self.session, {from_account.account_id: -amount})
+        if balances is None:
+            self.session.rollback()
             raise BackendError("There are not sufficient funds in this account to perform this action")
-        from_account.balance -= amount
+        set_committed_value(from_account, 'balance', balances[from_account.account_id])
         logger.log(PUBLIC_LOG, f'Economy: {from_account.economy.currency_name}\n {user.mention} removed {frmt(amount)} from {from_account.account_name}')
         self.session.add(Transaction(
             actor_id = user.id,
@@ -1100,8 +2547,120 @@ class Backend:
         self.notify_users(from_account.get_update_notifiers(), f'{user.mention} removed {frmt(amount)} from {from_account.account_name},\n it\'s new balance is {from_account.get_balance()}', "Balance Update")
         self.session.commit()
 
+    def add_key_spending(self, key: APIKey | KeyContext, amount: int) -> bool:
+        """
+        Adds to what a key has spent, refusing to take it over the key's spending limit.
+        The check is done by the update itself so concurrent requests (or api workers) can't overspend between them.
+
+        :returns: Whether the spending was recorded.
+        """
+        if not self._add_key_spending(self.session, key, amount):
+            self.session.rollback()
+            return False
+        self.session.commit()
+        return True
+
+    def _add_key_spending(self, session: Session, key: APIKey | KeyContext, amount: int) -> bool:
+        """add_key_spending without the commit, so it can be part of a bigger transaction"""
+        spent = func.coalesce(APIKey.spent_to_date, 0) + amount
+        stmt = update(APIKey).where(APIKey.key_id == key.key_id).values(spent_to_date=spent).returning(APIKey.spent_to_date)
+        if key.spending_limit is not None and amount > 0:
+            stmt = stmt.where(spent <= key.spending_limit)
+        spent_to_date = session.execute(stmt, execution_options={"synchronize_session": False}).scalar_one_or_none()
+        if spent_to_date is None:
+            return False
+        if isinstance(key, APIKey):
+            set_committed_value(key, 'spent_to_date', spent_to_date)
+        return True
+
+    def claim_idempotency_key(self, claim: IdempotencyClaim, request_hash: str) -> IdempotencyRecord | None:
+        """
+        Claims an idempotency key for a request an api key is about to make.
+        The claim is only leased for idempotency_lease seconds until an outcome is recorded against it, so a request that died
+        without recording one only holds its retries up for that long, recorded outcomes are kept for idempotency_ttl seconds.
+        Expired records are cleared out every so often rather than on every claim so the hot path only pays for the insert.
+
+        :returns: None if the idempotency key was free and now belongs to the caller, who should record the outcome by passing the claim
+                  to perform_transaction or finish_idempotency_key, otherwise the record of the earlier request made with it,
+                  whose status is None if that request hasn't finished.
+        """
+        session = self.session
+        now = time.time()
+        expired = IdempotencyRecord.expires_at <= now
+        if now >= self._idempotency_purge_due:
+            self._idempotency_purge_due = now + min(self.idempotency_ttl, 60)
+            session.execute(delete(IdempotencyRecord).where(expired))
+        else:
+            session.execute(delete(IdempotencyRecord).where(IdempotencyRecord.key_id == claim.key_id)
+                            .where(IdempotencyRecord.idempotency_key == claim.idempotency_key).where(expired))
+        try:
+            session.execute(insert(IdempotencyRecord).values(key_id=claim.key_id, idempotency_key=claim.idempotency_key, claim_id=claim.claim_id,
+                                                             request_hash=request_hash, expires_at=now + self.idempotency_lease))
+            session.commit()
+            return None
+        except IntegrityError:
+            session.rollback()
+        record = session.execute(select(IdempotencyRecord).where(IdempotencyRecord.key_id == claim.key_id)
+                                 .where(IdempotencyRecord.idempotency_key == claim.idempotency_key)).scalar_one_or_none()
+        # the request holding it may have been released since the insert clashed
+        return record if record is not None else self.claim_idempotency_key(claim, request_hash)
+
+    def _record_idempotency_outcome(self, session: Session, claim: IdempotencyClaim, status: int, response: str) -> bool:
+        """Records the outcome against a claim without committing, returns False if the claim is no longer held"""
+        stmt = (update(IdempotencyRecord).where(IdempotencyRecord.key_id == claim.key_id)
+                .where(IdempotencyRecord.idempotency_key == claim.idempotency_key)
+                .where(IdempotencyRecord.claim_id == claim.claim_id).where(IdempotencyRecord.status.is_(None))
+                .values(status=status, response=response, expires_at=time.time() + self.idempotency_ttl))
+        return session.execute(stmt, execution_options={"synchronize_session": False}).rowcount == 1
+
+    def finish_idempotency_key(self, claim: IdempotencyClaim, status: int, response: str):
+        """Records the outcome of a request that failed before it changed anything, so retries of it get the same answer"""
+        self._record_idempotency_outcome(self.session, claim, status, response)
+        self.session.commit()
+
+    def release_idempotency_key(self, claim: IdempotencyClaim):
+        """
+        Gives up a claim so the request can be retried, unless an outcome was recorded against it,
+        which only happens in the same database transaction as the request's changes, in which case they went through and it's kept.
+        """
+        self.session.rollback()
+        self.session.execute(delete(IdempotencyRecord).where(IdempotencyRecord.key_id == claim.key_id)
+                             .where(IdempotencyRecord.idempotency_key == claim.idempotency_key)
+                             .where(IdempotencyRecord.claim_id == claim.claim_id).where(IdempotencyRecord.status.is_(None)))
+        self.session.commit()
+
+    def issue_granted_key(self, grant_store: GrantStore, application: Application, ref_id: UUID) -> APIKey | None:
+        """
+        Creates the key an application was granted for a reference, taking the grant out of the store in the same database transaction,
+        so two api workers can't both create a key for it and a failure part way leaves the grant to be retrieved again.
+
+        :returns: The new key, or None if the grant has already been claimed.
+        """
+        state = grant_store.pop(application.application_id, ref_id)
+        if state is None:
+            return None
+        try:
+            data = state['request_data']
+            key = APIKey(application=application, internal_app_id=ref_id, issuer_id=state.get('issuer_id'), spending_limit=data.get('spending_limit'))
+            self.session.add(key)
+            self.session.flush() # the key needs its id before permissions can be given to it
+            key.activate()
+            for account_id, permissions in data['permissions'].items():
+                self._change_many_permissions(StubUser(CONSOLE_USER_ID), key.key_id, *[Permissions[p] for p in permissions],
+                                              account=self.get_account_by_id(UUID(account_id)))
+            self.session.commit()
+        except BaseException:
+            self.session.rollback()
+            grant_store.restore(application.application_id, ref_id, state)
+            raise
+        return key
+
     def delete_key(self, key):
         self.session.execute(Delete(Permission).where(Permission.user_id == key.key_id))
+        self.session.execute(Delete(IdempotencyRecord).where(IdempotencyRecord.key_id == key.key_id))
+        self._invalidate_on_commit(self.session, self.permission_cache.invalidate_subject, key.key_id)
+        self.token_cache.invalidate_key(key.key_id)
+        self.key_contexts.invalidate(key.key_id)
         self.session.delete(key)
         self.session.commit()
 
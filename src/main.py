@@ -2,16 +2,19 @@
 import asyncio
 import sys
 from utils import load_config, syncing, generate_transaction_csv
-from middleman import BackendError, Account, Permissions, AccountType, TransactionType, TaxType, frmt
+from middleman import BackendError, Permissions, AccountType, TransactionType, TaxType, frmt
 from middleman import DiscordBackendInterface as Backend
 import datetime
+import functools
+import itertools
 import logging
 import aiohttp
 import re
 import textwrap
 from enum import Enum
+from uuid import UUID
 
-from discord.ext import tasks, commands
+from discord.ext import commands
 from discord import app_commands
 from discord import Webhook
 
@@ -98,10 +101,7 @@ test_guild = None # discord.Object(id=1236137485554155612)  # Change to None for
 intents = discord.Intents.default()
 intents.message_content = True
 
-login_map: dict[int, Account] = {}
-
-tick_time = datetime.time(hour=0,
-                          minute=0)  # tick at midnight UTC, might update this to twice a day if I feel like it or even once an hour, we'll see how I feel
+login_map: dict[int, UUID] = {}  # maps users to the id of the account they're logged in as, ORM objects don't outlive the unit of work they were loaded in
 
 backend: Backend = None  # pyright: ignore
 # Stop any fucky undefined errors
@@ -117,7 +117,8 @@ def get_account(member):
     if economy is None:
         return None
 
-    acc = login_map.get(member.id)
+    acc_id = login_map.get(member.id)
+    acc = backend.get_account_by_id(acc_id) if acc_id is not None else None
     if acc is not None and acc.economy_id != economy.economy_id:
         acc = None
 
@@ -186,14 +187,21 @@ def parse_amount(amount: str) -> int:
 bot = commands.Bot(intents=intents, help_command=None, command_prefix='!')
 
 
-@tasks.loop(time=tick_time)
-async def tick():
-    await backend.tick()
+def unit_of_work(command):
+    """
+    Runs a command inside its own backend unit of work
+    """
+
+    @functools.wraps(command)
+    async def wrapper(*args, **kwargs):
+        with backend.unit_of_work():
+            return await command(*args, **kwargs)
+    return wrapper
 
 
 @bot.event
 async def on_ready():
-    await backend.tick()
+    backend.scheduler.start()  # pays anything that fell due while we were offline straight away
     if syncing:
         sync = await bot.tree.sync(guild=test_guild)
         print(f'Synced {len(sync)} command(s)')
@@ -210,15 +218,16 @@ async def on_ready():
 
 @bot.tree.command(name="ping", description="ping the bot to check if it's online", guild=test_guild)
 @app_commands.describe(isalive="Give a simpler response to only check if we can talk to discord, useful if DB is really broken")
+@unit_of_work
 async def ping(interaction: discord.Interaction, isalive: bool = False):
     if isalive:
         await interaction.response.send_message(f'Pong!')
         return
 
     now = datetime.datetime.now(datetime.timezone.utc)
-    keys = ["Connected to Discord: ", "Backend Exists: ", "Connected to Database: ", "Ping: ", "Uptime: "]
+    keys = ["Connected to Discord: ", "Backend Exists: ", "Connected to Database: ", "Ping: ", "Uptime: ", "Notifications: "]
     values = [True, backend is not None, backend is not None, str(round((now - interaction.created_at).microseconds / 1000)) + 'ms',
-              str(datetime.datetime.now() - init_time)]
+              str(datetime.datetime.now() - init_time), '-']
     good = True
     if backend is not None:
         try:
@@ -231,6 +240,8 @@ async def ping(interaction: discord.Interaction, isalive: bool = False):
         except:
             values[2] = False
             good = False
+        stats = backend.notifier.stats()
+        values[5] = f"{stats['queue_depth']} queued, {stats['dropped']} dropped"
     else:
         good = False
 
@@ -254,6 +265,7 @@ async def ping(interaction: discord.Interaction, isalive: bool = False):
 @bot.tree.command(name="create_economy", description="Creates a new economy", guild=test_guild)
 @app_commands.describe(economy_name="The name of the economy")
 @app_commands.describe(currency_unit="The unit of currency to be used in the economy")
+@unit_of_work
 async def create_economy(interaction: discord.Interaction, economy_name: str, currency_unit: str):
     responder = backend.get_responder(interaction)
     try:
@@ -265,6 +277,7 @@ async def create_economy(interaction: discord.Interaction, economy_name: str, cu
 
 @bot.tree.command(name="list_economies", description="lists all of the currently registered economies",
                   guild=test_guild)
+@unit_of_work
 async def list_economies(interaction: discord.Interaction):
     responder = backend.get_responder(interaction)
     economies = backend.get_economies()
@@ -281,6 +294,7 @@ async def list_economies(interaction: discord.Interaction):
 @bot.tree.command(name='join_economy', description="registers this guild as a member of a named economy",
                   guild=test_guild)
 @app_commands.describe(economy_name="The name of the economy you want to join")
+@unit_of_work
 async def join_economy(interaction: discord.Interaction, economy_name: str):
     responder = backend.get_responder(interaction)
     economy = backend.get_economy_by_name(economy_name)
@@ -293,6 +307,7 @@ async def join_economy(interaction: discord.Interaction, economy_name: str):
 
 @bot.tree.command(name='delete_economy', description="Deletes an economy", guild=test_guild)
 @app_commands.describe(economy_name='The name of the economy')
+@unit_of_work
 async def delete_economy(interaction: discord.Interaction, economy_name: str):
     responder = backend.get_responder(interaction)
     economy = backend.get_economy_by_name(economy_name)
@@ -309,6 +324,7 @@ async def delete_economy(interaction: discord.Interaction, economy_name: str):
 
 @bot.tree.command(name="link", description="Links your mc account with taubot", guild=test_guild)
 @app_commands.describe(token="The token generated by running /link on the mc server")
+@unit_of_work
 async def link_account(interaction: discord.Interaction, token: str):
     responder = backend.get_responder(interaction)
     try:
@@ -319,6 +335,7 @@ async def link_account(interaction: discord.Interaction, token: str):
 
 
 @bot.tree.command(name='open_account', description="opens a user account in this guild's economy", guild=test_guild)
+@unit_of_work
 async def create_account(interaction: discord.Interaction):
     responder = backend.get_responder(interaction)
     economy = backend.get_guild_economy(interaction.guild.id)
@@ -334,6 +351,7 @@ async def create_account(interaction: discord.Interaction):
 
 @app_commands.describe(new_owner="The new owner of the account.", account_name="The account you wish to transfer your ownership of. Defaults to the current logged in account.")
 @bot.tree.command(name='transfer_ownership', description="Transfers your ownership of an account to another user.", guild=test_guild)
+@unit_of_work
 async def transfer_ownership(interaction: discord.Interaction, new_owner: discord.Member, account_name: str | None):
     responder = backend.get_responder(interaction)
     economy = backend.get_guild_economy(interaction.guild.id)
@@ -366,7 +384,7 @@ async def transfer_ownership(interaction: discord.Interaction, new_owner: discor
         else:
             user_acc = backend.get_account_from_interaction(interaction)
             if user_acc:
-                login_map[interaction.user.id] = user_acc
+                login_map[interaction.user.id] = user_acc.account_id
             await responder(message=f"Transferred account ownership to {new_owner.mention}.", edit=True, view=None)
     else:
         await responder(message=f"Cancelled operation.", edit=True, view=None)
@@ -374,6 +392,7 @@ async def transfer_ownership(interaction: discord.Interaction, new_owner: discor
 @bot.tree.command(name='login', description="login to an account that is not your's in order to act as your behalf",
                   guild=test_guild)
 @app_commands.describe(account_name="The account to login as")
+@unit_of_work
 async def login(interaction: discord.Interaction, account_name: str | None):
     responder = backend.get_responder(interaction)
     economy = backend.get_guild_economy(interaction.guild.id)
@@ -389,12 +408,13 @@ async def login(interaction: discord.Interaction, account_name: str | None):
         await responder(message=f'You do not have permission to login as {account.account_name}', colour=red())
         return
 
-    login_map[interaction.user.id] = account
+    login_map[interaction.user.id] = account.account_id
     await responder(
         message=f'You have now logged in as {account.account_name}\n To log back into your user account simply run `/login` without any arguments')
 
 
 @bot.tree.command(name='whoami', description="tells you who you are logged in as", guild=test_guild)
+@unit_of_work
 async def whoami(interaction: discord.Interaction):
     me = get_account(interaction.user)
     responder = backend.get_responder(interaction)
@@ -409,6 +429,7 @@ async def whoami(interaction: discord.Interaction):
 @app_commands.describe(owner="The owner of the new account")
 @app_commands.describe(account_name="The name of the account to open")
 @app_commands.describe(account_type="The type of account to open")
+@unit_of_work
 async def open_special_account(interaction: discord.Interaction, owner: discord.Member | discord.Role | None,
                                account_name: str, account_type: AccountType):
     responder = backend.get_responder(interaction)
@@ -428,6 +449,7 @@ async def open_special_account(interaction: discord.Interaction, owner: discord.
 
 @bot.tree.command(name="close_account", guild=test_guild)
 @app_commands.describe(account_name="The name of the account you want to close")
+@unit_of_work
 async def close_account(interaction: discord.Interaction, account_name: str | None):
     responder = backend.get_responder(interaction)
     economy = backend.get_guild_economy(interaction.guild.id)
@@ -448,6 +470,7 @@ async def close_account(interaction: discord.Interaction, account_name: str | No
 
 
 @bot.tree.command(name='balance', guild=test_guild)
+@unit_of_work
 async def get_balance(interaction: discord.Interaction):
     responder = backend.get_responder(interaction)
     economy = backend.get_guild_economy(interaction.guild.id)
@@ -460,7 +483,7 @@ async def get_balance(interaction: discord.Interaction):
         await responder(message='You do not have an account in this economy', colour=red())
         return
 
-    if backend.has_permission(interaction.user, Permissions.VIEW_BALANCE, account=account, economy=economy):
+    if await backend.has_permission_async(interaction.user, Permissions.VIEW_BALANCE, account=account, economy=economy):
         await responder(message=f'The balance on {account.account_name} is : {account.get_balance()}')
     else:
         await responder(message=f'You do not have permission to view the balance of {account.account_name}')
@@ -470,6 +493,7 @@ async def get_balance(interaction: discord.Interaction):
 @app_commands.describe(amount="The amount to transfer")
 @app_commands.describe(to_account="The account to transfer the funds too")
 @app_commands.describe(transaction_type="The type of transfer that is being performed")
+@unit_of_work
 async def transfer_funds(interaction: discord.Interaction, amount: str, to_account: str,
                          transaction_type: TransactionType = TransactionType.PERSONAL):
     responder = backend.get_responder(interaction)
@@ -488,7 +512,7 @@ async def transfer_funds(interaction: discord.Interaction, amount: str, to_accou
         return
 
     try:
-        backend.perform_transaction(interaction.user, from_account, to_account, parse_amount(amount), transaction_type)
+        await backend.perform_transaction_async(interaction.user, from_account, to_account, parse_amount(amount), transaction_type)
         await responder('Successfully performed transaction')
     except (BackendError, ParseException) as e:
         await responder(message=f'Failed to perform transaction due to : {e}', colour=red())
@@ -500,6 +524,7 @@ async def transfer_funds(interaction: discord.Interaction, amount: str, to_accou
 @app_commands.describe(payment_interval="How often you want to perform the transaction in days")
 @app_commands.describe(number_of_payments="The number of payments you want to make")
 @app_commands.describe(transaction_type="The type of transfer that is being performed")
+@unit_of_work
 async def create_recurring_transfer(interaction: discord.Interaction, amount: str, to_account: str,
                                     payment_interval: int, number_of_payments: int | None,
                                     transaction_type: TransactionType = TransactionType.PERSONAL):
@@ -534,6 +559,7 @@ async def create_recurring_transfer(interaction: discord.Interaction, amount: st
 
 @bot.tree.command(name='view_permissions', guild=test_guild)
 @app_commands.describe(user='The user you want to view the permissions of')
+@unit_of_work
 async def view_permissions(interaction: discord.Interaction, user: discord.Member | discord.Role):
     responder = backend.get_responder(interaction)
     economy = backend.get_guild_economy(interaction.guild.id)
@@ -560,6 +586,7 @@ class PermissionState(Enum):
 @app_commands.describe(account="The account the permission should apply too")
 @app_commands.describe(state="The state you want to update the permission too")
 @app_commands.describe(universal="Whether or not the scope is restricted to this economy")
+@unit_of_work
 async def update_permissions(interaction: discord.Interaction, affects: discord.Member | discord.Role,
                              permission: Permissions, state: PermissionState, account: str | None,
                              universal: bool = False):
@@ -585,6 +612,7 @@ async def update_permissions(interaction: discord.Interaction, affects: discord.
 @bot.tree.command(name="print_money", guild=test_guild)
 @app_commands.describe(to_account="The account you want to give money too")
 @app_commands.describe(amount="The amount you want to print")
+@unit_of_work
 async def print_money(interaction: discord.Interaction, to_account: str, amount: str):
     economy = backend.get_guild_economy(interaction.guild.id)
     responder = backend.get_responder(interaction)
@@ -608,6 +636,7 @@ async def print_money(interaction: discord.Interaction, to_account: str, amount:
 @bot.tree.command(name="remove_funds", guild=test_guild)
 @app_commands.describe(from_account="The account you want to remove funds from")
 @app_commands.describe(amount="The amount you want to remove")
+@unit_of_work
 async def remove_funds(interaction: discord.Interaction, from_account: str, amount: str):
     responder = backend.get_responder(interaction)
     economy = backend.get_guild_economy(interaction.guild.id)
@@ -631,11 +660,12 @@ async def remove_funds(interaction: discord.Interaction, from_account: str, amou
 @bot.tree.command(name="create_tax_bracket", guild=test_guild)
 @app_commands.describe(tax_name="The name of the tax bracket you want to create")
 @app_commands.describe(affected_type="The type of account that is affected by your tax")
-@app_commands.describe(tax_type="The type of tax you wish to create")
+@app_commands.describe(tax_type="The type of tax you wish to create, VAT comes out of transfers and transaction taxes are paid on top of them")
 @app_commands.describe(bracket_start="The starting point for the tax bracket")
 @app_commands.describe(bracket_end="The ending point for the tax bracket")
 @app_commands.describe(rate="The % of the income between the brackets that you wish to tax")
 @app_commands.describe(to_account="The account you wish to send the revenue from taxation too")
+@unit_of_work
 async def create_tax_bracket(interaction: discord.Interaction, tax_name: str, affected_type: AccountType,
                              tax_type: TaxType, bracket_start: str, bracket_end: str, rate: int, to_account: str):
     economy = backend.get_guild_economy(interaction.guild.id)
@@ -660,6 +690,7 @@ async def create_tax_bracket(interaction: discord.Interaction, tax_name: str, af
 
 @bot.tree.command(name="delete_tax_bracket", guild=test_guild)
 @app_commands.describe(tax_name="The name of the tax bracket you want to delete")
+@unit_of_work
 async def delete_tax_bracket(interaction: discord.Interaction, tax_name: str):
     economy = backend.get_guild_economy(interaction.guild.id)
     responder = backend.get_responder(interaction)
@@ -674,6 +705,7 @@ async def delete_tax_bracket(interaction: discord.Interaction, tax_name: str):
 
 
 @bot.tree.command(name="perform_tax", guild=test_guild)
+@unit_of_work
 async def perform_tax(interaction: discord.Interaction):
     economy = backend.get_guild_economy(interaction.guild.id)
     responder = backend.get_responder(interaction)
@@ -681,15 +713,39 @@ async def perform_tax(interaction: discord.Interaction):
         await responder(message='This guild is not registered to an economy', colour=red())
         return
     try:
-        backend.perform_tax(interaction.user, economy)
-        await responder(message='Tax performed succesfully', colour=red())
+        revenue = backend.perform_tax(interaction.user, economy)
+        await responder(message=f'Tax performed succesfully, raising {frmt(sum(revenue.values()))}', colour=red())
     except BackendError as e:
         await responder(
             message=f'could not perform taxes due to : {e}\n note: no changes have been made to any balances',
             colour=red())
 
 
+@bot.tree.command(name="simulate_tax", description="See what a tax cycle would raise without performing it", guild=test_guild)
+@unit_of_work
+async def simulate_tax(interaction: discord.Interaction):
+    economy = backend.get_guild_economy(interaction.guild.id)
+    responder = backend.get_responder(interaction)
+    if economy is None:
+        await responder(message='This guild is not registered to an economy', colour=red())
+        return
+    try:
+        report = backend.simulate_tax(interaction.user, economy)
+    except BackendError as e:
+        await responder(message=f'Could not simulate taxes due to : {e}', colour=red())
+        return
+
+    lines = [f"{b['tax_name']}: {frmt(b['revenue'])} from {b['accounts']} accounts" for b in report['brackets']]
+    lines.append(f"Total: {frmt(report['total'])}")
+    if report['debtors']:
+        owed = sum(d['owed'] for d in report['debtors'])
+        lines.append(f"{len(report['debtors'])} accounts would be left owing {frmt(owed)}")
+    message = '\n'.join(lines)
+    await responder(message=message if len(message) <= 1024 else message[:1020] + '...')
+
+
 @bot.tree.command(name='toggle_ephemeral', guild=test_guild)
+@unit_of_work
 async def toggle_ephemeral(interaction: discord.Interaction):
     responder = backend.get_responder(interaction)
     backend.toggle_ephemeral(interaction.user)
@@ -701,6 +757,7 @@ async def toggle_ephemeral(interaction: discord.Interaction):
     account="The account you want to view the transaction logs of, leave empty to default to the account your currently logged in as.",
     limit="The number of transactions back you wish too see (note: will not show transactions before this feature was added).",
     as_csv="Whether you wish to view the transaction log as a CSV file.")
+@unit_of_work
 async def view_transaction_log(interaction: discord.Interaction, account: str | None, limit: int = 10, as_csv: bool = False):
     economy = backend.get_guild_economy(interaction.guild.id)
     responder = backend.get_responder(interaction)
@@ -711,24 +768,26 @@ async def view_transaction_log(interaction: discord.Interaction, account: str |
     account = get_account_from_name(account, economy)
     account = account if account is not None else get_account(interaction.user)
     try:
-        transactions = backend.get_transaction_log(interaction.user, account, limit=limit)
+        chunks = backend.iter_transaction_log(interaction.user, account, limit=limit)
     except BackendError as e:
         return await responder(message=f"{e}")
 
-    if len(transactions) == 0:
+    first = next(chunks, None)
+    if first is None:
         await responder(message='No transactions have been logged yet')
     else:
         if as_csv:
-            file = generate_transaction_csv(transactions, currency=economy.currency_unit)
-            await responder(message=f'Logged latest `{len(transactions)}` transaction(s).', as_embed=False, file=file)
+            file, count = generate_transaction_csv(itertools.chain([first], chunks), currency=economy.currency_unit)
+            await responder(message=f'Logged latest `{count}` transaction(s).', as_embed=False, file=file)
         else:
             entries = '\n'.join([
-                                f'{t.timestamp.strftime("%d/%m/%y %H:%M")} {t.target_account.get_name()} --{frmt(t.amount)}{economy.currency_unit}-> {t.destination_account.get_name()}'
-                                for t in transactions])
+                                f'{timestamp.strftime("%d/%m/%y %H:%M")} {from_name} --{frmt(amount)}{economy.currency_unit}-> {to_name}'
+                                for chunk in itertools.chain([first], chunks) for timestamp, from_name, amount, to_name in chunk])
             await responder(message=entries)
 
 @bot.tree.command(name="subscribe", guild=test_guild)
 @app_commands.describe(account="The account you want to get balance update notifications for")
+@unit_of_work
 async def subscribe(interaction: discord.Interaction, account: str):
     economy = backend.get_guild_economy(interaction.guild.id)
     responder = backend.get_responder(interaction)
@@ -744,6 +803,7 @@ async def subscribe(interaction: discord.Interaction, account: str):
 
 @bot.tree.command(name="unsubscribe", guild=test_guild)
 @app_commands.describe(account="The account you want to unsubscribe from.")
+@unit_of_work
 async def unsubscribe(interaction: discord.Interaction, account: str):
     economy = backend.get_guild_economy(interaction.guild.id)
     responder = backend.get_responder(interaction)
@@ -768,7 +828,12 @@ if __name__ == '__main__':
     config = load_config()
     db_path = config.get('database_uri')
     db_path = db_path if db_path else 'sqlite:///database.db'
-    backend = Backend(bot, db_path)
+    backend = Backend(bot, db_path, member_cache_ttl=config.get('member_cache_ttl', 60),
+                      notification_window=config.get('notification_window', 2), notification_queue_size=config.get('notification_queue_size', 10000),
+                      async_mode=config.get('database_mode') == 'async',
+                      pool_size=config.get('database_pool_size'), max_overflow=config.get('database_max_overflow'),
+                      tick_concurrency=config.get('tick_concurrency', 4), token_cache_size=config.get('api_token_cache_size', 4096),
+                      tick_summary_interval=config.get('tick_summary_interval', 60*60*24))
     token = config.get('discord_token')
     if not token:
         logger.log(logging.CRITICAL, "Discord token not found in the config file")
@@ -785,4 +850,7 @@ if __name__ == '__main__':
     if private_webhook_url:
         setup_webhook(backend_logger, private_webhook_url, 51)
 
-    bot.run(token, log_handler=None)
+    try:
+        bot.run(token, log_handler=None)
+    finally:
+        backend.close()
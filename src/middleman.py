@@ -1,26 +1,277 @@
 import discord
 import asyncio
-import typing
-from backend import Backend, Permissions, BackendError, Account, AccountType, TransactionType, TaxType, frmt
+import time
+from collections import OrderedDict, deque
+from backend import logger, Backend, Permissions, BackendError, Account, AccountType, TransactionType, TaxType, frmt
 
-def loop_adder(func: typing.Callable[..., typing.Coroutine]):
+class MemberResolver:
     """
-    Decorator that schedules an async function to run in the event loop as a task.
-    :param func: The coroutine to be scheduled.
-    :returns: A wrapped function that schedules the original coroutine as a task when called.
+    Resolves guild members, checking the gateway cache first, then a TTL cache of members previously
+    fetched over REST, and only then falling back to the REST API.
+    Concurrent lookups of the same member share a single REST call.
     """
-    def execute(*args, **kwargs):
-        asyncio.get_event_loop().create_task(func(*args, **kwargs))
-    return execute
+
+    def __init__(self, bot: discord.Client, ttl: float = 60, max_size: int = 4096):
+        self.bot = bot
+        self.ttl = ttl
+        self.max_size = max_size
+        self.gateway_hits = 0
+        self.cache_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._members: OrderedDict = OrderedDict()
+        self._guilds: dict[int, tuple[float, discord.Guild]] = {}
+        self._pending: dict[tuple[int, int], asyncio.Task] = {}
+
+    async def get_member(self, user_id: int, guild_id: int):
+        guild = self.bot.get_guild(guild_id)
+        if guild is not None:
+            member = guild.get_member(user_id)
+            if member is not None:
+                self.gateway_hits += 1
+                return member
+
+        key = (guild_id, user_id)
+        entry = self._members.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._members.move_to_end(key)
+                self.cache_hits += 1
+                return entry[1]
+            del self._members[key]
+
+        task = self._pending.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch_member(user_id, guild_id, guild))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch_member(self, user_id: int, guild_id: int, guild: discord.Guild | None):
+        if guild is None:
+            entry = self._guilds.get(guild_id)
+            if entry is not None and entry[0] > time.monotonic():
+                guild = entry[1]
+            else:
+                guild = await self.bot.fetch_guild(guild_id)
+                if guild is None:
+                    return None
+                self._guilds[guild_id] = (time.monotonic() + self.ttl, guild)
+
+        member = await guild.fetch_member(user_id)
+        if member is not None:
+            self._members[(guild_id, user_id)] = (time.monotonic() + self.ttl, member)
+            while len(self._members) > self.max_size:
+                self._members.popitem(last=False)
+        return member
+
+    def invalidate(self, user_id: int, guild_id: int):
+        self._members.pop((guild_id, user_id), None)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "gateway_hits": self.gateway_hits,
+            "cache_hits": self.cache_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "size": len(self._members)
+        }
+
+
+class RateLimiter:
+    """
+    Paces calls to discord so we stay under its rate limits instead of relying on 429s,
+    a global bucket shared by every call plus a bucket per route key (e.g. a channel id).
+    """
+
+    def __init__(self, global_rate: int = 40, global_per: float = 1, route_rate: int = 5, route_per: float = 5):
+        self.global_rate = global_rate
+        self.global_per = global_per
+        self.route_rate = route_rate
+        self.route_per = route_per
+        self.waited = 0.0
+        self._global: deque = deque()
+        self._routes: dict[object, deque] = {}
+
+    @staticmethod
+    def _delay(calls: deque, rate: int, per: float, now: float) -> float:
+        while calls and calls[0] <= now - per:
+            calls.popleft()
+        return 0 if len(calls) < rate else calls[0] + per - now
+
+    async def acquire(self, route=None):
+        while True:
+            now = time.monotonic()
+            calls = self._routes.setdefault(route, deque()) if route is not None else None
+            delay = self._delay(self._global, self.global_rate, self.global_per, now)
+            if calls is not None:
+                delay = max(delay, self._delay(calls, self.route_rate, self.route_per, now))
+            if delay <= 0:
+                self._global.append(now)
+                if calls is not None:
+                    calls.append(now)
+                break
+            self.waited += delay
+            await asyncio.sleep(delay)
+
+        # routes that have gone quiet don't need remembering
+        if len(self._routes) > 1024:
+            for key in [k for k, v in self._routes.items() if not v or v[-1] <= now - self.route_per]:
+                del self._routes[key]
+
+
+class Notification:
+    def __init__(self, due: float, thumbnail=None):
+        self.due = due
+        self.thumbnail = thumbnail
+        self.updates: list[tuple[str, str]] = []
+        self.overflow = 0
+
+
+class NotificationDispatcher:
+    """
+    Delivers DM notifications from a bounded queue drained by a few worker tasks.
+    Updates to the same user made within `window` seconds of each other are merged into one embed,
+    DM channel ids are cached so we don't have to fetch the user and open the DM every time
+    and sends are paced by a RateLimiter.
+    """
+
+    MAX_FIELDS = 25  # discord's limit on fields per embed
+    MAX_FIELD_LENGTH = 1024
+
+    def __init__(self, bot: discord.Client, max_queue: int = 10000, window: float = 2, workers: int = 4,
+                 channel_cache_size: int = 4096, limiter: RateLimiter | None = None):
+        self.bot = bot
+        self.max_queue = max_queue
+        self.window = window
+        self.workers = workers
+        self.channel_cache_size = channel_cache_size
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+        self.channel_cache_hits = 0
+        self._queue: OrderedDict[int, Notification] = OrderedDict()
+        self._channels: OrderedDict[int, int] = OrderedDict()
+        self._tasks: list[asyncio.Task] = []
+
+    def submit(self, user_id: int, message: str, title: str, thumbnail=None) -> bool:
+        """
+        Queues a notification for a user, merging it into one that's already waiting if there is one.
+
+        :returns: False if the queue was full and the notification was dropped.
+        """
+        notification = self._queue.get(user_id)
+        if notification is not None:
+            self.coalesced += 1
+        elif len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            return False
+        else:
+            notification = Notification(time.monotonic() + self.window, thumbnail)
+            self._queue[user_id] = notification
+
+        if len(notification.updates) < self.MAX_FIELDS - 1:
+            notification.updates.append((title, message))
+        else:
+            notification.overflow += 1
+        self._start_workers()
+        return True
+
+    def _start_workers(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # nothing to run them on yet, they'll get started by the next submit made from inside the loop
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(loop.create_task(self._worker()))
+
+    async def _worker(self):
+        # workers exit once the queue is empty and submit starts them back up
+        while self._queue:
+            user_id, notification = next(iter(self._queue.items()))
+            delay = notification.due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue  # another worker might have taken it in the meantime
+
+            del self._queue[user_id]
+            try:
+                await self._deliver(user_id, notification)
+                self.sent += 1
+            except Exception as e:
+                self.failed += 1
+                self._channels.pop(user_id, None)
+                logger.warning(f"Failed to notify user {user_id}: {e}")
+
+    def _build_embed(self, notification: Notification) -> discord.Embed:
+        embed = discord.Embed(colour=discord.Colour.yellow())
+        embed.set_thumbnail(url=notification.thumbnail)
+        for title, message in notification.updates:
+            embed.add_field(name=title, value=message[:self.MAX_FIELD_LENGTH], inline=False)
+        if notification.overflow:
+            embed.add_field(name="...", value=f"and {notification.overflow} more updates", inline=False)
+        embed.set_footer(text="This message was sent by a bot and is probably highly important")
+        return embed
+
+    async def get_dm_channel_id(self, user_id: int) -> int:
+        channel_id = self._channels.get(user_id)
+        if channel_id is not None:
+            self._channels.move_to_end(user_id)
+            self.channel_cache_hits += 1
+            return channel_id
+
+        await self.limiter.acquire()
+        user = await self.bot.fetch_user(user_id)
+        channel = user.dm_channel
+        if channel is None:
+            await self.limiter.acquire()
+            channel = await user.create_dm()
+        self._channels[user_id] = channel.id
+        while len(self._channels) > self.channel_cache_size:
+            self._channels.popitem(last=False)
+        return channel.id
+
+    async def _deliver(self, user_id: int, notification: Notification):
+        channel_id = await self.get_dm_channel_id(user_id)
+        channel = self.bot.get_partial_messageable(channel_id, type=discord.ChannelType.private)
+        await self.limiter.acquire(channel_id)
+        await channel.send(embed=self._build_embed(notification))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "queue_depth": len(self._queue),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "channel_cache_hits": self.channel_cache_hits,
+            "rate_limit_wait": round(self.limiter.waited, 3)
+        }
+
 
 class DiscordBackendInterface(Backend):
     """
     A discord-aware interface of the backend.
     """
 
-    def __init__(self, bot: discord.Client, *args, **kwargs):
+    def __init__(self, bot: discord.Client, *args, member_cache_ttl: float = 60, notification_window: float = 2,
+                 notification_queue_size: int = 10000, **kwargs):
         super().__init__(*args, **kwargs)
         self.bot = bot
+        self.member_resolver = MemberResolver(bot, ttl=member_cache_ttl)
+        self.notifier = NotificationDispatcher(bot, max_queue=notification_queue_size, window=notification_window)
 
     def get_responder(self, interaction: discord.Interaction):
         """
@@ -68,15 +319,14 @@ class DiscordBackendInterface(Backend):
 
     async def get_member(self, user_id: int, guild_id: int):
         """
-        Fetches a user with a specified ID from a specific guild. 
+        Fetches a user with a specified ID from a specific guild, see MemberResolver.
 
         :param user_id: User ID.
         :param guild_id: Guild ID.
         :returns: The user as a member object if it and the guild exist, else `None`.
         """
 
-        guild = await self.bot.fetch_guild(guild_id)
-        return await guild.fetch_member(user_id) if guild is not None else None
+        return await self.member_resolver.get_member(user_id, guild_id)
 
     async def get_user_dms(self, user_id: int):
         """
@@ -86,14 +336,12 @@ class DiscordBackendInterface(Backend):
         :returns: The DM channel used between the user and the bot.
         """
 
-        user = await self.bot.fetch_user(user_id)
-        dms = user.dm_channel if user.dm_channel else await user.create_dm()
-        return dms
+        channel_id = await self.notifier.get_dm_channel_id(user_id)
+        return self.bot.get_partial_messageable(channel_id, type=discord.ChannelType.private)
 
-    @loop_adder
-    async def notify_user(self, user_id: int, message: str, title: str, thumbnail=None):
+    def notify_user(self, user_id: int, message: str, title: str, thumbnail=None):
         """
-        Notifies a user of a change through private messages.
+        Notifies a user of a change through private messages, see NotificationDispatcher.
 
         :param user_id: User ID.
         :param message: The message you wish to notify the user of.
@@ -101,9 +349,4 @@ class DiscordBackendInterface(Backend):
         :param thumbnail: The URL of the image used in the notification embed's thumbnail.
         """
 
-        embed = discord.Embed(colour=discord.Colour.yellow())
-        embed.set_thumbnail(url=thumbnail)
-        embed.add_field(name=title, value=message)
-        embed.set_footer(text="This message was sent by a bot and is probably highly important")
-        dms = await self.get_user_dms(user_id)
-        await dms.send(embed=embed)
\ No newline at end of file
+        self.notifier.submit(user_id, message, title, thumbnail)
@@ -2,12 +2,16 @@ import sys
 import json
 import csv
 import io
+import tempfile
 import uuid
+import zlib
 import discord
 from middleman import frmt
 
 syncing = False
 
+CSV_SPOOL_SIZE = 1024*1024 # exports bigger than this get written to disk instead of being kept in memory
+
 def load_config():
     global syncing
     if len(sys.argv) > 3:
@@ -27,25 +31,71 @@ def load_config():
     except:
         return {}
 
-def generate_transaction_csv(transactions: list, filename=None, *, currency='t', as_discord_file: bool = True):
-    filename = filename or (str(uuid.uuid4()) + '.csv')
-    with io.StringIO() as buffer:
-        writer = csv.writer(buffer)
-        writer.writerow(["Timestamp", "From", f"Amount ({currency})", "To"]) # header
-        if len(transactions) > 0:
-            writer.writerows(
-                [
-                    t.timestamp.strftime("%d/%m/%y %H:%M"),
-                    t.target_account.get_name(),
-                    frmt(t.amount),
-                    t.destination_account.get_name()
-                ] for t in transactions
-            )
-
-        buffer.seek(0)
-        byte = io.BytesIO(buffer.getvalue().encode("utf-8"))
-    
+class TransactionCSVEncoder:
+    """
+    Encodes a transaction log into a gzip compressed CSV a chunk at a time, for callers that get their chunks asynchronously.
+
+    Chunks are lists of (timestamp, from_name, amount, to_name) rows, as produced by Backend.iter_transaction_log.
+    """
+
+    def __init__(self, currency='t'):
+        self._compressor = zlib.compressobj(wbits=31) # 31 selects a gzip header and trailer
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._writer.writerow(["Timestamp", "From", f"Amount ({currency})", "To"]) # header
+
+    def encode(self, chunk) -> bytes:
+        self._writer.writerows(
+            [
+                timestamp.strftime("%d/%m/%y %H:%M"),
+                from_name,
+                frmt(amount),
+                to_name
+            ] for timestamp, from_name, amount, to_name in chunk
+        )
+        return self._flush_buffer()
+
+    def finish(self) -> bytes:
+        return self._flush_buffer() + self._compressor.flush()
+
+    def _flush_buffer(self) -> bytes:
+        data = self._compressor.compress(self._buffer.getvalue().encode("utf-8"))
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+def iter_transaction_csv(chunks, *, currency='t'):
+    """
+    Yields a gzip compressed CSV of a transaction log piece by piece, so only one chunk is ever held in memory.
+
+    :param chunks: An iterable of lists of (timestamp, from_name, amount, to_name) rows, as produced by Backend.iter_transaction_log
+    """
+    encoder = TransactionCSVEncoder(currency)
+    for chunk in chunks:
+        yield encoder.encode(chunk)
+    yield encoder.finish()
+
+def generate_transaction_csv(chunks, filename=None, *, currency='t', as_discord_file: bool = True):
+    """
+    Writes a gzip compressed CSV of a transaction log to a file that's only kept in memory while it's small.
+
+    :returns: The file, and the number of transactions written to it.
+    """
+    filename = filename or (str(uuid.uuid4()) + '.csv.gz')
+    count = 0
+
+    def counted():
+        nonlocal count
+        for chunk in chunks:
+            count += len(chunk)
+            yield chunk
+
+    file = tempfile.SpooledTemporaryFile(max_size=CSV_SPOOL_SIZE)
+    for piece in iter_transaction_csv(counted(), currency=currency):
+        file.write(piece)
+    file.seek(0)
+
     if as_discord_file:
-        return discord.File(byte, filename=filename)
+        return discord.File(file, filename=filename), count
     else:
-        return byte
\ No newline at end of file
+        return file, count
@@ -2,6 +2,7 @@
 import asyncio
 import unittest
 from backend_tests import BackendTests
+from api_tests import APITests
 
 
 
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+import asyncio
+import gzip
+import unittest
+from uuid import uuid4
+
+from backend_tests import create_test_backend, admin, admin_id, simdem
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from sqlalchemy import select
+
+import api
+from backend import Account, APIKey, Application, KeyType, Permissions
+
+
+def setup_keys():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    api.private_key = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                                serialization.NoEncryption())
+    api.trusted_public_keys['TB.pub'] = private_key.public_key().public_bytes(serialization.Encoding.PEM,
+                                                                              serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+class APITests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setup_keys()
+
+    def setUp(self):
+        api.config = {}
+        api.metrics = api.APIMetrics()
+        api.backend = backend = create_test_backend()
+        self.addCleanup(backend.close)
+        backend.notifier.workers = 0  # there's no discord to deliver notifications to
+        simdem.members.append(admin)  # so the keys' issuer can be fetched
+        self.addCleanup(simdem.members.remove, admin)
+
+        self.economy = backend.create_economy(admin, 'tau', 't')
+        self.from_account = backend.create_account(admin, admin_id, self.economy)
+        self.to_account = backend.create_account(admin, 1234, self.economy)
+        backend.print_money(admin, self.from_account, 1000)
+        app = Application(application_id=uuid4(), application_name='app', owner_id=admin_id, economy=self.economy)
+        key = APIKey(application=app, issuer_id=admin_id, type=KeyType.GRANT, enabled=True)
+        backend.session.add(key)
+        backend.session.commit()
+        self.key_id = key.key_id
+        backend.change_permissions(admin, self.key_id, Permissions.TRANSFER_FUNDS, account=self.from_account)
+        self.headers = {"authorization": api.generate_key(self.key_id)}
+
+        app = web.Application(middlewares=[api.instrument, api.unit_of_work, api.authenticate])
+        app.add_routes(api.routes)
+        async def start():
+            client = TestClient(TestServer(app))  # has to be made inside the loop it's going to run on
+            await client.start_server()
+            return client
+        self.client = self.run_async(start())
+        self.addCleanup(lambda: self.run_async(self.client.close()))
+
+    @staticmethod
+    def run_async(coro):
+        return asyncio.get_event_loop().run_until_complete(coro)
+
+    def balance(self, account: Account) -> int:
+        return api.backend.session.execute(select(Account.balance).where(Account.account_id == account.account_id)).scalar_one()
+
+    def test_idempotent_transaction(self):
+        async def run():
+            body = {"from_account": str(self.from_account.account_id), "to_account": str(self.to_account.account_id), "amount": 100}
+            headers = dict(self.headers, **{"Idempotency-Key": "retry me"})
+            async with self.client.post('/api/transactions/', json=body, headers=headers) as resp:
+                self.assertEqual(resp.status, 200)
+                self.assertNotIn("Idempotent-Replayed", resp.headers)
+                text = await resp.text()
+
+            async with self.client.post('/api/transactions/', json=body, headers=headers) as resp:
+                self.assertEqual(resp.status, 200)
+                self.assertEqual(resp.headers["Idempotent-Replayed"], "true")
+                self.assertEqual(await resp.text(), text)
+            self.assertEqual(self.balance(self.from_account), 900)
+            self.assertEqual(self.balance(self.to_account), 100)
+
+            # reusing the key for a different transaction is refused rather than replayed
+            async with self.client.post('/api/transactions/', json=dict(body, amount=200), headers=headers) as resp:
+                self.assertEqual(resp.status, 422)
+            self.assertEqual(self.balance(self.from_account), 900)
+
+            # failures are replayed too, even once the transfer could have gone through
+            headers["Idempotency-Key"] = "too much"
+            async with self.client.post('/api/transactions/', json=dict(body, amount=1000), headers=headers) as resp:
+                self.assertEqual(resp.status, 400)
+            api.backend.print_money(admin, api.backend.get_account_by_id(self.from_account.account_id), 1000)
+            async with self.client.post('/api/transactions/', json=dict(body, amount=1000), headers=headers) as resp:
+                self.assertEqual(resp.status, 400)
+                self.assertEqual(resp.headers["Idempotent-Replayed"], "true")
+            self.assertEqual(self.balance(self.from_account), 1900)
+
+        self.run_async(run())
+
+    def test_batch_transactions(self):
+        async def run():
+            transfer = {"from_account": str(self.from_account.account_id), "to_account": str(self.to_account.account_id), "amount": 100}
+            body = {"mode": "best_effort", "transfers": [transfer, dict(transfer, to_account=str(uuid4())), dict(transfer, amount=5000),
+                                                          dict(transfer, from_account=str(self.to_account.account_id))]}
+            headers = dict(self.headers, **{"Idempotency-Key": "batch"})
+            async with self.client.post('/api/transactions/batch', json=body, headers=headers) as resp:
+                self.assertEqual(resp.status, 200)
+                results = (await resp.json())["results"]
+            self.assertEqual([r["status"] for r in results], ["done", "failed", "failed", "failed"])
+            self.assertEqual(results[1]["reason"], "Account not found")
+            self.assertEqual(results[2]["reason"], "You do not have sufficient funds to transfer from that account")
+            self.assertEqual(results[3]["reason"], "Your key does not have permission to transfer funds from that account")
+            self.assertEqual((self.balance(self.from_account), self.balance(self.to_account)), (900, 100))
+
+            async with self.client.post('/api/transactions/batch', json=body, headers=headers) as resp:
+                self.assertEqual(resp.status, 200)
+                self.assertEqual(resp.headers["Idempotent-Replayed"], "true")
+                self.assertEqual((await resp.json())["results"], results)
+            self.assertEqual((self.balance(self.from_account), self.balance(self.to_account)), (900, 100))
+
+            # an atomic batch that fails the key's checks isn't attempted at all, and its failure is replayed too
+            body["mode"] = "atomic"
+            headers["Idempotency-Key"] = "atomic batch"
+            for replayed in (False, True):
+                async with self.client.post('/api/transactions/batch', json=body, headers=headers) as resp:
+                    self.assertEqual(resp.status, 400)
+                    self.assertEqual("Idempotent-Replayed" in resp.headers, replayed)
+                    self.assertEqual([r["status"] for r in (await resp.json())["results"]], ["skipped", "failed", "skipped", "failed"])
+            self.assertEqual(self.balance(self.from_account), 900)
+
+        self.run_async(run())
+
+    def test_lookup_accounts(self):
+        api.backend.change_permissions(admin, self.key_id, Permissions.VIEW_BALANCE, account=self.from_account)
+        from_id, to_id, missing_id = str(self.from_account.account_id), str(self.to_account.account_id), str(uuid4())
+
+        async def lookup(body):
+            async with self.client.post('/api/accounts/lookup', json=body, headers=self.headers) as resp:
+                return resp.status, (await resp.json() if resp.status == 200 else None)
+
+        status, found = self.run_async(lookup({"ids": [from_id, missing_id, to_id], "names": [self.to_account.account_name, "missing"],
+                                               "fields": ["account_id", "balance"]}))
+        self.assertEqual(status, 200)
+        # in the order asked for, once each, with balances only where the key can see them
+        self.assertEqual(found["accounts"], [{"account_id": from_id, "balance": 1000}, {"account_id": to_id, "balance": None}])
+        self.assertEqual(found["not_found"], [missing_id, "missing"])
+
+        for body in ({}, {"ids": [from_id], "fields": ["password"]}, {"ids": ["not a uuid"]}, {"names": [from_id], "other": 1}):
+            self.assertEqual(self.run_async(lookup(body))[0], 400)
+
+    def test_export_transactions(self):
+        for amount in range(1, 6):
+            api.backend.perform_transaction(admin, self.from_account, self.to_account, amount)
+        api.backend.change_permissions(admin, self.key_id, Permissions.VIEW_BALANCE, account=self.from_account)
+
+        async def run():
+            async with self.client.get(f'/api/accounts/{self.from_account.account_id}/transactions/export', headers=self.headers,
+                                       auto_decompress=False) as resp:
+                self.assertEqual(resp.status, 200)
+                return gzip.decompress(await resp.read()).decode()
+        lines = self.run_async(run()).splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[0], "Timestamp,From,Amount (t),To")
+
+        async def unauthorised():
+            async with self.client.get(f'/api/accounts/{self.to_account.account_id}/transactions/export', headers=self.headers) as resp:
+                return resp.status
+        self.assertEqual(self.run_async(unauthorised()), 401)
+
+        async def bad_limits():
+            statuses = []
+            for route in ('transactions', 'transactions/export'):
+                for limit in ('abc', '0', '-1', '1.5'):
+                    async with self.client.get(f'/api/accounts/{self.from_account.account_id}/{route}?limit={limit}',
+                                               headers=self.headers) as resp:
+                        statuses.append(resp.status)
+            return statuses
+        self.assertEqual(self.run_async(bad_limits()), [400] * 8)
+
+    def test_deleted_key(self):
+        async def get():
+            async with self.client.get(f'/api/accounts/{self.from_account.account_id}', headers=self.headers) as resp:
+                return resp.status
+
+        self.assertEqual(self.run_async(get()), 200)
+        self.assertEqual(len(api.backend.token_cache), 1)  # the token has been verified once
+        api.backend.delete_key(api.backend.get_key_by_id(self.key_id))
+        self.assertEqual(len(api.backend.token_cache), 0)
+        self.assertEqual(self.run_async(get()), 401)
+
+    def test_histogram(self):
+        route_metrics = api.metrics.route('/route', 'GET')
+        for elapsed in (0.005, 0.3, 20):  # on a bound, between two and past the last
+            route_metrics.latency.observe(elapsed)
+        self.assertEqual(route_metrics.latency.counts, [1, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1])
+
+        lines = api.metrics.render().splitlines()
+        buckets = {line.split('le="')[1].split('"')[0]: int(line.split()[-1]) for line in lines
+                   if line.startswith('taubot_api_request_duration_seconds_bucket')}
+        self.assertEqual((buckets["0.005"], buckets["0.25"], buckets["0.5"], buckets["10.0"], buckets["+Inf"]), (1, 1, 2, 2, 3))
+        self.assertIn('taubot_api_request_duration_seconds_count{route="/route",method="GET"} 3', lines)
+
+    def test_metrics_format(self):
+        route_metrics = api.metrics.route('/route', 'GET')
+        route_metrics.observe(200, 0.01, api.RequestStats())
+        text = api.metrics.render()
+        self.assertTrue(text.endswith("\n# EOF\n"))
+        lines = text.splitlines()
+        self.assertIn("# TYPE taubot_api_responses counter", lines)  # counters are named without their _total suffix
+        self.assertIn('taubot_api_responses_total{route="/route",method="GET",status="200"} 1', lines)
+        self.assertIn('taubot_api_requests_in_flight{route="/route",method="GET"} 0', lines)
+
+    def test_metrics_record_failures(self):
+        async def broken(request):
+            raise RuntimeError()
+
+        async def missing(request):
+            raise web.HTTPNotFound()
+
+        async def run():
+            app = web.Application(middlewares=[api.instrument])
+            app.router.add_get('/broken', broken)
+            app.router.add_get('/missing', missing)
+            async with TestClient(TestServer(app)) as client:
+                for url in ('/broken', '/missing'):
+                    async with client.get(url) as resp:
+                        await resp.read()
+        self.run_async(run())
+        self.assertEqual(api.metrics.route('/broken', 'GET').responses, {500: 1})
+        self.assertEqual(api.metrics.route('/missing', 'GET').responses, {404: 1})
+        self.assertEqual(api.metrics.route('/broken', 'GET').in_flight, 0)
+
+    def test_get_metrics(self):
+        async def get(headers):
+            async with self.client.get('/metrics', headers=headers) as resp:
+                return resp.status, resp.headers.get("Content-Type")
+
+        self.assertEqual(self.run_async(get({}))[0], 404)  # disabled unless a token is configured
+        api.config = {"metrics_token": "secret"}
+        self.assertEqual(self.run_async(get({}))[0], 401)
+        self.assertEqual(self.run_async(get({"authorization": "Bearer wrong"}))[0], 401)
+        status, content_type = self.run_async(get({"authorization": "Bearer secret"}))
+        self.assertEqual(status, 200)
+        self.assertTrue(content_type.startswith("application/openmetrics-text"))
+
+    def test_grant_waiters(self):
+        waiters = api.GrantWaiters()
+        app_id, ref_id = uuid4(), uuid4()
+
+        async def run():
+            waiting = [asyncio.ensure_future(waiters.wait(app_id, ref_id, 10)) for _ in range(2)]
+            await asyncio.sleep(0)  # let them start waiting
+            self.assertEqual(len(waiters._events), 1)  # waiters on the same grant share an event
+            waiters.notify(app_id, uuid4())  # someone else's grant
+            waiters.notify(app_id, ref_id)
+            self.assertEqual(await asyncio.wait_for(asyncio.gather(*waiting), 1), [True, True])
+            self.assertEqual((waiters._events, waiters._waiting), ({}, {}))
+
+            self.assertFalse(await waiters.wait(app_id, ref_id, 0.01))  # never notified
+            self.assertEqual((waiters._events, waiters._waiting), ({}, {}))
+            waiters.notify(app_id, ref_id)  # with nobody waiting there's nothing to wake
+            self.assertEqual(waiters._events, {})
+        self.run_async(run())
+
+
+    def test_retrieve_key_wait(self):
+        api.grant_store = api.MemoryGrantStore()
+        self.addCleanup(setattr, api, 'grant_store', None)
+        application = api.backend.get_key_by_id(self.key_id).application
+        master = APIKey(application=application, issuer_id=admin_id, type=KeyType.MASTER, enabled=True)
+        api.backend.session.add(master)
+        api.backend.session.commit()
+        headers = {"authorization": api.generate_key(master.key_id)}
+        application_id = application.application_id
+
+        async def retrieve(ref_id, wait):
+            async with self.client.get(f'/api/retrieve-key/{ref_id}?wait={wait}', headers=headers) as resp:
+                return resp.status, (await resp.json() if resp.status == 200 else None)
+
+        async def run():
+            ref_id, never_granted = uuid4(), uuid4()
+            for ref in (ref_id, never_granted):
+                async with self.client.post('/api/oauth-references', json={"ref_id": str(ref)}, headers=headers) as resp:
+                    self.assertEqual(resp.status, 201)
+
+            # the grant arrives while the request is waiting for it
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            waiting = asyncio.ensure_future(retrieve(ref_id, 10))
+            await asyncio.sleep(0.1)
+            self.assertFalse(waiting.done())
+            api.grant_store.put(application_id, ref_id, {"issuer_id": admin_id, "request_data": {
+                "permissions": {str(self.from_account.account_id): ["VIEW_BALANCE"]}}})
+            api.grant_waiters.notify(application_id, ref_id)
+            status, body = await asyncio.wait_for(waiting, 2)
+            self.assertEqual(status, 200)
+            self.assertLess(loop.time() - start, 2)
+            new_key = api.backend.get_key(api.backend.get_application(application_id), ref_id)
+            self.assertEqual(body["key"], api.generate_key(new_key.key_id))
+
+            # nobody grants the other one so the wait runs out
+            start = loop.time()
+            self.assertEqual((await retrieve(never_granted, 0.2))[0], 404)
+            self.assertGreaterEqual(loop.time() - start, 0.2)
+            self.assertIsNotNone(api.grant_store.get(application_id, never_granted))  # it can still be granted later
+
+        self.run_async(run())
+
+
+    def test_discord_id_cache(self):
+        calls, connections = [], set()
+
+        async def users_me(request):
+            token = request.headers['Authorization'].removeprefix('Bearer ')
+            calls.append(token)
+            connections.add(request.transport)
+            if token == 'bad':
+                raise web.HTTPUnauthorized()
+            return web.json_response({"id": str(len(token))})
+
+        async def run():
+            discord = web.Application()
+            discord.router.add_get('/users/@me', users_me)
+            async with TestServer(discord) as server:
+                old_url = api.API_URL
+                api.API_URL = str(server.make_url(''))
+                await api.open_http_session(None)
+                try:
+                    http, clock = api.http, [0.0]
+                    api.discord_ids.clock = lambda: clock[0]
+                    self.assertEqual(await api.get_user_id('abc'), 3)
+                    self.assertEqual(await api.get_user_id('abc'), 3)  # cached
+                    self.assertEqual(await api.get_user_id('abcd'), 4)
+                    self.assertEqual((calls, api.discord_ids.hits), (['abc', 'abcd'], 1))
+                    self.assertNotIn('abc', api.discord_ids._entries)  # only digests of the tokens are kept
+
+                    # failures aren't cached and entries expire, either way discord is asked again
+                    for _ in range(2):
+                        with self.assertRaises(web.HTTPBadRequest):
+                            await api.get_user_id('bad')
+                    clock[0] = 301
+                    self.assertEqual(await api.get_user_id('abc'), 3)
+                    self.assertEqual(calls, ['abc', 'abcd', 'bad', 'bad', 'abc'])
+
+                    # every call goes through the one session, so its connection gets reused
+                    self.assertIs(api.http, http)
+                    self.assertEqual(len(connections), 1)
+                finally:
+                    await api.close_http_session(None)
+                    api.API_URL = old_url
+        self.run_async(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
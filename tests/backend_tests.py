@@ -5,6 +5,10 @@ import time
 import datetime
 from os import path
 import asyncio
+import gzip
+import random
+import tempfile
+import threading
 
 from discord_utils import *
 
@@ -12,6 +16,8 @@ sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), 's
 
 from middleman import *
 from backend import *
+from utils import iter_transaction_csv
+from sqlalchemy import event
 
 logger.setLevel(100) # shut that thing up
 
@@ -140,6 +146,157 @@ class BackendTests(unittest.TestCase):
     
 
     
+    def test_transaction_log_pagination(self):
+        backend = create_test_backend()
+        econ = backend.create_economy(admin, 'tau', 't')
+        user = add_member(user_id)
+        other_user = add_member(other_user_id)
+        from_acc = backend.create_account(user, user_id, econ)
+        to_acc = backend.create_account(other_user, other_user_id, econ)
+        backend.print_money(admin, from_acc, 100)
+        for i in range(5):
+            backend.perform_transaction(user, from_acc, to_acc, 10)
+            backend.perform_transaction(other_user, to_acc, from_acc, 1)
+
+        full_log = backend.get_transaction_log(user, from_acc)
+        self.assertEqual(len(full_log), 10)
+        self.assertEqual(full_log, sorted(full_log, key=lambda t: (t.timestamp, t.transaction_id), reverse=True))
+
+        pages = []
+        before = None
+        while True:
+            page = backend.get_transaction_log(user, from_acc, limit=3, before=before)
+            pages += page
+            if len(page) < 3:
+                break
+            before = (page[-1].timestamp, page[-1].transaction_id)
+        self.assertEqual(pages, full_log)
+
+        chunks = list(backend.iter_transaction_log(user, from_acc, chunk_size=4))
+        self.assertEqual([len(c) for c in chunks], [4, 4, 2])
+        rows = [row for chunk in chunks for row in chunk]
+        self.assertEqual([r[0] for r in rows], [t.timestamp for t in full_log])
+        self.assertEqual([(r[1], r[2], r[3]) for r in rows], [(t.target_account.get_name(), t.amount, t.destination_account.get_name()) for t in full_log])
+        self.assertEqual(sum(len(c) for c in backend.iter_transaction_log(user, from_acc, limit=5, chunk_size=2)), 5)
+
+        async def collect(**kwargs):
+            collected = []
+            async for chunk in backend.iter_transaction_log_async(user, from_acc, **kwargs):
+                self.assertFalse(backend.session.in_transaction())  # nothing's held while a chunk is being sent
+                collected.append(chunk)
+            return collected
+        loop = asyncio.get_event_loop()
+        self.assertEqual(loop.run_until_complete(collect(chunk_size=4)), chunks)
+        self.assertEqual(sum(len(c) for c in loop.run_until_complete(collect(limit=5, chunk_size=2))), 5)
+
+        csv_text = gzip.decompress(b''.join(iter_transaction_csv(iter(chunks)))).decode()
+        self.assertEqual(len(csv_text.splitlines()), 11)
+
+    def test_concurrent_transfers_conserve_money(self):
+        with tempfile.TemporaryDirectory() as directory:
+            db_path = path.join(directory, 'stress.db')
+            backend = Backend(f"sqlite:///{db_path}")
+            econ = backend.create_economy(admin, 'tau', 't')
+            accounts = [backend.create_account(admin, None, econ, f'account {i}', AccountType.CORPORATION) for i in range(5)]
+            for acc in accounts:
+                backend.print_money(admin, acc, 1000)
+            account_ids = [acc.account_id for acc in accounts]
+
+            errors = []
+
+            def worker(seed):
+                rng = random.Random(seed)
+                worker_backend = Backend(f"sqlite:///{db_path}")
+                try:
+                    for _ in range(40):
+                        from_id, to_id = rng.sample(account_ids, 2)
+                        try:
+                            worker_backend.perform_transaction(admin, worker_backend.get_account_by_id(from_id), worker_backend.get_account_by_id(to_id), rng.randint(1, 600))
+                        except BackendError:
+                            pass
+                except Exception as e:  # anything else would otherwise just kill the thread quietly
+                    errors.append(e)
+                finally:
+                    worker_backend.close()
+
+            threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+
+            backend.session.expire_all()
+            transfers = backend.session.execute(select(func.count()).select_from(Transaction).where(Transaction.action == Actions.TRANSFER)).scalar()
+            self.assertGreater(transfers, 0)
+            balances = [backend.get_account_by_id(i).balance for i in account_ids]
+            self.assertEqual(sum(balances), 5000)
+            self.assertTrue(all(balance >= 0 for balance in balances))
+            backend.close()
+
+    def test_async_hot_paths(self):
+        for async_mode in (False, True):
+            with tempfile.TemporaryDirectory() as directory:
+                backend = DiscordBackendInterface(bot, f"sqlite:///{path.join(directory, 'async.db')}", async_mode=async_mode)
+                econ = backend.create_economy(admin, 'tau', 't')
+                user = add_member(user_id)
+                other_user = add_member(other_user_id)
+                backend.create_account(user, user_id, econ)
+                to_acc = backend.create_account(other_user, other_user_id, econ)
+                backend.print_money(admin, backend.get_user_account(user_id, econ), 100)
+
+                async def run():
+                    from_acc = await backend.get_user_account_async(user_id, econ)
+                    self.assertEqual((await backend.get_account_by_name_async(from_acc.account_name, econ)).account_id, from_acc.account_id)
+                    self.assertEqual((await backend.get_account_by_id_async(to_acc.account_id)).account_id, to_acc.account_id)
+                    self.assertTrue(await backend.has_permission_async(user, Permissions.TRANSFER_FUNDS, account=from_acc))
+                    self.assertFalse(await backend.has_permission_async(other_user, Permissions.TRANSFER_FUNDS, account=from_acc))
+
+                    await backend.perform_transaction_async(user, from_acc, to_acc, 60)
+                    self.assertEqual(from_acc.balance, 40)
+                    with self.assertRaises(BackendError):
+                        await backend.perform_transaction_async(user, from_acc, to_acc, 60)
+                    log = await backend.get_transaction_log_async(user, from_acc)
+                    self.assertEqual([t.amount for t in log], [60])
+
+                asyncio.get_event_loop().run_until_complete(run())
+                backend.session.expire_all()
+                self.assertEqual(backend.get_user_account(user_id, econ).balance, 40)
+                self.assertEqual(backend.get_user_account(other_user_id, econ).balance, 60)
+                asyncio.get_event_loop().run_until_complete(backend.close_async())
+
+    def test_unit_of_work(self):
+        backend = create_test_backend()
+        econ = backend.create_economy(admin, 'tau', 't')
+        default_session = backend.session
+
+        with backend.unit_of_work() as session:
+            self.assertIs(backend.session, session)
+            self.assertIsNot(session, default_session)
+            with backend.unit_of_work() as inner:
+                self.assertIs(inner, session)
+            acc = backend.create_account(add_member(user_id), user_id, backend.get_economy_by_id(econ.economy_id))
+            acc_id = acc.account_id
+        self.assertIs(backend.session, default_session)
+        self.assertEqual(backend.get_account_by_id(acc_id).account_id, acc_id)
+
+        sessions = []
+
+        async def command():
+            with backend.unit_of_work():
+                await asyncio.sleep(0)
+                session = backend.session
+                sessions.append(session)
+                await asyncio.sleep(0)
+                self.assertIs(backend.session, session)
+
+        async def run():
+            await asyncio.gather(command(), command())
+
+        asyncio.get_event_loop().run_until_complete(run())
+        self.assertIsNot(sessions[0], sessions[1])
+
     def test_permissions(self):
         backend = create_test_backend()
         econ = backend.create_economy(admin, 'tau', 't')
@@ -170,6 +327,178 @@ class BackendTests(unittest.TestCase):
         
         self.assertFalse(backend.has_permission(user, Permissions.TRANSFER_FUNDS, account=acc, economy=econ))
         
+    def test_permission_cache(self):
+        backend = create_test_backend()
+        econ = backend.create_economy(admin, 'tau', 't')
+        user = add_member(user_id)
+        other_user = add_member(other_user_id)
+        acc = backend.create_account(user, user_id, econ)
+
+        hits = backend.permission_cache.hits
+        self.assertFalse(backend.has_permission(other_user, Permissions.VIEW_BALANCE, account=acc))
+        self.assertFalse(backend.has_permission(other_user, Permissions.VIEW_BALANCE, account=acc))
+        self.assertEqual(backend.permission_cache.hits, hits + 1)
+
+        # granting the permission on the economy should evict the account level entry
+        backend.change_permissions(admin, other_user_id, Permissions.VIEW_BALANCE, economy=econ)
+        self.assertTrue(backend.has_permission(other_user, Permissions.VIEW_BALANCE, account=acc))
+        backend.reset_permission(admin, other_user_id, Permissions.VIEW_BALANCE, economy=econ)
+        self.assertFalse(backend.has_permission(other_user, Permissions.VIEW_BALANCE, account=acc))
+
+        # the owner's default permissions should follow the account
+        self.assertTrue(backend.has_permission(user, Permissions.VIEW_BALANCE, account=acc))
+        backend.transfer_ownership(user, acc, other_user_id)
+        self.assertFalse(backend.has_permission(user, Permissions.VIEW_BALANCE, account=acc))
+        self.assertTrue(backend.has_permission(other_user, Permissions.VIEW_BALANCE, account=acc))
+
+        # a change that gets rolled back mustn't stay cached, the invalidation waits for the transaction to end
+        backend._change_many_permissions(admin, user_id, Permissions.VIEW_BALANCE, account=acc)
+        self.assertTrue(backend.has_permission(user, Permissions.VIEW_BALANCE, account=acc))
+        backend.session.rollback()
+        self.assertFalse(backend.has_permission(user, Permissions.VIEW_BALANCE, account=acc))
+
+        # entries expire so changes made by another process are seen eventually
+        clock = [0.0]
+        cache = PermissionCache(max_size=2, ttl=60)
+        cache.clock = lambda: clock[0]
+        key = PermissionCache.make_key(StubUser(1), Permissions.VIEW_BALANCE, None, None)
+        cache.put(key, True)
+        clock[0] = 59
+        self.assertTrue(cache.get(key))
+        clock[0] = 61
+        self.assertIsNone(cache.get(key))
+
+        cache = PermissionCache(max_size=2)
+        for i in range(3):
+            cache.put(PermissionCache.make_key(StubUser(i + 1), Permissions.VIEW_BALANCE, None, None), True)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get(PermissionCache.make_key(StubUser(1), Permissions.VIEW_BALANCE, None, None)))
+        cache.invalidate_subject(2)
+        self.assertEqual(len(cache), 1)
+
+    def test_lru_cache(self):
+        clock = [0.0]
+        cache = LRUCache(max_size=2, ttl=10, clock=lambda: clock[0])
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.hits, 1)
+
+        cache.put('c', 3) # evicts b, a was used more recently
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+        clock[0] = 5
+        cache.put('a', 4) # putting again restarts the ttl
+        clock[0] = 12
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.get('a'), 4)
+        self.assertEqual(len(cache), 1)
+        clock[0] = 15
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.misses, 3)
+
+    def test_evaluate_permissions(self):
+        backend = create_test_backend()
+        econ = backend.create_economy(admin, 'tau', 't')
+        user = add_member(user_id)
+        other_user = add_member(other_user_id)
+        accs = [backend.create_account(user, user_id, econ), backend.create_account(other_user, other_user_id, econ)]
+        accs.append(backend.create_account(admin, None, econ, 'government', AccountType.GOVERNMENT))
+        backend.change_permissions(admin, other_user_id, Permissions.VIEW_BALANCE, economy=econ)
+        backend.change_permissions(admin, other_user_id, Permissions.TRANSFER_FUNDS, account=accs[2])
+        backend.change_permissions(admin, user_id, Permissions.VIEW_BALANCE, account=accs[0], allowed=False)
+
+        perms = [Permissions.VIEW_BALANCE, Permissions.TRANSFER_FUNDS, Permissions.CLOSE_ACCOUNT]
+        for member in (user, other_user):
+            backend.permission_cache.clear()
+            matrix = backend.evaluate_permissions(member, perms, accs)
+            backend.permission_cache.clear()
+            for perm in perms:
+                for acc in accs:
+                    self.assertEqual(matrix[(perm, acc.account_id)], backend.has_permission(member, perm, account=acc))
+
+    def test_member_resolver(self):
+        calls = []
+
+        class CountingGuild(StubGuild):
+            async def fetch_member(self, user_id):
+                calls.append(user_id)
+                await asyncio.sleep(0)
+                return StubMember(user_id, [], self)
+
+        class CountingBot(StubBot):
+            async def fetch_guild(self, guild_id):
+                return CountingGuild(guild_id, [], [])
+
+        resolver = MemberResolver(CountingBot())
+
+        async def lookup():
+            members = await asyncio.gather(*[resolver.get_member(user_id, guild_id) for _ in range(5)])
+            members.append(await resolver.get_member(user_id, guild_id))
+            return members
+
+        members = asyncio.get_event_loop().run_until_complete(lookup())
+        self.assertEqual(calls, [user_id])
+        self.assertTrue(all(m is members[0] for m in members))
+        self.assertEqual(resolver.stats()["coalesced"], 4)
+        self.assertEqual(resolver.stats()["cache_hits"], 1)
+
+    def test_notification_dispatcher(self):
+        fetched = []
+        sent = []
+
+        class RecordingChannel(Channel):
+            async def send(self, *args, **kwargs):
+                sent.append((self.id, kwargs["embed"]))
+
+        class RecordingBot(StubBot):
+            async def fetch_user(self, user_id):
+                fetched.append(user_id)
+                return StubMember(user_id, [])
+
+            def get_partial_messageable(self, channel_id, type=None):
+                return RecordingChannel(channel_id)
+
+        class RecordingLimiter(RateLimiter):
+            async def acquire(self, route=None):
+                await super().acquire(route)
+                if route is not None:
+                    acquired.setdefault(route, []).append(self._routes[route][-1])
+
+        acquired = {}
+        dispatcher = NotificationDispatcher(RecordingBot(), max_queue=2, window=0.05, limiter=RecordingLimiter(route_rate=1, route_per=0.1))
+
+        async def wait_for(count, timeout=10):
+            deadline = asyncio.get_running_loop().time() + timeout
+            while dispatcher.sent + dispatcher.failed < count:
+                self.assertLess(asyncio.get_running_loop().time(), deadline)
+                await asyncio.sleep(0.01)
+
+        async def run():
+            for i in range(30):
+                dispatcher.submit(user_id, f"update {i}", "Balance Update")
+            dispatcher.submit(other_user_id, "hello", "Balance Update")
+            self.assertFalse(dispatcher.submit(admin_id, "dropped", "Balance Update"))
+            await wait_for(2)
+            dispatcher.submit(user_id, "later", "Balance Update")
+            await wait_for(3)
+            await dispatcher.close()
+
+        asyncio.get_event_loop().run_until_complete(run())
+        self.assertEqual(sorted(fetched), sorted([user_id, other_user_id]))  # the second DM to user_id used the cached channel
+        self.assertEqual(len(sent), 3)
+        first = [embed for channel_id, embed in sent if channel_id == user_id + 10][0]
+        self.assertEqual(len(first.fields), NotificationDispatcher.MAX_FIELDS)
+        self.assertEqual(first.fields[-1].value, "and 6 more updates")
+        sends = acquired[user_id + 10]
+        self.assertGreaterEqual(sends[1] - sends[0], 0.1)  # user_id's channel bucket only allows one send per 0.1s
+        stats = dispatcher.stats()
+        self.assertEqual((stats["coalesced"], stats["dropped"], stats["queue_depth"], stats["channel_cache_hits"]), (29, 1, 0, 1))
+
     def test_recurring_transfers(self):
         backend = create_test_backend()
         econ = backend.create_economy(admin, 'tau', 't')
@@ -204,6 +533,530 @@ class BackendTests(unittest.TestCase):
         l.run_until_complete(backend.tick())
         self.assertEqual(backend.get_user_account(user_id, econ).balance, 900)
 
+    def test_bulk_tick(self):
+        backend = create_test_backend()
+        econ = backend.create_economy(admin, 'tau', 't')
+        user = add_member(user_id)
+        other_user = add_member(other_user_id)
+        from_acc = backend.create_account(user, user_id, econ)
+        to_acc = backend.create_account(other_user, other_user_id, econ)
+        gov = backend.create_account(admin, None, econ, 'gov', AccountType.GOVERNMENT)
+        backend.create_tax_bracket(admin, 'vat', AccountType.USER, TaxType.VAT, 0, 100000, 10, gov)
+        backend.print_money(admin, from_acc, 1000)
+        backend.create_recurring_transfer(user, from_acc, to_acc, 100, 60*60*24, 5)
+        backend.create_recurring_transfer(user, from_acc, to_acc, 300, 60*60*24, 100)
+
+        old_time_func = time.time
+        time.time = lambda: old_time_func() + 60*60*24*3
+        try:
+            asyncio.get_event_loop().run_until_complete(backend.tick())
+        finally:
+            time.time = old_time_func
+
+        # both transfers are due 4 payments, the 100 one makes all 4 then the 300 one can only afford 2 and gets cancelled
+        self.assertEqual(backend.get_account_by_id(from_acc.account_id).balance, 0)
+        self.assertEqual(backend.get_account_by_id(to_acc.account_id).balance, 900)
+        self.assertEqual(backend.get_account_by_id(gov.account_id).balance, 100)
+        self.assertEqual(backend.get_account_by_id(to_acc.account_id).income_to_date, 1000)
+        remaining = backend.session.execute(select(RecurringTransfer)).scalars().all()
+        self.assertEqual([(t.amount, t.number_of_payments_left) for t in remaining], [(100, 1)])
+        transfers = backend.session.execute(select(func.count()).select_from(Transaction).where(Transaction.action == Actions.TRANSFER)).scalar()
+        self.assertEqual(transfers, 6)
+
+    def test_tick_closed_accounts(self):
+        backend = create_test_backend()
+        econ = backend.create_economy(admin, 'tau', 't')
+        user = add_member(user_id)
+        from_acc = backend.create_account(user, user_id, econ)
+        to_acc = backend.create_account(add_member(other_user_id), other_user_id, econ)
+        closed = backend.create_account(admin, None, econ, 'closed', AccountType.CORPORATION)
+        closed_payer = backend.create_account(admin, None, econ, 'closed payer', AccountType.CORPORATION)
+        backend.print_money(admin, from_acc, 1000)
+        backend.print_money(admin, closed_payer, 1000)
+        backend.create_recurring_transfer(user, from_acc, closed, 100, 60, 5)
+        backend.create_recurring_transfer(user, from_acc, to_acc, 100, 60, 5)
+        backend.create_recurring_transfer(admin, closed_payer, to_acc, 100, 60, 5)
+        backend.delete_account(admin, closed)
+        backend.delete_account(admin, closed_payer)
+
+        old_time_func = time.time
+        time.time = lambda: old_time_func() + 61
+        self.addCleanup(setattr, time, 'time', old_time_func)
+        self.assertTrue(asyncio.get_event_loop().run_until_complete(backend.tick()))
+
+        # only the transfers touching a closed account get cancelled, the rest of the economy still gets paid
+        self.assertEqual(backend.get_account_by_id(to_acc.account_id).balance, 300)  # the first payments were made when they were set up
+        self.assertEqual(backend.get_account_by_id(from_acc.account_id).balance, 700)
+        remaining = backend.session.execute(select(RecurringTransfer)).scalars().all()
+        self.assertEqual([t.to_account_id for t in remaining], [to_acc.account_id])
+
+    def test_parallel_tick(self):
+        with tempfile.TemporaryDirectory() as directory:
+            backend = create_test_backend(path.join(directory, 'tick.db'))
+            from_ids = []
+            for name, guild in (('tau', simdem), ('bad', other_guild)):
+                econ = backend.create_economy(add_member(admin_id, guild=guild), name, name[0])
+                from_acc = backend.create_account(add_member(user_id, guild=guild), user_id, econ)
+                to_acc = backend.create_account(add_member(other_user_id, guild=guild), other_user_id, econ)
+                backend.print_money(admin, from_acc, 1000)
+                backend.create_recurring_transfer(add_member(user_id, guild=guild), from_acc, to_acc, 10, 60, 5)
+                from_ids.append(from_acc.account_id)
+
+            threads = []
+            tick_economy = backend._tick_economy
+
+            def failing_tick_economy(session, transfers, *args):
+                threads.append(threading.current_thread().name)
+                if transfers[0].from_account.economy.currency_name == 'bad':
+                    raise RuntimeError("boom")
+                return tick_economy(session, transfers, *args)
+
+            backend._tick_economy = failing_tick_economy
+            old_time_func = time.time
+            time.time = lambda: old_time_func() + 60
+            try:
+                with self.assertLogs(logger, level=PUBLIC_LOG) as logs:
+                    with backend.unit_of_work():
+                        self.assertFalse(asyncio.get_event_loop().run_until_complete(backend.tick()))  # so the scheduler backs off
+            finally:
+                time.time = old_time_func
+
+            self.assertTrue(all(name.startswith("tick") for name in threads))
+            with backend.unit_of_work():
+                self.assertEqual([backend.get_account_by_id(i).balance for i in from_ids], [980, 990])  # the failing economy didn't stop the other one
+            summary = logs.records[-1].getMessage()
+            self.assertIn("across 2 economies", summary)
+            self.assertIn("tau: 1 transfers in", summary)
+            self.assertIn("bad: 0 transfers in", summary)
+            self.assertIn("1 failed ticks, the last due to: boom", summary)
+            backend.close()
+
+    def test_transfer_scheduler(self):
+        # the clock is driven by hand so nothing depends on how quickly the test gets scheduled
+        clock = [time.time()]
+        old_time_func = time.time
+        time.time = lambda: clock[0]
+        self.addCleanup(setattr, time, 'time', old_time_func)
+        with tempfile.TemporaryDirectory() as directory:
+            backend = create_test_backend(path.join(directory, 'scheduler.db'))
+            econ = backend.create_economy(admin, 'tau', 't')
+            user = add_member(user_id)
+            other_user = add_member(other_user_id)
+            from_acc = backend.create_account(user, user_id, econ)
+            to_acc = backend.create_account(other_user, other_user_id, econ)
+            backend.print_money(admin, from_acc, 1000)
+            backend.create_recurring_transfer(user, from_acc, to_acc, 10, 100, 4)
+            from_id = from_acc.account_id
+
+            def balance():
+                with backend.unit_of_work():
+                    return backend.get_account_by_id(from_id).balance
+
+            async def wait_until(condition, timeout=10):
+                deadline = asyncio.get_running_loop().time() + timeout
+                while not condition():
+                    self.assertLess(asyncio.get_running_loop().time(), deadline)
+                    await asyncio.sleep(0.01)
+
+            def runs():
+                return backend.scheduler.stats()["runs"]
+
+            async def run():
+                clock[0] += 250  # the bot is "offline" for two payments
+                backend.scheduler.start()
+                await wait_until(lambda: runs() == 1)
+                self.assertEqual(balance(), 970)  # both missed payments were recovered on startup
+                clock[0] += 50
+                backend.scheduler.wake()
+                await wait_until(lambda: runs() == 2)
+                self.assertEqual(balance(), 960)
+                clock[0] += 100  # the transfer gets cleared up once its next payment would have been due
+                backend.scheduler.wake()
+                await wait_until(lambda: runs() == 3)
+                await backend.scheduler.stop()
+
+            asyncio.get_event_loop().run_until_complete(run())
+            self.assertEqual(balance(), 960)
+            with backend.unit_of_work() as session:
+                self.assertEqual(session.execute(select(func.count()).select_from(RecurringTransfer)).scalar(), 0)
+            stats = backend.scheduler.stats()
+            self.assertEqual(stats["scheduled"], 0)
+            self.assertEqual(stats["max_lag"], 150)  # the recovered payment was overdue
+            self.assertEqual(stats["last_lag"], 0)
+            backend.close()
+
+    def test_transfer_scheduler_backs_off(self):
+        backend = create_test_backend()
+        econ = backend.create_economy(admin, 'tau', 't')
+        user = add_member(user_id)
+        from_acc = backend.create_account(user, user_id, econ)
+        to_acc = backend.create_account(add_member(other_user_id), other_user_id, econ)
+        backend.print_money(admin, from_acc, 1000)
+        backend.create_recurring_transfer(user, from_acc, to_acc, 10, 60, 5)
+        old_time_func = time.time
+        time.time = lambda: old_time_func() + 61
+        self.addCleanup(setattr, time, 'time', old_time_func)
+
+        tick_economy = backend._tick_economy
+        attempts = []
+
+        def failing_tick_economy(*args):
+            attempts.append(time.time())
+            if len(attempts) < 3:
+                raise RuntimeError("boom")
+            return tick_economy(*args)
+
+        backend._tick_economy = failing_tick_economy
+        backend.scheduler.retry_delay = 0.1
+
+        async def run():
+            backend.scheduler.start()
+            deadline = asyncio.get_running_loop().time() + 10
+            while backend.scheduler.stats()["runs"] == 0:
+                self.assertLess(asyncio.get_running_loop().time(), deadline)
+                await asyncio.sleep(0.01)
+            await backend.scheduler.stop()
+
+        with self.assertLogs(logger, level=PUBLIC_LOG) as logs:
+            asyncio.get_event_loop().run_until_complete(run())
+        self.assertEqual(len(logs.records), 1)  # the later ticks wait for the next summary rather than posting one each
+        # the failing economy was retried after a back off each time rather than straight away over and over
+        self.assertEqual(len(attempts), 3)
+        self.assertGreaterEqual(attempts[2] - attempts[0], 0.2)
+        self.assertEqual(backend.scheduler.stats()["failures"], 2)
+        self.assertEqual(backend.get_account_by_id(to_acc.account_id).balance, 20)
+
+    def test_tax_engine(self):
+        backend = create_test_backend()
+        econ = backend.create_economy(admin, 'tau', 't')
+        other_admin = add_member(admin_id, guild=other_guild)
+        other_econ = backend.create_economy(other_admin, 'other', 'o')
+        gov = backend.create_account(admin, None, econ, 'government', AccountType.GOVERNMENT)
+        backend.create_tax_bracket(admin, 'w1', AccountType.USER, TaxType.WEALTH, 1000, 2000, 10, gov)
+        backend.create_tax_bracket(admin, 'w2', AccountType.USER, TaxType.WEALTH, 2000, 5000, 20, gov)
+        backend.create_tax_bracket(admin, 'i1', AccountType.USER, TaxType.INCOME, 0, 1000, 10, gov)
+        backend.create_tax_bracket(admin, 'i2', AccountType.USER, TaxType.INCOME, 1000, 10000, 50, gov)
+
+        accounts = {}
+        for owner_id, economy, actor, balance, income in ((1, econ, admin, 3000, 0), (2, econ, admin, 500, 3000),
+                                                          (3, econ, admin, 1500, 800), (4, other_econ, other_admin, 3000, 500)):
+            account = backend.create_account(actor, owner_id, economy)
+            backend.print_money(actor, account, balance)
+            backend.session.execute(update(Account).where(Account.account_id == account.account_id).values(income_to_date=income))
+            accounts[owner_id] = account.account_id
+        backend.session.commit()
+
+        revenue = backend.perform_tax(admin, econ)
+
+        # 2's income tax bill of 1100 only gets 500 out of them, the 600 shortfall comes off the top bracket
+        self.assertEqual(revenue, {'w1': 150, 'w2': 200, 'i1': 180, 'i2': 400})
+        balances = {owner_id: backend.get_account_by_id(account_id).balance for owner_id, account_id in accounts.items()}
+        self.assertEqual(balances, {1: 2700, 2: 0, 3: 1370, 4: 3000})
+        self.assertEqual(backend.get_account_by_id(gov.account_id).balance, 930)
+        self.assertEqual(sum(balances[i] for i in (1, 2, 3)) + 930, 5000)
+        incomes = {owner_id: backend.get_account_by_id(account_id).income_to_date for owner_id, account_id in accounts.items()}
+        self.assertEqual(incomes, {1: 0, 2: 0, 3: 0, 4: 500})  # the other economy is left alone
+
+    def test_simulate_tax(self):
+        rng = random.Random(1234)
+        for _ in range(5):
+            backend = create_test_backend()
+            econ = backend.create_economy(admin, 'tau', 't')
+            gov = backend.create_account(admin, None, econ, 'government', AccountType.GOVERNMENT)
+            types = [AccountType.USER, AccountType.CORPORATION, AccountType.CHARITY]
+            for tax_type in (TaxType.WEALTH, TaxType.INCOME):
+                for account_type in types[:2]:
+                    start = rng.randrange(0, 5000)
+                    for i in range(rng.randrange(1, 5)):
+                        end = start + rng.randrange(1000, 50000)
+                        backend.create_tax_bracket(admin, f'{tax_type.name}-{account_type.name}-{i}', account_type, tax_type, start, end, rng.randrange(0, 90), gov)
+                        start = end
+
+            accounts = []
+            for i in range(200):
+                account = backend.create_account(admin, 1000 + i, econ, f'account {i}', rng.choice(types))
+                accounts.append(account.account_id)
+                backend.session.execute(update(Account).where(Account.account_id == account.account_id)
+                                        .values(balance=rng.randrange(-100, 100000), income_to_date=rng.randrange(0, 100000)))
+            backend.session.commit()
+
+            report = backend.simulate_tax(admin, econ)
+            self.assertEqual(backend.get_account_by_id(gov.account_id).balance, 0)  # nothing was touched
+            revenue = backend.perform_tax(admin, econ)
+
+            self.assertEqual({b["tax_name"]: b["revenue"] for b in report["brackets"]}, revenue)
+            self.assertEqual(report["total"], backend.get_account_by_id(gov.account_id).balance)
+            self.assertTrue(report["debtors"])
+            for debtor in report["debtors"]:
+                self.assertLessEqual(backend.get_account_by_name(debtor["account_name"], econ).balance, 0)
+
+    def test_simulate_tax_credits_recipients(self):
+        backend = create_test_backend()
+        econ = backend.create_economy(admin, 'tau', 't')
+        gov = backend.create_account(admin, None, econ, 'government', AccountType.GOVERNMENT)
+        treasury = backend.create_account(admin, None, econ, 'treasury', AccountType.CORPORATION)
+        user = backend.create_account(admin, 1, econ, 'user', AccountType.USER)
+        backend.create_tax_bracket(admin, 'wealth', AccountType.USER, TaxType.WEALTH, 0, 100000, 10, gov)
+        backend.create_tax_bracket(admin, 'income', AccountType.GOVERNMENT, TaxType.INCOME, 0, 100000, 10, treasury)
+        # the government can only pay its income tax out of the wealth tax it has just been paid
+        backend.session.execute(update(Account).where(Account.account_id == user.account_id).values(balance=5000))
+        backend.session.execute(update(Account).where(Account.account_id == gov.account_id).values(balance=0, income_to_date=1000))
+        backend.session.commit()
+
+        report = backend.simulate_tax(admin, econ)
+        revenue = backend.perform_tax(admin, econ)
+        self.assertEqual({b["tax_name"]: b["revenue"] for b in report["brackets"]}, revenue)
+        self.assertEqual(revenue, {'wealth': 500, 'income': 100})
+        self.assertEqual(report["debtors"], [])
+        self.assertEqual(backend.get_account_by_id(gov.account_id).balance, 400)
+
+    def test_transaction_taxes(self):
+        backend = create_test_backend()
+        econ = backend.create_economy(admin, 'tau', 't')
+        gov = backend.create_account(admin, None, econ, 'government', AccountType.GOVERNMENT)
+        backend.create_tax_bracket(admin, 'v1', AccountType.USER, TaxType.VAT, 100, 1000, 10, gov)
+        backend.create_tax_bracket(admin, 'v2', AccountType.USER, TaxType.VAT, 1000, 5000, 20, gov)
+        backend.create_tax_bracket(admin, 't1', AccountType.USER, TaxType.TRANSACTION, 0, 10000, 1, gov)
+        sender = backend.create_account(admin, 1, econ)
+        receiver = backend.create_account(admin, 2, econ)
+        backend.print_money(admin, sender, 10000)
+
+        queries = []
+        event.listen(backend.engine, "before_cursor_execute", lambda *args: queries.append(args[2]))
+        # 90 + 100 of VAT comes out of the 1500, the 15 of transaction tax goes on top of it
+        backend.perform_transaction(admin, sender, receiver, 1500)
+        backend.perform_transaction(admin, sender, receiver, 50)  # below the VAT brackets
+        self.assertFalse([q for q in queries if 'FROM taxes' in q])
+
+        self.assertEqual(backend.get_account_by_id(sender.account_id).balance, 10000 - 1515 - 50)
+        self.assertEqual(backend.get_account_by_id(receiver.account_id).balance, 1310 + 50)
+        self.assertEqual(backend.get_account_by_id(gov.account_id).balance, 205)
+        with self.assertRaises(BackendError):
+            backend.perform_transaction(admin, sender, receiver, 8435)  # affordable were it not for the transaction tax
+
+        backend.delete_tax_bracket(admin, 't1', econ)
+        backend.perform_transaction(admin, sender, receiver, 100)
+        self.assertEqual(backend.get_account_by_id(gov.account_id).balance, 205)
+        with self.assertRaises(BackendError):
+            backend.delete_tax_bracket(admin, 't1', econ)
+
+    def test_transaction_batch(self):
+        backend = create_test_backend()
+        econ = backend.create_economy(admin, 'tau', 't')
+        other_econ = backend.create_economy(add_member(0, guild=other_guild), 'other', 'o')
+        gov = backend.create_account(admin, None, econ, 'government', AccountType.GOVERNMENT)
+        backend.create_tax_bracket(admin, 't1', AccountType.USER, TaxType.TRANSACTION, 0, 10000, 10, gov)
+        a = backend.create_account(admin, 1, econ)
+        b = backend.create_account(admin, 2, econ)
+        foreign = backend.create_account(admin, 3, other_econ)
+        backend.print_money(admin, a, 1000)
+        key = APIKey(issuer_id=admin_id, spending_limit=1000, enabled=True)
+        backend.session.add(key)
+        backend.session.commit()
+
+        # the second transfer can only be paid for with what the first one brings in
+        errors = backend.perform_transactions(admin, [(a, b, 500), (b, a, 400), (a, foreign, 10)], atomic=True, key=key)
+        self.assertEqual(errors, [None, None, "Cannot transfer funds from one economy to another"])
+        self.assertEqual(backend.get_account_by_id(a.account_id).balance, 1000)
+        self.assertEqual(backend.get_key_by_id(key.key_id).spent_to_date, 0)
+
+        queries = []
+        event.listen(backend.engine, "before_cursor_execute", lambda *args: queries.append(args[2]))
+        errors = backend.perform_transactions(admin, [(a, b, 500), (b, a, 400), (a, b, 2000), (a, a, 10)], atomic=False, key=key)
+        self.assertEqual(errors, [None, None, "You do not have sufficient funds to transfer from that account", None])
+        self.assertEqual(backend.get_account_by_id(a.account_id).balance, 1000 - 550 + 400)
+        self.assertEqual(backend.get_account_by_id(b.account_id).balance, 500 - 440)
+        self.assertEqual(backend.get_account_by_id(gov.account_id).balance, 90)
+        self.assertEqual(len(backend.get_transaction_log(admin, a)), 2)
+        self.assertEqual(backend.get_key_by_id(key.key_id).spent_to_date, 910)
+        self.assertLess(len([q for q in queries if q.startswith('UPDATE accounts')]), 2)
+
+        with self.assertRaises(SpendingLimitError):
+            backend.perform_transactions(admin, [(a, b, 50), (b, a, 50)], atomic=False, key=key)
+        self.assertEqual(backend.get_account_by_id(a.account_id).balance, 850)
+        self.assertEqual(backend.get_key_by_id(key.key_id).spent_to_date, 910)
+
+    def test_lookup_accounts(self):
+        backend = create_test_backend()
+        econ = backend.create_economy(admin, 'tau', 't')
+        other_econ = backend.create_economy(add_member(0, guild=other_guild), 'other', 'o')
+        a = backend.create_account(admin, None, econ, 'a', AccountType.CORPORATION)
+        b = backend.create_account(admin, None, econ, 'b', AccountType.CORPORATION)
+        foreign = backend.create_account(admin, None, other_econ, 'b', AccountType.CORPORATION)
+        ids = (a.account_id, b.account_id, foreign.account_id, econ.economy_id)
+
+        queries = []
+        event.listen(backend.engine, "before_cursor_execute", lambda *args: queries.append(args[2]))
+        accounts = backend.lookup_accounts([ids[0], uuid4()], ['b', 'missing'], ids[3])
+        self.assertEqual(len(queries), 1)
+        self.assertEqual({account.account_id for account in accounts}, {ids[0], ids[1]})  # names only match in the given economy
+        self.assertEqual({account.account_id for account in backend.lookup_accounts([ids[2]], [], ids[3])}, {ids[2]})
+
+    def test_token_cache(self):
+        backend = create_test_backend()
+        backend.token_cache.max_size = 2
+        keys = [APIKey(issuer_id=admin_id, enabled=True) for _ in range(3)]
+        backend.session.add_all(keys)
+        backend.session.commit()
+        digests = [TokenCache.digest(f'token {i}') for i in range(3)]
+        for digest, key in zip(digests, keys):
+            backend.token_cache.put(digest, key.key_id, key.enabled)
+
+        self.assertIsNone(backend.token_cache.get(digests[0]))  # least recently used
+        self.assertEqual(backend.token_cache.get(digests[1]), (keys[1].key_id, True))
+        self.assertEqual(backend.token_cache.stats()["evictions"], 1)
+
+        backend.delete_key(keys[1])
+        self.assertIsNone(backend.token_cache.get(digests[1]))
+        backend.delete_key(keys[2])
+        self.assertIsNone(backend.token_cache.get(digests[2]))
+        self.assertEqual(len(backend.token_cache), 0)
+
+    def test_key_context(self):
+        backend = create_test_backend()
+        simdem.members.append(admin)  # so the key's issuer can be fetched
+        self.addCleanup(simdem.members.remove, admin)
+        econ = backend.create_economy(admin, 'tau', 't')
+        account = backend.create_account(admin, admin_id, econ)
+        other = backend.create_account(admin, 1234, econ)
+        app = Application(application_id=uuid4(), application_name='app', owner_id=admin_id, economy=econ)
+        key = APIKey(application=app, issuer_id=admin_id, spending_limit=100, enabled=True)
+        backend.session.add(key)
+        backend.session.commit()
+        key_id, economy_id, guild_id = key.key_id, econ.economy_id, econ.owner_guild_id
+        backend.change_permissions(admin, key_id, Permissions.VIEW_BALANCE, account=account)
+
+        queries = []
+        event.listen(backend.engine, "before_cursor_execute", lambda *args: queries.append(args[2]))
+        context = backend.get_key_context(key_id)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual((context.economy_id, context.owner_guild_id, context.spending_limit), (economy_id, guild_id, 100))
+        self.assertIs(backend.get_key_context(key_id), context)
+        self.assertEqual(len(queries), 1)
+
+        loop = asyncio.get_event_loop()
+        self.assertTrue(loop.run_until_complete(backend.key_has_permission(context, Permissions.VIEW_BALANCE, account=account)))
+        self.assertFalse(loop.run_until_complete(backend.key_has_permission(context, Permissions.VIEW_BALANCE, account=other)))
+        perms = loop.run_until_complete(backend.key_evaluate_permissions(context, [Permissions.VIEW_BALANCE], [account, other]))
+        self.assertEqual(perms, {(Permissions.VIEW_BALANCE, account.account_id): True, (Permissions.VIEW_BALANCE, other.account_id): False})
+
+        backend.change_permissions(admin, key.key_id, Permissions.VIEW_BALANCE, account=other)
+        context = backend.get_key_context(key.key_id)
+        self.assertTrue(loop.run_until_complete(backend.key_has_permission(context, Permissions.VIEW_BALANCE, account=other)))
+
+        self.assertTrue(backend.add_key_spending(context, 60))
+        self.assertFalse(backend.add_key_spending(context, 60))  # over the limit
+        self.assertTrue(backend.add_key_spending(context, 40))
+        self.assertEqual(backend.get_key_by_id(key.key_id).spent_to_date, 100)
+
+        backend.delete_key(backend.get_key_by_id(key.key_id))
+        self.assertIsNone(backend.get_key_context(key.key_id))
+
+    def test_grant_stores(self):
+        backend = create_test_backend()
+        econ = backend.create_economy(admin, 'tau', 't')
+        app = Application(application_id=uuid4(), application_name='app', owner_id=admin_id, economy=econ)
+        backend.session.add(app)
+        backend.session.commit()
+        app_id = app.application_id
+
+        self.assertRaises(TypeError, GrantStore)  # only its implementations can be made
+        for store in (MemoryGrantStore(ttl=0.2, max_pending=2), SQLGrantStore(backend, ttl=0.2, max_pending=2)):
+            refs = [uuid4() for _ in range(3)]
+            for ref_id in refs:
+                store.put(app_id, ref_id, {})
+            self.assertIsNone(store.get(app_id, refs[0]))  # dropped to make room
+            store.put(app_id, refs[1], {"issuer_id": admin_id, "request_data": {"spending_limit": None}})
+            self.assertEqual(store.get(app_id, refs[1])["issuer_id"], admin_id)
+            self.assertEqual(store.pop(app_id, refs[1])["request_data"], {"spending_limit": None})
+            self.assertIsNone(store.pop(app_id, refs[1]))
+            self.assertEqual(store.get(app_id, refs[2]), {})
+            time.sleep(0.25)
+            self.assertIsNone(store.get(app_id, refs[2]))  # expired
+            self.assertIsNone(store.pop(app_id, refs[2]))
+
+    def test_issue_granted_key(self):
+        backend = create_test_backend()
+        econ = backend.create_economy(admin, 'tau', 't')
+        account = backend.create_account(admin, admin_id, econ)
+        app = Application(application_id=uuid4(), application_name='app', owner_id=admin_id, economy=econ)
+        backend.session.add(app)
+        backend.session.commit()
+        app_id = app.application_id
+
+        for store in (MemoryGrantStore(), SQLGrantStore(backend)):
+            ref_id = uuid4()
+            grant = {"issuer_id": admin_id, "request_data": {"spending_limit": 50, "permissions": {str(account.account_id): ["NOT_A_PERMISSION"]}}}
+            store.put(app_id, ref_id, grant)
+            backend.session.commit()
+            with self.assertRaises(KeyError):
+                backend.issue_granted_key(store, app, ref_id)
+            self.assertIsNone(backend.get_key(app, ref_id))
+            self.assertEqual(store.get(app_id, ref_id), grant)  # still there to be retrieved again
+
+            grant["request_data"]["permissions"] = {str(account.account_id): ["TRANSFER_FUNDS"]}
+            store.put(app_id, ref_id, grant)
+            backend.session.commit()
+            key = backend.issue_granted_key(store, app, ref_id)
+            self.assertEqual((key.enabled, key.spending_limit), (True, 50))
+            self.assertTrue(backend.has_permission(StubUser(key.key_id), Permissions.TRANSFER_FUNDS, account=account))
+            self.assertIsNone(backend.issue_granted_key(store, app, ref_id))  # only claimed once
+            backend.session.rollback()
+            self.assertIsNone(store.get(app_id, ref_id))
+
+    def test_idempotency_keys(self):
+        clock = [time.time()]
+        old_time_func = time.time
+        time.time = lambda: clock[0]
+        self.addCleanup(setattr, time, 'time', old_time_func)
+        backend = create_test_backend()
+        backend.idempotency_ttl, backend.idempotency_lease = 100, 10
+        econ = backend.create_economy(admin, 'tau', 't')
+        user = add_member(user_id)
+        from_acc = backend.create_account(user, user_id, econ)
+        to_acc = backend.create_account(add_member(other_user_id), other_user_id, econ)
+        backend.print_money(admin, from_acc, 1000)
+        key, other = APIKey(issuer_id=admin_id, enabled=True, spending_limit=300), APIKey(issuer_id=admin_id, enabled=True)
+        backend.session.add_all([key, other])
+        backend.session.commit()
+        key_id, other_id = key.key_id, other.key_id
+
+        claim = IdempotencyClaim(key_id, 'retry me', uuid4(), 200, '200: OK')
+        self.assertIsNone(backend.claim_idempotency_key(claim, 'hash'))
+        self.assertIsNone(backend.claim_idempotency_key(claim._replace(key_id=other_id), 'hash'))  # keys are scoped to the api key
+        retry = claim._replace(claim_id=uuid4())
+        self.assertIsNone(backend.claim_idempotency_key(retry, 'hash').status)  # still in progress
+
+        # the outcome goes in with the transfer, so releasing afterwards (say the request got cancelled) keeps it
+        backend.perform_transaction(user, from_acc, to_acc, 100, key=key, idempotency=claim)
+        backend.release_idempotency_key(claim)
+        record = backend.claim_idempotency_key(retry, 'other hash')
+        self.assertEqual((record.status, record.response, record.request_hash), (200, '200: OK', 'hash'))
+        self.assertEqual(key.spent_to_date, 100)
+
+        # a claim whose lease ran out is handed to the next request and the original can't go through anymore
+        clock[0] += 11
+        stale = claim._replace(key_id=other_id)
+        self.assertIsNone(backend.claim_idempotency_key(stale._replace(claim_id=uuid4()), 'hash'))
+        with self.assertRaises(IdempotencyError):
+            backend.perform_transaction(user, from_acc, to_acc, 100, idempotency=stale)
+        self.assertEqual(backend.get_account_by_id(from_acc.account_id).balance, 900)
+        self.assertIsNotNone(backend.claim_idempotency_key(claim._replace(claim_id=uuid4()), 'hash').status)  # finished ones last the ttl
+
+        # nothing is recorded when the key's spending limit stops the transfer
+        limited = IdempotencyClaim(key_id, 'too much', uuid4())
+        backend.claim_idempotency_key(limited, 'hash')
+        with self.assertRaises(SpendingLimitError):
+            backend.perform_transaction(user, from_acc, to_acc, 300, key=key, idempotency=limited)
+        backend.release_idempotency_key(limited)
+        self.assertIsNone(backend.claim_idempotency_key(limited, 'hash'))
+
+        clock[0] += 101
+        self.assertIsNone(backend.claim_idempotency_key(claim, 'hash'))  # expired
+        backend.delete_key(backend.get_key_by_id(key_id))
+        self.assertEqual(backend.session.execute(select(func.count()).select_from(IdempotencyRecord)
+                                                 .where(IdempotencyRecord.key_id == key_id)).scalar_one(), 0)
+
     def test_taxes(self):
         backend = create_test_backend()
         econ = backend.create_economy(admin, 'tau', 't')
@@ -56,12 +56,18 @@ class StubGuild:
             return m[0]
         return None
 
+    def get_member(self, user_id):
+        return None
+
 
 
 class StubBot:
     def __init__(self):
         pass
 
+    def get_guild(self, guild_id):
+        return None
+
     async def fetch_guild(self, guild_id):
         g = guilds.get(guild_id)
         if g is not None:
@@ -73,5 +79,8 @@ class StubBot:
     async def fetch_user(self, user_id):
         return StubMember(user_id, [])
 
+    def get_partial_messageable(self, channel_id, type=None):
+        return Channel(channel_id)
+
 
 